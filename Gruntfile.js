@@ -1,8 +1,51 @@
 module.exports = function(grunt) {
     'use strict';
+    // Static files of the Flask app and the bundles built from them. The
+    // app reads the same bundle list to link the sources before a build.
+    var staticDir = 'vagrant/catalog/static/',
+        bundles = grunt.file.readJSON('vagrant/catalog/bundles.json');
+
+    // Returns {bundle path: [source paths]} for bundles ending in `ext`.
+    function bundleFiles(ext) {
+        var files = {};
+        Object.keys(bundles).forEach(function(name) {
+            if (name.slice(-ext.length) === ext) {
+                files[staticDir + name] = bundles[name].map(function(src) {
+                    return staticDir + src;
+                });
+            }
+        });
+        return files;
+    }
+
     // Project configuration.
     grunt.initConfig({
         pkg: grunt.file.readJSON('package.json'),
+        uglify: {
+            options: {
+                preserveComments: 'some'
+            },
+            assets: {
+                files: bundleFiles('.js')
+            }
+        },
+        cssmin: {
+            assets: {
+                files: bundleFiles('.css')
+            }
+        },
+        // Renames each bundle to include a hash of its content.
+        filerev: {
+            options: {
+                algorithm: 'sha256',
+                length: 10
+            },
+            assets: {
+                src: Object.keys(bundles).map(function(name) {
+                    return staticDir + name;
+                })
+            }
+        },
         watch: {
             markdown: {
                 files: ['docs/*.md'],
@@ -15,9 +58,29 @@ module.exports = function(grunt) {
     });
 
     // Load plugins for tasks.
+    grunt.loadNpmTasks('grunt-contrib-cssmin');
+    grunt.loadNpmTasks('grunt-contrib-uglify');
     grunt.loadNpmTasks('grunt-contrib-watch');
+    grunt.loadNpmTasks('grunt-filerev');
     grunt.loadNpmTasks('grunt-readme');
 
+    // Writes the bundle names and their hashed names, relative to the
+    // static folder, for the Flask app to link.
+    grunt.registerTask('manifest', 'Write static/manifest.json.', function() {
+        var manifest = {};
+        Object.keys(grunt.filerev.summary).forEach(function(path) {
+            var hashed = grunt.filerev.summary[path];
+            path = path.replace(/\\/g, '/');
+            hashed = hashed.replace(/\\/g, '/');
+            manifest[path.slice(staticDir.length)] =
+                hashed.slice(staticDir.length);
+        });
+        grunt.file.write(staticDir + 'manifest.json',
+                         JSON.stringify(manifest, null, 2) + '\n');
+        grunt.log.writeln('Wrote ' + staticDir + 'manifest.json');
+    });
+
     // Default task(s).
     grunt.registerTask('default', ['readme', 'watch']);
+    grunt.registerTask('assets', ['uglify', 'cssmin', 'filerev', 'manifest']);
 };
\ No newline at end of file
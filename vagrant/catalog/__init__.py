@@ -1,8 +1,38 @@
+import os
 from flask import Flask
 import database_setup as db_setup
 from database_setup import Restaurant, MenuItem, MenuItemRating, User
+from catalog.cache import ResponseCache, DatabaseVersions
+from catalog.profiling import QueryProfiler
+from catalog.metrics import Metrics
+from catalog.google import GoogleClient
+from catalog.compress import Compressor
+from catalog.assets import Assets
 
 app = Flask(__name__)
+# Cache for JSON API responses. Cleared by the write methods in `api.py`,
+# which bump the tag versions shared by all processes in the database.
+app.response_cache = ResponseCache(
+    max_entries=1000, ttl=300,
+    versions=DatabaseVersions(lambda: app.db_session))
+# SQL counts and timings per request. Set app.config['SQL_PROFILING'] = True
+# to add them to response headers and the "/debug/queries" summary.
+app.query_profiler = QueryProfiler(window=100)
+app.query_profiler.init_app(app)
+# Prometheus metrics served at "/metrics".
+app.metrics = Metrics()
+app.metrics.init_app(app)
+# Client for Google sign-in calls. See `google.py` for its config settings.
+app.google = GoogleClient()
+app.google.init_app(app)
+# Compresses large responses and serves precompressed static files. Run
+# `compress.py` to write the static copies.
+app.compressor = Compressor()
+app.compressor.init_app(app)
+# Links the bundles built by `assets.py` in templates and caches them for a
+# year.
+app.assets = Assets()
+app.assets.init_app(app)
 # Sub-modules require Flask instance called `app`.
 import catalog.views
 import catalog.api
@@ -12,17 +42,100 @@ import catalog.signin
 def start_session(test=False):
     """Gets a session (SQLAlchemy) with the database.
 
-    Gets a new session with the testing or production database and assigns
-    it to the global `session` variable. The session is also added as an
-    attribute to 'app'. See `database_setup.py` for dbapi type and db tables.
+    Gets a scoped session registry for the testing or production database
+    and adds it as an attribute to 'app'. Each thread uses its own session
+    from the registry and the session is removed at the end of each request.
+    See `database_setup.py` for dbapi type, pool settings and db tables.
 
     :arg boolean test: Boolean to use test DB instead of the production DB.
     """
-    app.db_session = db_setup.get_database_session(test=test)
+    app.db_session = db_setup.get_scoped_session(test=test)
+    engine = db_setup.get_engine(test=test)
+    app.query_profiler.attach(engine)
+    app.metrics.attach(engine)
 
 # Access start_session method using a reference to app.
 app.start_session = start_session
 
+# App config keys for the database settings in `database_setup.py`.
+database_settings = [
+    ('DATABASE_NAME', 'database_name'),
+    ('DATABASE_POSTGRESQL', 'use_postgresql'),
+    ('DATABASE_POOL_SIZE', 'pool_size'),
+    ('DATABASE_MAX_OVERFLOW', 'max_overflow'),
+    ('DATABASE_POOL_RECYCLE', 'pool_recycle'),
+]
+# Set once ``after_fork`` is registered to run in forked processes.
+_fork_hook = []
+
+
+def after_fork():
+    """Drops the connections a worker process inherited from its parent.
+
+    Pre-fork servers import the app and may open connections before forking
+    worker processes. A connection used by two processes mixes up their
+    queries, so each worker starts with empty pools. The parent's
+    connections are left open for the parent.
+    """
+    if hasattr(app, 'db_session'):
+        # Forget the parent's sessions without returning their connections.
+        app.db_session.registry.clear()
+    db_setup.dispose_engines(close=False)
+    app.google.reset()
+
+
+def load_config(config=None):
+    """Reads the app settings and applies the database settings.
+
+    Settings are read from the Python file named by the ``CATALOG_SETTINGS``
+    environment variable, if set, and then from the ``config`` dict. A
+    ``SECRET_KEY`` is required, because every worker process must sign
+    sessions with the same key. The database settings are given by the
+    ``database_settings`` keys, and the Google settings in `google.py`.
+
+    :arg dict config: Settings to use over those of the settings file.
+    :raises RuntimeError: If no ``SECRET_KEY`` is set.
+    """
+    app.config.from_envvar('CATALOG_SETTINGS', silent=True)
+    if config:
+        app.config.update(config)
+    if not app.config.get('SECRET_KEY'):
+        raise RuntimeError('Set SECRET_KEY in the CATALOG_SETTINGS file.')
+    changed = False
+    for key, name in database_settings:
+        if key in app.config and app.config[key] != getattr(db_setup, name):
+            setattr(db_setup, name, app.config[key])
+            changed = True
+    if changed:
+        # Engines created before have the old settings.
+        db_setup.reset_engines()
+
+
+def create_app(config=None):
+    """Configures the app for a production WSGI server and returns it.
+
+    See ``load_config`` for the settings. Workers forked after this call
+    drop inherited database connections, see ``after_fork``.
+
+    :arg dict config: Settings to use over those of the settings file.
+    :returns: The Flask app.
+    :raises RuntimeError: If no ``SECRET_KEY`` is set.
+    """
+    load_config(config)
+    start_session(test=app.config.get('TESTING', False))
+    app.google.load_secrets()
+    if hasattr(os, 'register_at_fork') and not _fork_hook:
+        os.register_at_fork(after_in_child=after_fork)
+        _fork_hook.append(after_fork)
+    return app
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Closes the current thread's session at the end of a request."""
+    if hasattr(app, 'db_session'):
+        app.db_session.remove()
+
 
 ##############################################################################
 # Helper functions for shorthand querying.
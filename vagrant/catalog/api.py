@@ -1,12 +1,19 @@
 import pip  # For getting list of installed packages
+import json
+import operator
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from functools import wraps
-from flask import request, jsonify, abort
+from flask import request, jsonify, abort, stream_with_context, make_response
 from flask import session as login_session
 from catalog import app
+from catalog.cache import cached_response, etag_response
 from database_setup import Restaurant, MenuItem, MenuItemRating, User
+from database_setup import update_rating_counts, upsert_ratings, search
+from database_setup import parse_price
+from sqlalchemy import func, and_, or_, false
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.exc import IntegrityError
-from random import sample
 
 
 ##############################################################################
@@ -29,69 +36,400 @@ def checks_login_and_csrf_status(func):
     return wrapper
 
 
+def varies_on_accept(func):
+    """Decorator adding "Vary: Accept" to every response of a view whose
+    format depends on the Accept header, including 304 and cached ones, so
+    caches don't serve a JSON list to a client asking for a stream.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        resp = make_response(func(*args, **kwargs))
+        resp.vary.add('Accept')
+        return resp
+    return wrapper
+
+
+##############################################################################
+# Query helpers
+##############################################################################
+# Page size used when only an 'after' cursor is given and the largest
+# page size allowed for a 'limit' parameter.
+default_page_size = 50
+max_page_size = 500
+
+# Largest number of ratings accepted by one request to "/ratings/batch".
+max_batch_size = 500
+
+# Number of rows loaded from the database at a time for streamed lists.
+stream_batch_size = 500
+
+# Sort keys of paginated lists as (column, descending) pairs, or
+# (column, descending, nulls last) triples for nullable columns. The last key
+# must be unique so that every row has a distinct position.
+restaurant_keys = [(Restaurant.name, False), (Restaurant.id, False)]
+menu_keys = [(MenuItem.id, False)]
+popularity_keys = [(MenuItem.restaurant_id, False),
+                   (MenuItem.favorite_count, True),
+                   (MenuItem.good_count, True),
+                   (MenuItem.bad_count, False),
+                   (MenuItem.id, False)]
+# Items without a price come last. Sorting on the bare column lets the
+# price index give the order.
+price_keys = [(MenuItem.price_cents, False, True), (MenuItem.id, False)]
+
+
+def _order_by(keys):
+    """Returns ORDER BY clauses for a list of sort keys."""
+    clauses = []
+    for key in keys:
+        clause = key[0].desc() if key[1] else key[0]
+        if len(key) > 2 and key[2]:
+            clause = clause.nullslast()
+        clauses.append(clause)
+    return clauses
+
+
+def _after(keys, values):
+    """Returns a filter for rows sorted after the given key values.
+
+    :arg keys: List of sort keys that rows are sorted by.
+    :arg values: Key values of the last row of the previous page.
+    """
+    clause = None
+    for key, value in reversed(list(zip(keys, values))):
+        column, desc, nulls_last = (tuple(key) + (False,))[:3]
+        if nulls_last and value is None:
+            # Nothing sorts after NULL in this column.
+            beyond, same = false(), column.is_(None)
+        else:
+            beyond = column < value if desc else column > value
+            if nulls_last:
+                beyond = or_(beyond, column.is_(None))
+            same = column == value
+        if clause is None:
+            clause = beyond
+        else:
+            clause = or_(beyond, and_(same, clause))
+    return clause
+
+
+def _encode_cursor(values):
+    """Returns an opaque cursor string for a list of key values."""
+    data = urlsafe_b64encode(json.dumps(values).encode('utf-8'))
+    return data.decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """Returns the list of key values in a cursor from ``_encode_cursor``.
+
+    Aborts with a 400 error if the cursor is not valid.
+    """
+    try:
+        data = cursor.encode('ascii') + b'=' * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(data).decode('utf-8'))
+    except (ValueError, TypeError):
+        return abort(400)
+    if not isinstance(values, list):
+        return abort(400)
+    return values
+
+
+def _paginate(query, keys, row_values):
+    """Applies keyset pagination from the request args to a query.
+
+    Reads the optional 'limit' and 'after' args. Pages start after the row
+    identified by the 'after' cursor, so every page is read from the index
+    at the same cost. The query is returned unchanged if neither arg is
+    given.
+
+    :arg query: Query sorted by ``keys``.
+    :arg keys: List of sort keys that rows are sorted by.
+    :arg row_values: Function returning the key values for a result row.
+    :returns: A tuple of the list of rows and a dict to add to the response.
+        The dict has the cursor string for the next page as 'next' (*None* if
+        there are no more rows) and is empty if not paginated.
+    """
+    query, limit = _page_query(query, keys, request.args)
+    if limit is None:
+        return query.all(), {}
+    return _page(query.all(), limit, row_values)
+
+
+def _page_query(query, keys, args):
+    """Applies the 'limit' and 'after' args to a query or select statement.
+
+    The query gets one row more than the page size, so ``_page`` can tell
+    if there is a next page. Aborts with a 400 error for invalid args.
+
+    :arg args: The request args.
+    :returns: A tuple of the query and the page size, or *None* as the size
+        if neither arg is given and the query is unchanged.
+    """
+    if 'limit' not in args and 'after' not in args:
+        return query, None
+    try:
+        limit = int(args.get('limit', default_page_size))
+    except ValueError:
+        return abort(400)
+    if limit < 1:
+        return abort(400)
+    limit = min(limit, max_page_size)
+    if args.get('after'):
+        values = _decode_cursor(args['after'])
+        if len(values) != len(keys):
+            return abort(400)
+        query = query.filter(_after(keys, values))
+    return query.limit(limit + 1), limit
+
+
+def _page(rows, limit, row_values):
+    """Returns the rows of a page from ``_page_query`` and the 'next' dict."""
+    if len(rows) <= limit:
+        return rows, dict(next=None)
+    rows = rows[:limit]
+    return rows, dict(next=_encode_cursor(row_values(rows[-1])))
+
+
+def _menu_filters(query, keys, args):
+    """Applies menu item filters and sort order from the request args.
+
+    Reads the optional 'course', 'min_price' and 'max_price' (in dollars,
+    like "7.50") args and 'sort=price' for cheapest items first. Aborts
+    with a 400 error for an invalid price or sort.
+
+    :arg query: Query of menu items, or of rows with a menu item first.
+    :arg keys: Default sort keys of the query.
+    :arg args: The request args.
+    :returns: A tuple of the sorted query and its sort keys.
+    """
+    if args.get('course'):
+        query = query.filter(MenuItem.course == args['course'])
+    for arg, compare in (('min_price', operator.ge),
+                         ('max_price', operator.le)):
+        if args.get(arg):
+            cents = parse_price(args[arg])
+            if cents is None:
+                return abort(400)
+            query = query.filter(compare(MenuItem.price_cents, cents))
+    sort = args.get('sort')
+    if sort == 'price':
+        keys = price_keys
+    elif sort:
+        return abort(400)
+    return query.order_by(None).order_by(*_order_by(keys)), keys
+
+
+def _item_key_values(keys):
+    """Returns a function of a menu item returning its sort key values."""
+    return lambda item: [getattr(item, key[0].name) for key in keys]
+
+
+def _wants_stream():
+    """Returns *True* if the request asks for a streamed list.
+
+    Lists are streamed for a 'stream=1' arg or an Accept header preferring
+    "application/x-ndjson".
+    """
+    if request.args.get('stream') == '1':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def _stream(query, sdict):
+    """Returns a response streaming query results as newline-delimited JSON.
+
+    Rows are loaded ``stream_batch_size`` at a time and each row is written
+    as one JSON object per line, so memory use does not grow with the
+    number of rows.
+
+    :arg query: Query for the rows to send.
+    :arg sdict: Function converting a row to serializeable format.
+    """
+    def generate():
+        for row in query.yield_per(stream_batch_size):
+            yield json.dumps(sdict(row)) + '\n'
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='application/x-ndjson')
+
+
+def _rated_items_query(user_id=None):
+    """Returns a query of menu items with their rating totals.
+
+    The restaurant name and the given user's rating are joined to each item
+    in one SQL statement instead of loading the ``ratings`` relationship of
+    every item. Rows are ordered by popularity: number of 'favorite' ratings
+    down to number of 'dislike' ratings.
+
+    :arg optional user_id: ID of user whose rating is added to each row.
+    :returns: Query yielding (MenuItem, restaurant_name, rating) tuples.
+    """
+    user_rating = aliased(MenuItemRating)
+    return (app.db_session
+            .query(MenuItem,
+                   Restaurant.name,
+                   func.coalesce(user_rating.rating, 0))
+            .join(Restaurant, MenuItem.restaurant_id == Restaurant.id)
+            .outerjoin(user_rating, and_(user_rating.item_id == MenuItem.id,
+                                         user_rating.user_id == user_id))
+            .order_by(*_order_by(popularity_keys)))
+
+
+def _rated_item_sdict(row):
+    """Converts a row from ``_rated_items_query`` to serializeable format.
+
+    The result has the same keys as ``MenuItem.sdict`` plus the user's
+    'rating' (zero if not rated).
+    """
+    item, restaurant_name, rating = row
+    sd = _item_sdict(item, restaurant_name)
+    sd['rating'] = int(rating)
+    return sd
+
+
+def _item_sdict(item, restaurant_name):
+    """Returns ``MenuItem.sdict`` without loading the item's restaurant."""
+    sd = {c.name: getattr(item, c.name) for c in item.__table__.columns}
+    sd['restaurant_name'] = restaurant_name
+    return sd
+
+
+def _menu_tags(name=None, r_id=None):
+    """Returns the response cache tags for a call to ``api_menu``."""
+    name = request.args.get('restaurant', name)
+    r_id = request.args.get('restaurant_id', r_id)
+    if name:
+        return [('menu_name', name)]
+    try:
+        return [('menu_id', int(r_id))]
+    except (TypeError, ValueError):
+        return []
+
+
+def _items_tags():
+    """Returns the response cache tags for a call to ``get_items``."""
+    return _menu_tags(r_id=request.args.get('id'))
+
+
+def _restaurant_tags(*restaurants):
+    """Returns the response cache tags for the menus of restaurants.
+
+    :arg restaurants: (id, name) tuples of restaurants.
+    """
+    tags = []
+    for r_id, name in restaurants:
+        tags.extend([('menu_id', r_id), ('menu_name', name)])
+    return tags
+
+
+def _item_tags(item_ids):
+    """Returns the response cache tags for the menus holding menu items."""
+    if not item_ids:
+        return []
+    recs = (app.db_session.query(Restaurant.id, Restaurant.name)
+            .join(MenuItem, MenuItem.restaurant_id == Restaurant.id)
+            .filter(MenuItem.id.in_(item_ids))
+            .distinct())
+    return _restaurant_tags(*recs)
+
+
+def _user_sdict(user):
+    """Returns ``User.sdict`` without the email address."""
+    sd = user.sdict
+    sd.pop('email', None)
+    return sd
+
+
+def _strip_rating_counts(item):
+    """Removes stored rating totals from posted menu item data.
+
+    The totals are only written by ``update_rating_counts``. The price in
+    cents is also removed, because it is set from the price string.
+    """
+    for key in ('favorite_count', 'good_count', 'bad_count', 'price_cents'):
+        item.pop(key, None)
+    return item
+
+
 ##############################################################################
 # JSON RESPONSE API (Using jsonify)
 ##############################################################################
 @app.route('/items', methods=['GET'])
+@etag_response(app.response_cache, _items_tags, per_user=True)
 def get_items():
     """Returns a list of all menu items for a restaurant.
 
     Items are sorted by overall popularity: number of 'favorite' ratings down
     to number of 'dislike' ratings. Each item also includes the user's rating
     if a user is logged in.
+
+    Pass 'limit' and 'after' args for pages of items. The response then
+    includes a 'next' cursor for getting the following page.
+
+    Pass 'course', 'min_price' and 'max_price' args to filter the items and
+    'sort=price' to sort them by price instead.
     """
     r_id = request.args['id']
-    recs = app.q_MenuItem().filter_by(restaurant_id=r_id)
-
-    # Convert to serializable and add logged-in user's ratings for each item.
     user_id = login_session.get('user_id', None)
-    serializable_recs = []
-    for each_rec in recs:
-        srec = each_rec.sdict
-        for each_rating in each_rec.ratings:
-            if each_rating.user_id == user_id:
-                srec['rating'] = each_rating.rating
-                break
-        else:
-            srec['rating'] = 0
-        serializable_recs.append(srec)
-
-    # Sort menu items by their popularity and return list.
-    resp = sorted(
-        serializable_recs,
-        key=lambda d: (-d['favorite_count'], -d['good_count'], d['bad_count'])
-    )
-    return jsonify(items=resp)
+    recs = _rated_items_query(user_id).filter(MenuItem.restaurant_id == r_id)
+    recs, keys = _menu_filters(recs, popularity_keys, request.args)
+    key_values = _item_key_values(keys)
+    recs, page = _paginate(recs, keys, lambda row: key_values(row[0]))
+    return jsonify(items=[_rated_item_sdict(each) for each in recs], **page)
 
 
 @app.route('/api/restaurants', methods=['GET'])
+@varies_on_accept
+@etag_response(app.response_cache, lambda: ['restaurants'],
+               bypass=_wants_stream)
+@cached_response(app.response_cache, lambda: ['restaurants'],
+                 bypass=_wants_stream)
 def api_restaurants():
     """Returns a list of restaurants in the database.
 
+    Pass 'limit' and 'after' args for pages of restaurants. The response
+    then includes a 'next' cursor for getting the following page.
+
+    Pass a 'stream=1' arg or accept "application/x-ndjson" to get all
+    restaurants streamed as one JSON object per line.
+
     :returns: JSON with a 'restaurants' key and list of restaurants.
     """
-    recs = app.q_Restaurant().order_by('name')
-    resp = [each.sdict for each in recs]
-    return jsonify(restaurants=resp)
+    recs = app.q_Restaurant().order_by(*_order_by(restaurant_keys))
+    if _wants_stream():
+        return _stream(recs, lambda rec: rec.sdict)
+    recs, page = _paginate(recs, restaurant_keys,
+                           lambda rec: [rec.name, rec.id])
+    return jsonify(restaurants=[each.sdict for each in recs], **page)
 
 
 @app.route('/api/users', methods=['GET'])
+@varies_on_accept
+@etag_response(app.response_cache, lambda: ['users'], bypass=_wants_stream)
+@cached_response(app.response_cache, lambda: ['users'], bypass=_wants_stream)
 def api_users():
     """Returns a list of users in the database.
 
     Email addresses are removed from returned data.
 
+    Pass a 'stream=1' arg or accept "application/x-ndjson" to get the users
+    streamed as one JSON object per line.
+
     :returns: JSON with a 'users' key and list of users.
     """
+    if _wants_stream():
+        return _stream(app.q_User().order_by(User.id), _user_sdict)
     recs = app.q_User().all()
-    resp = [each.sdict for each in recs]
-    [each.pop('email', None) for each in resp]
-    return jsonify(users=resp)
+    return jsonify(users=[_user_sdict(each) for each in recs])
 
 
 @app.route('/api/menu', methods=['GET'])
 @app.route('/api/menu/restaurant=<string:name>', methods=['GET'])
 @app.route('/api/menu/restaurant_id=<int:r_id>', methods=['GET'])
+@varies_on_accept
+@etag_response(app.response_cache, _menu_tags, bypass=_wants_stream)
+@cached_response(app.response_cache, _menu_tags, bypass=_wants_stream)
 def api_menu(name=None, r_id=None):
     """Returns the menu for a restaurant in JSON format.
 
@@ -99,6 +437,15 @@ def api_menu(name=None, r_id=None):
     You can get a list of restaurant names and ID numbers by using
     "/api/restaurants".
 
+    Pass 'limit' and 'after' args for pages of menu items. The response
+    then includes a 'next' cursor for getting the following page.
+
+    Pass a 'stream=1' arg or accept "application/x-ndjson" to get the whole
+    menu streamed as one JSON object per line.
+
+    Pass 'course', 'min_price' and 'max_price' args to filter the items and
+    'sort=price' to sort them by price instead of ID.
+
     :arg string restaurant: The name of a restaurant to lookup.
     :arg int restaurant_id: The database ID of a restaurant.
     :returns: JSON with a 'menu' key and a list of menu items.
@@ -119,9 +466,54 @@ def api_menu(name=None, r_id=None):
     else:
         # Retrieve menu items by the restaurant ID.
         recs = app.q_MenuItem().filter_by(restaurant_id=r_id)
+    recs, keys = _menu_filters(recs, menu_keys, request.args)
+    if _wants_stream():
+        return _stream(recs, lambda rec: rec.sdict)
+    recs, page = _paginate(recs, keys, _item_key_values(keys))
     # Convert database objects to serializable dict objects.
     recs_json = [each.sdict for each in recs]
-    return jsonify(menu=recs_json)
+    return jsonify(menu=recs_json, **page)
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Returns menu items and restaurants matching the words of a search.
+
+    Items match on their name and description and restaurants on their name
+    and note. Every word must match. The best matches come first.
+
+    Results come in pages of 'limit' results (default 50). Pass the 'next'
+    cursor of a response as the 'after' arg to get the following page.
+
+    :arg string q: Words to search for.
+    :returns: JSON with a 'results' key, a list of results, and a 'next' key.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify(error='Missing search words.'), 400
+    try:
+        limit = int(request.args.get('limit', default_page_size))
+    except ValueError:
+        return abort(400)
+    if limit < 1:
+        return abort(400)
+    limit = min(limit, max_page_size)
+    after = None
+    if request.args.get('after'):
+        after = _decode_cursor(request.args['after'])
+        if len(after) != 3 or \
+                not isinstance(after[0], (int, float)) or \
+                after[1] not in ('item', 'restaurant') or \
+                not isinstance(after[2], int):
+            return abort(400)
+    results = search(app.db_session, query, limit + 1, after)
+    page = dict(next=None)
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        page['next'] = _encode_cursor([last['rank'], last['type'],
+                                       last['id']])
+    return jsonify(results=results, **page)
 
 
 @app.route('/api/favorites', methods=['GET'])
@@ -135,8 +527,12 @@ def get_favorites(user_id=None, limit=3):
     :arg optional limit: Maximum number of items to return.
     :returns: JSON with an 'items' key and a list of menu items.
     """
-    if 'limit' in request.args:
-        limit = int(request.args.get('limit'))
+    try:
+        limit = int(request.args.get('limit', limit))
+    except ValueError:
+        return abort(400)
+    if limit < 0:
+        return abort(400)
     if 'user_id' in request.args:
         try:
             user_id = int(request.args.get('user_id'))
@@ -144,15 +540,17 @@ def get_favorites(user_id=None, limit=3):
             return abort(400)
     else:
         user_id = login_session.get('user_id', None)
-    if user_id is not None:
-        recs = app.q_Rating().filter_by(user_id=user_id, rating=1)
-    else:
+    if user_id is None:
         return abort(400)
-    count = recs.count()
-    # Make a list of the serializable version of each rec.
-    recs_json = [each.item.sdict for each in recs]
-    # Return a random sampling of the items up to the limit.
-    return jsonify(items=sample(recs_json, min(limit, count)))
+    # Let the database pick a random sampling of the items up to the limit.
+    recs = (app.db_session.query(MenuItem, Restaurant.name)
+            .join(Restaurant, MenuItem.restaurant_id == Restaurant.id)
+            .join(MenuItemRating, MenuItemRating.item_id == MenuItem.id)
+            .filter(MenuItemRating.user_id == user_id,
+                    MenuItemRating.rating == 1)
+            .order_by(func.random())
+            .limit(min(limit, max_page_size)))
+    return jsonify(items=[_item_sdict(*each) for each in recs])
 
 
 @app.route('/ratings', methods=['POST'])
@@ -171,20 +569,79 @@ def save_rating():
     except KeyError:
         return jsonify(error='Missing data in request.'), 400
     try:
-        # Find existing rating record. Throws NoResultFound if none.
-        rec = app.q_Rating().filter_by(user_id=user_id,
-                                       item_id=item_id).one()
-        rec.rating = new_rating
-    except NoResultFound:
-        # Add new rating record to database.
-        new_rec = MenuItemRating(user_id=user_id,
-                                 item_id=item_id,
-                                 rating=new_rating)
-        app.db_session.add(new_rec)
-    app.db_session.commit()
+        # Add new rating record or change the existing one.
+        upsert_ratings(app.db_session, [dict(user_id=user_id,
+                                             item_id=item_id,
+                                             rating=new_rating)])
+        update_rating_counts(app.db_session, [item_id])
+        app.response_cache.invalidate(*_item_tags([item_id]))
+        app.db_session.commit()
+    except IntegrityError:
+        app.db_session.rollback()
+        return jsonify(error='Rating save failed'), 500
     return jsonify(status='ok')
 
 
+@app.route('/ratings/batch', methods=['POST'])
+@checks_login_and_csrf_status
+def save_ratings():
+    """Saves many menu item ratings to the database in one transaction.
+
+    Incoming request data must contain a 'ratings' list of objects with
+    'item_id' and 'rating' keys. Valid ratings are written with one SQL
+    statement. If an item is listed more than once the last rating is used.
+
+    :Returns: JSON with a 'results' list holding the status of each item.
+    """
+    user_id = login_session['user_id']
+    params = request.get_json() or {}
+    ratings = params.get('ratings')
+    if not isinstance(ratings, list):
+        return jsonify(error='Missing data in request.'), 400
+    if len(ratings) > max_batch_size:
+        return jsonify(error='Too many ratings in request.'), 400
+    # Validate all ratings before writing.
+    new_ratings = {}
+    errors = {}
+    for each in ratings:
+        try:
+            item_id, rating = each['item_id'], each['rating']
+        except (KeyError, TypeError):
+            return jsonify(error='Missing data in request.'), 400
+        if not isinstance(item_id, int):
+            return jsonify(error='Invalid item ID in request.'), 400
+        new_ratings.pop(item_id, None)
+        errors.pop(item_id, None)
+        if rating in (1, 2, 3):
+            new_ratings[item_id] = rating
+        else:
+            errors[item_id] = 'Invalid rating.'
+    found = app.db_session.query(MenuItem.id).filter(
+        MenuItem.id.in_(list(new_ratings.keys()))).all()
+    found = set(each.id for each in found)
+    for item_id in list(new_ratings.keys()):
+        if item_id not in found:
+            errors[item_id] = 'Item not found.'
+            del new_ratings[item_id]
+    if new_ratings:
+        try:
+            upsert_ratings(app.db_session, [
+                dict(user_id=user_id, item_id=item_id, rating=rating)
+                for item_id, rating in new_ratings.items()])
+            update_rating_counts(app.db_session, list(new_ratings.keys()))
+            app.response_cache.invalidate(
+                *_item_tags(list(new_ratings.keys())))
+            app.db_session.commit()
+        except IntegrityError:
+            app.db_session.rollback()
+            return jsonify(error='Rating save failed'), 500
+    results = [dict(item_id=item_id, status='ok')
+               for item_id in sorted(new_ratings)]
+    results.extend(dict(item_id=item_id, status='error', error=error)
+                   for item_id, error in sorted(errors.items()))
+    return jsonify(status='ok', results=results)
+
+
 @app.route('/items', methods=['POST'])
 @checks_login_and_csrf_status
 def save_item():
@@ -197,17 +654,18 @@ def save_item():
     user_id = login_session['user_id']
     obj = request.get_json()
     rating = int(obj.pop('rating', 0))
+    item = _strip_rating_counts(obj.pop('item'))
     try:
-        new_rec = MenuItem(created_by=user_id,
-                           **obj.pop('item'))
+        new_rec = MenuItem(created_by=user_id, **item)
         app.db_session.add(new_rec)
         app.db_session.flush()
         if rating:
-            new_rating = MenuItemRating(rating=rating,
-                                        item_id=new_rec.id,
-                                        user_id=user_id)
-            app.db_session.add(new_rating)
-            app.db_session.commit()
+            upsert_ratings(app.db_session, [dict(user_id=user_id,
+                                                 item_id=new_rec.id,
+                                                 rating=rating)])
+            update_rating_counts(app.db_session, [new_rec.id])
+        app.response_cache.invalidate(*_item_tags([new_rec.id]))
+        app.db_session.commit()
         return jsonify(id=new_rec.id)
     except IntegrityError as e:
         app.db_session.rollback()
@@ -223,10 +681,15 @@ def update_item():
     """
     user_id = login_session['user_id']
     obj = request.get_json()
-    item = obj.pop('item')
+    item = _strip_rating_counts(obj.pop('item'))
     item_id = item['id']
     rating = int(obj.pop('rating', 0))
+    # Menus holding the item before the update (in case it moves).
+    tags = _item_tags([item_id])
     # Try to update the item using it's ID.
+    if 'price' in item:
+        # Bulk updates skip the ORM, which sets the cents of new prices.
+        item['price_cents'] = parse_price(item['price'])
     try:
         app.q_MenuItem().filter_by(id=item_id).update(item)
         app.db_session.flush()
@@ -235,20 +698,12 @@ def update_item():
         return jsonify(error=e.orig.pgerror), 500
     # Create or update rating if rating > 0.
     if rating:
-        try:
-            # Try update.
-            rating_rec = app.q_Rating().filter_by(item_id=item_id,
-                                                  user_id=user_id).one()
-            rating_rec.rating = rating
-            app.db_session.flush()
-        except NoResultFound:
-            # Create new rating record.
-            new_rating = MenuItemRating(rating=rating,
-                                        item_id=item_id,
-                                        user_id=user_id)
-            app.db_session.add(new_rating)
-            app.db_session.flush()
+        upsert_ratings(app.db_session, [dict(user_id=user_id,
+                                             item_id=item_id,
+                                             rating=rating)])
+        update_rating_counts(app.db_session, [item_id])
     # Commit changes and return item ID for reference.
+    app.response_cache.invalidate(*(tags + _item_tags([item_id])))
     app.db_session.commit()
     return jsonify(id=item_id)
 
@@ -269,8 +724,11 @@ def save_restaurant():
                              **restaurant_data)
         app.db_session.add(new_rec)
         app.db_session.flush()
+        r_id = new_rec.id
+        tags = _restaurant_tags((r_id, new_rec.name))
+        app.response_cache.invalidate('restaurants', *tags)
         app.db_session.commit()
-        return jsonify(id=new_rec.id)
+        return jsonify(id=r_id)
     except IntegrityError:
         app.db_session.rollback()
         return jsonify(error='Restaurant save failed'), 500
@@ -286,7 +744,13 @@ def update_restaurant():
     obj = request.get_json()
     item = obj.pop('restaurant')
     if item.get('id', None):
+        # Menus looked up by the old name must also be cleared.
+        tags = _restaurant_tags(*app.db_session
+                                .query(Restaurant.id, Restaurant.name)
+                                .filter_by(id=item['id']))
         app.q_Restaurant().filter_by(id=item['id']).update(item)
+        tags.append(('menu_name', item.get('name')))
+        app.response_cache.invalidate('restaurants', *tags)
         app.db_session.commit()
         return jsonify(id=item['id'])
     else:
@@ -306,7 +770,10 @@ def delete_item():
         return abort(400)
     try:
         record = app.q_MenuItem().get(request.get_json()['id'])
+        tags = _restaurant_tags((record.restaurant.id,
+                                 record.restaurant.name))
         app.db_session.delete(record)
+        app.response_cache.invalidate(*tags)
         app.db_session.commit()
         return jsonify(status='ok')
     except IntegrityError:
@@ -327,7 +794,9 @@ def delete_restaurant():
         return abort(400)
     try:
         record = app.q_Restaurant().get(request.get_json()['id'])
+        tags = _restaurant_tags((record.id, record.name))
         app.db_session.delete(record)
+        app.response_cache.invalidate('restaurants', *tags)
         app.db_session.commit()
         return jsonify(status='ok')
     except IntegrityError:
@@ -335,6 +804,32 @@ def delete_restaurant():
         return abort(500)
 
 
+@app.route('/cache', methods=['GET'])
+@checks_login_and_csrf_status
+def show_cache_stats():
+    """Returns the size and hit/miss counters of the response cache."""
+    return jsonify(**app.response_cache.stats())
+
+
+@app.route('/debug/queries', methods=['GET'])
+@checks_login_and_csrf_status
+def show_query_stats():
+    """Returns SQL query counts and timings of recent requests by route.
+
+    Requests are only profiled while the 'SQL_PROFILING' config value is set.
+    """
+    return jsonify(enabled=bool(app.config['SQL_PROFILING']),
+                   routes=app.query_profiler.summary())
+
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    """Returns request, database pool and cache metrics for Prometheus."""
+    return app.response_class(
+        app.metrics.expose(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/environment', methods=['GET'])
 @checks_login_and_csrf_status
 def show_environment():
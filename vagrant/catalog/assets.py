@@ -0,0 +1,114 @@
+"""
+Links templates to the bundled, minified and fingerprinted static assets.
+
+The bundles listed in ``bundles.json`` are built by Grunt from the repo
+root, after changing a static file and before each deploy::
+
+    npm install
+    grunt assets
+
+Each bundle is written to the static folder as one minified file named with
+a hash of its content, e.g. ``js/app.3f9c2b1a7d.js``, and
+``static/manifest.json`` maps bundle names to those files. Gzip (and brotli)
+copies are then written by ``compress.py``.
+
+Templates get the hashed names from ``url_for('static', filename=...)`` or
+``asset_urls``. A hashed file never changes, so it is served with a one year
+``immutable`` Cache-Control and browsers do not ask for it again; a changed
+bundle gets a new name. Without a build, the bundles' source files are
+linked instead.
+"""
+import os
+import json
+from flask import request, url_for
+
+# Dict of bundle names to their source files in load order, relative to the
+# static folder. The Gruntfile builds the bundles from the same file and
+# writes each one next to its sources, so relative urls in CSS still work.
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'bundles.json')) as f:
+    bundles = json.load(f)
+
+# One year in seconds, the longest max-age browsers honor.
+one_year = 31536000
+
+
+class Assets(object):
+    """Links templates to the built bundles and caches them for a year.
+
+    ``url_for('static', filename=name)`` returns the hashed file of a built
+    bundle name. The ``asset_urls`` template function also works before a
+    build, see its docs.
+
+    Settings are read from the app config when ``init_app`` is called:
+
+    ===============  ========================================================
+    ASSETS_MANIFEST  Path of the manifest written by ``grunt assets``. Default
+                     "manifest.json" in the static folder.
+    ASSETS_MAX_AGE   Seconds browsers keep a hashed file.
+    ===============  ========================================================
+    """
+
+    defaults = {
+        'ASSETS_MANIFEST': None,
+        'ASSETS_MAX_AGE': one_year,
+    }
+
+    def __init__(self):
+        self.config = dict(self.defaults)
+        self.static_folder = None
+        self._manifest = None
+
+    def init_app(self, app):
+        """Registers the url default, template function and cache header."""
+        for key, value in self.defaults.items():
+            app.config.setdefault(key, value)
+        self.config = app.config
+        self.static_folder = app.static_folder
+        app.url_defaults(self._hashed_filename)
+        app.add_template_global(self.asset_urls, 'asset_urls')
+        app.after_request(self._cache_control)
+
+    @property
+    def manifest(self):
+        """Dict of bundle names to hashed names. Empty before a build."""
+        if self._manifest is None:
+            path = (self.config['ASSETS_MANIFEST'] or
+                    os.path.join(self.static_folder, 'manifest.json'))
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+            except (IOError, OSError):
+                manifest = {}
+            self._manifest = manifest
+        return self._manifest
+
+    def reload(self):
+        """Reads the manifest again on next use, e.g. after a new build."""
+        self._manifest = None
+
+    def asset_urls(self, name):
+        """Returns the urls to link in a template for a bundle or file.
+
+        A built bundle has one url, its hashed file. A bundle that is not
+        built yet has the urls of its source files, so pages also work in
+        development. Other names have their ``url_for('static')`` url.
+        """
+        if name not in self.manifest and name in bundles:
+            return [url_for('static', filename=source)
+                    for source in bundles[name]]
+        return [url_for('static', filename=name)]
+
+    def _hashed_filename(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def _cache_control(self, response):
+        if (request.endpoint == 'static' and response.status_code in
+                (200, 304) and request.view_args and
+                request.view_args.get('filename') in self.manifest.values()):
+            response.headers['Cache-Control'] = (
+                'public, max-age={}, immutable'.format(
+                    self.config['ASSETS_MAX_AGE']))
+        return response
+
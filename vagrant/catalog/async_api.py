@@ -0,0 +1,237 @@
+"""
+ASGI application serving the read-only JSON API with asyncio.
+
+Serves the same JSON as these routes of `api.py`:
+
+    /api/restaurants
+    /api/menu, /api/menu/restaurant=<name>, /api/menu/restaurant_id=<id>
+    /items
+
+Requests wait for the database without holding a thread, so one process can
+keep thousands of mostly idle client connections open. Queries run on
+SQLAlchemy's asyncio engine (asyncpg for postgresql, aiosqlite for sqlite)
+with the models of `database_setup.py`. Login state is read from the Flask
+session cookie, so the app needs the same ``SECRET_KEY`` as the Flask app
+(see ``load_config`` in `__init__.py`).
+
+Run it with an ASGI server next to the Flask app and route the GET requests
+of the paths above to it. From the ``vagrant`` directory, with `catalog`
+on the path for the Python 3 imports::
+
+    CATALOG_SETTINGS=/vagrant/catalog.cfg PYTHONPATH=catalog uvicorn \\
+        --factory catalog.async_api:create_asgi_app --port 8001
+
+Responses are not cached and 'stream' args are ignored; use the Flask app
+for those.
+"""
+import re
+import json
+from urllib.parse import parse_qsl
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, NotFound
+from werkzeug.http import parse_cookie
+from sqlalchemy import select, func, and_
+from sqlalchemy.orm import aliased
+from catalog import app as flask_app, load_config
+from catalog import api
+from database_setup import Restaurant, MenuItem, MenuItemRating
+from database_setup import get_async_engine
+try:
+    from sqlalchemy.ext.asyncio import AsyncSession
+except ImportError:  # Python 2 or SQLAlchemy < 1.4 have no asyncio support.
+    AsyncSession = None
+
+
+###############################################################################
+# Queries
+###############################################################################
+# Each function returns a select statement for the request and a function
+# converting its result rows to the same dict the Flask route returns.
+def restaurants_query(args):
+    """Builds the statement of "/api/restaurants"."""
+    stmt = select(Restaurant).order_by(*api._order_by(api.restaurant_keys))
+    stmt, limit = api._page_query(stmt, api.restaurant_keys, args)
+
+    def render(rows):
+        recs = [row[0] for row in rows]
+        page = {}
+        if limit is not None:
+            recs, page = api._page(recs, limit,
+                                   lambda rec: [rec.name, rec.id])
+        return dict(restaurants=[each.sdict for each in recs], **page)
+    return stmt, render
+
+
+def menu_query(args, name=None, r_id=None):
+    """Builds the statement of "/api/menu"."""
+    r_id = args.get('restaurant_id', r_id)
+    name = args.get('restaurant', name)
+    stmt = (select(MenuItem, Restaurant.name)
+            .join(Restaurant, MenuItem.restaurant_id == Restaurant.id))
+    if name:
+        stmt = stmt.where(Restaurant.name == name)
+    else:
+        stmt = stmt.where(MenuItem.restaurant_id == r_id)
+    stmt, keys = api._menu_filters(stmt, api.menu_keys, args)
+    stmt, limit = api._page_query(stmt, keys, args)
+    key_values = api._item_key_values(keys)
+
+    def render(rows):
+        page = {}
+        if limit is not None:
+            rows, page = api._page(rows, limit,
+                                   lambda row: key_values(row[0]))
+        return dict(menu=[api._item_sdict(item, restaurant_name)
+                          for item, restaurant_name in rows], **page)
+    return stmt, render
+
+
+def items_query(args, user_id=None):
+    """Builds the statement of "/items" (see ``api._rated_items_query``)."""
+    r_id = args['id']
+    user_rating = aliased(MenuItemRating)
+    stmt = (select(MenuItem,
+                   Restaurant.name,
+                   func.coalesce(user_rating.rating, 0))
+            .join(Restaurant, MenuItem.restaurant_id == Restaurant.id)
+            .outerjoin(user_rating, and_(user_rating.item_id == MenuItem.id,
+                                         user_rating.user_id == user_id))
+            .where(MenuItem.restaurant_id == r_id))
+    stmt, keys = api._menu_filters(stmt, api.popularity_keys, args)
+    stmt, limit = api._page_query(stmt, keys, args)
+    key_values = api._item_key_values(keys)
+
+    def render(rows):
+        page = {}
+        if limit is not None:
+            rows, page = api._page(rows, limit,
+                                   lambda row: key_values(row[0]))
+        return dict(items=[api._rated_item_sdict(each) for each in rows],
+                    **page)
+    return stmt, render
+
+
+# Paths as (pattern, query function, whether it uses the logged in user).
+routes = [
+    (re.compile(r'^/api/restaurants$'), restaurants_query, False),
+    (re.compile(r'^/api/menu$'), menu_query, False),
+    (re.compile(r'^/api/menu/restaurant=(?P<name>[^/]+)$'), menu_query,
+     False),
+    (re.compile(r'^/api/menu/restaurant_id=(?P<r_id>\d+)$'), menu_query,
+     False),
+    (re.compile(r'^/items$'), items_query, True),
+]
+
+
+###############################################################################
+# ASGI application
+###############################################################################
+class AsyncReadAPI(object):
+    """ASGI application answering the read routes listed in ``routes``.
+
+    The asyncio engine is created on the first request, in the server's
+    event loop, and disposed when the server shuts down.
+
+    :arg boolean test: Boolean to use test db instead of the production db.
+    """
+
+    def __init__(self, test=False):
+        self.test = test
+        self.engine = None
+
+    def sessions(self):
+        """Returns a new AsyncSession on the app's engine."""
+        if self.engine is None:
+            self.engine = get_async_engine(test=self.test)
+        return AsyncSession(self.engine, expire_on_commit=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                    self.engine = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _user_id(self, scope):
+        """Returns the user ID in the request's Flask session cookie."""
+        headers = dict(scope.get('headers') or [])
+        cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+        cookie = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return None
+        serializer = flask_app.session_interface.get_signing_serializer(
+            flask_app)
+        try:
+            data = serializer.loads(
+                cookie, max_age=int(
+                    flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:  # Also raised for expired cookies.
+            return None
+        return data.get('user_id')
+
+    async def _http(self, scope, send):
+        try:
+            data = await self.respond(scope)
+            status = 200
+            headers = [(b'content-type', b'application/json')]
+            body = (json.dumps(data, sort_keys=True, separators=(',', ':')) +
+                    '\n').encode('utf-8')
+        except HTTPException as e:
+            response = e.get_response()
+            status = response.status_code
+            headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                       for k, v in response.headers.items()
+                       if k.lower() != 'content-length']
+            body = response.get_data()
+        headers.append((b'content-length', str(len(body)).encode('ascii')))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': b'' if scope['method'] == 'HEAD' else body})
+
+    async def respond(self, scope):
+        """Returns the JSON data for a request's scope.
+
+        :raises HTTPException: For unknown paths, methods and invalid args.
+        """
+        for pattern, query, per_user in routes:
+            match = pattern.match(scope['path'])
+            if match is not None:
+                break
+        else:
+            raise NotFound()
+        if scope['method'] not in ('GET', 'HEAD'):
+            raise MethodNotAllowed(['GET', 'HEAD'])
+        args = MultiDict(parse_qsl(
+            scope.get('query_string', b'').decode('latin-1'),
+            keep_blank_values=True))
+        params = match.groupdict()
+        if per_user:
+            params['user_id'] = self._user_id(scope)
+        stmt, render = query(args, **params)
+        async with self.sessions() as session:
+            rows = (await session.execute(stmt)).all()
+        return render(rows)
+
+
+def create_asgi_app(config=None, test=False):
+    """Reads the app settings and returns the ASGI application.
+
+    :arg dict config: Settings to use over those of the settings file.
+    :arg boolean test: Boolean to use test db instead of the production db.
+    """
+    load_config(config)
+    return AsyncReadAPI(test=test)
+
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Loads users, restaurants, menu items and ratings from CSV or JSON files.
+
+Run this file with a directory holding any of the files below. CSV files
+need a header row and JSON files a list of objects with the same keys.
+Foreign keys use natural keys (a user's email, a restaurant's name and an
+item's restaurant and name) and are resolved in memory.
+
+===================================  =========================================
+File                                 Columns
+===================================  =========================================
+users.csv / users.json               name, email, picture
+restaurants.csv / restaurants.json   name, phone, note, created_by (email)
+menu_items.csv / menu_items.json     restaurant, name, description, price,
+                                     course, created_by (email)
+ratings.csv / ratings.json           user (email), restaurant, item, rating
+===================================  =========================================
+
+Rows are written in batches with one bulk insert each, or with ``COPY`` on
+PostgreSQL. Rows whose key is already in the database are skipped, so a
+directory can be loaded again safely.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from io import StringIO
+from sqlalchemy import select, func, text
+from sqlalchemy.orm import sessionmaker
+from database_setup import User, Restaurant, MenuItem, MenuItemRating
+from database_setup import get_engine, update_rating_counts, parse_price
+
+# Number of rows written by one INSERT or COPY statement.
+batch_size = 1000
+
+# Input file names (without extension) in the order they are loaded.
+file_names = ['users', 'restaurants', 'menu_items', 'ratings']
+
+
+###############################################################################
+# Reading input files
+###############################################################################
+def _text(value):
+    """Returns a value read from a file as unicode text."""
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return u'{}'.format(value)
+
+
+def read_rows(path):
+    """Yields the rows of a CSV or JSON file as dicts.
+
+    :arg string path: Path to a ".csv" file with a header row or a ".json"
+        file with a list of objects.
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            for row in json.load(f):
+                yield row
+    else:
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def _batches(rows, size):
+    """Yields lists of up to ``size`` items from an iterable."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+###############################################################################
+# Writing rows
+###############################################################################
+def _copy_value(value):
+    """Returns a value in the text format of PostgreSQL's ``COPY``."""
+    if value is None:
+        return u'\\N'
+    return (_text(value).replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+            .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
+def _copy(conn, table, records):
+    """Writes records to a table with PostgreSQL's ``COPY ... FROM STDIN``.
+
+    :arg conn: A SQLAlchemy Connection to a PostgreSQL database.
+    :arg table: SQLAlchemy Table to write to.
+    :arg list records: Dicts of column values, all with the same keys.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    columns = list(records[0])
+    buf = StringIO()
+    for rec in records:
+        buf.write(u'\t'.join(_copy_value(rec[c]) for c in columns) + u'\n')
+    buf.seek(0)
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        quote(table.name), ', '.join(quote(c) for c in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+def _reserve_ids(conn, table, count):
+    """Returns a list of unused primary keys for new rows of a table.
+
+    Keys come from the table's sequence on PostgreSQL. On SQLite they
+    follow the largest key in the table, so only one loader may write to a
+    SQLite database at a time.
+    """
+    if conn.dialect.name == 'postgresql':
+        name = conn.dialect.identifier_preparer.quote(table.name)
+        rows = conn.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:name, 'id')) "
+                 "FROM generate_series(1, :count)"),
+            dict(name=name, count=count))
+        return [row[0] for row in rows]
+    start = conn.execute(select([func.max(table.c.id)])).scalar() or 0
+    return list(range(start + 1, start + 1 + count))
+
+
+###############################################################################
+# Loader
+###############################################################################
+class BulkLoader(object):
+    """Loads rows into the database in batches.
+
+    Keys of rows already in the database are read once when the loader is
+    created. The keys and IDs of loaded rows are kept in memory for
+    resolving the foreign keys of later files.
+
+    :arg engine: SQLAlchemy Engine of the database to load.
+    :arg int batch_size: Number of rows written by one statement.
+    :arg boolean use_copy: Write with ``COPY`` instead of INSERT. Defaults to
+        *True* for PostgreSQL databases.
+    :arg out: File the loading speed of each file is reported to, or *None*.
+    """
+
+    def __init__(self, engine, batch_size=batch_size, use_copy=None,
+                 out=sys.stdout):
+        self.engine = engine
+        self.batch_size = batch_size
+        if use_copy is None:
+            use_copy = engine.dialect.name == 'postgresql'
+        self.use_copy = use_copy
+        self.out = out
+        self.stats = []
+        self.users = {}  # email -> id
+        self.restaurants = {}  # name -> id
+        self.items = {}  # (restaurant_id, name) -> id
+        self.ratings = set()  # (user_id, item_id)
+        self._read_keys()
+        # Keys in the database before loading. Rows with these are skipped.
+        self._existing = dict(users=set(self.users),
+                              restaurants=set(self.restaurants),
+                              menu_items=set(self.items))
+
+    def _read_keys(self):
+        """Reads the keys and IDs of rows already in the database."""
+        with self.engine.connect() as conn:
+            users = User.__table__.c
+            for email, id in conn.execute(
+                    select([users.email, users.id]).order_by(users.id)):
+                if email:
+                    self.users.setdefault(email, id)
+            rests = Restaurant.__table__.c
+            for name, id in conn.execute(
+                    select([rests.name, rests.id]).order_by(rests.id)):
+                self.restaurants.setdefault(name, id)
+            items = MenuItem.__table__.c
+            for r_id, name, id in conn.execute(
+                    select([items.restaurant_id, items.name, items.id])
+                    .order_by(items.id)):
+                self.items.setdefault((r_id, name), id)
+            ratings = MenuItemRating.__table__.c
+            self.ratings.update(tuple(row) for row in conn.execute(
+                select([ratings.user_id, ratings.item_id])))
+
+    def _lookup(self, keys, key, what, line):
+        """Returns the ID for a foreign key or raises a ValueError."""
+        try:
+            return keys[key]
+        except KeyError:
+            raise ValueError('{}: unknown {} {!r}'.format(line, what, key))
+
+    def _user(self, row, line):
+        email = _text(row.get('email'))
+        if email and email in self._existing['users']:
+            return None, None
+        return email or None, dict(name=_text(row['name']),
+                                   email=email,
+                                   picture=_text(row.get('picture')))
+
+    def _restaurant(self, row, line):
+        name = _text(row['name'])
+        if name in self._existing['restaurants']:
+            return None, None
+        created_by = self._lookup(self.users, _text(row['created_by']),
+                                  'user', line)
+        return name, dict(name=name,
+                          phone=_text(row.get('phone')),
+                          note=_text(row.get('note')),
+                          created_by=created_by)
+
+    def _menu_item(self, row, line):
+        r_id = self._lookup(self.restaurants, _text(row['restaurant']),
+                            'restaurant', line)
+        name = _text(row['name'])
+        if (r_id, name) in self._existing['menu_items']:
+            return None, None
+        created_by = self._lookup(self.users, _text(row['created_by']),
+                                  'user', line)
+        price = _text(row.get('price'))
+        return (r_id, name), dict(name=name,
+                                  description=_text(row.get('description')),
+                                  price=price,
+                                  price_cents=parse_price(price),
+                                  course=_text(row.get('course')),
+                                  restaurant_id=r_id,
+                                  created_by=created_by)
+
+    def _rating(self, row, line):
+        user_id = self._lookup(self.users, _text(row['user']), 'user', line)
+        r_id = self._lookup(self.restaurants, _text(row['restaurant']),
+                            'restaurant', line)
+        item_id = self._lookup(self.items, (r_id, _text(row['item'])),
+                               'menu item', line)
+        rating = int(row['rating'])
+        if rating not in (1, 2, 3):
+            raise ValueError('{}: rating must be 1, 2 or 3'.format(line))
+        key = (user_id, item_id)
+        if key in self.ratings:
+            return None, None
+        # Ratings are not referenced by other files, so they get no ID.
+        self.ratings.add(key)
+        return None, dict(user_id=user_id, item_id=item_id, rating=rating)
+
+    def load(self, name, rows):
+        """Loads the rows of one input file.
+
+        Rows are converted and written ``batch_size`` at a time. Rows whose
+        key was in the database before loading are skipped. Within one load,
+        later rows with the same key are still added but references resolve
+        to the first row, except for ratings, where the first row wins.
+
+        :arg string name: One of the names in ``file_names``.
+        :arg rows: Iterable of dicts, e.g. from ``read_rows``.
+        :returns: Dict with the number of rows loaded and skipped, the
+            seconds taken and the rows per second.
+        """
+        table, convert, keys = {
+            'users': (User.__table__, self._user, self.users),
+            'restaurants': (Restaurant.__table__, self._restaurant,
+                            self.restaurants),
+            'menu_items': (MenuItem.__table__, self._menu_item, self.items),
+            'ratings': (MenuItemRating.__table__, self._rating, None),
+        }[name]
+        start = time.time()
+        loaded = skipped = 0
+        lines = enumerate(rows, 1)
+        for batch in _batches(lines, self.batch_size):
+            converted = []
+            for line, row in batch:
+                key, record = convert(row, '{} row {}'.format(name, line))
+                if record is None:
+                    skipped += 1
+                else:
+                    converted.append((key, record))
+            if not converted:
+                continue
+            with self.engine.begin() as conn:
+                if keys is not None:
+                    ids = _reserve_ids(conn, table, len(converted))
+                    for (key, record), id in zip(converted, ids):
+                        record['id'] = id
+                        if key is not None:
+                            keys.setdefault(key, id)
+                records = [record for key, record in converted]
+                if self.use_copy:
+                    _copy(conn, table, records)
+                else:
+                    conn.execute(table.insert(), records)
+            loaded += len(converted)
+        seconds = time.time() - start
+        stats = dict(name=name, loaded=loaded, skipped=skipped,
+                     seconds=seconds,
+                     rows_per_second=loaded / seconds if seconds else 0)
+        self.stats.append(stats)
+        if self.out is not None:
+            self.out.write(
+                '{name}: {loaded} rows loaded, {skipped} skipped in '
+                '{seconds:.2f}s ({rows_per_second:.0f} rows/sec)\n'
+                .format(**stats))
+        return stats
+
+    def load_directory(self, path):
+        """Loads each input file found in a directory and recounts ratings.
+
+        :arg string path: Directory holding files named in ``file_names``
+            with a ".csv" or ".json" extension.
+        :returns: List of the stats returned by ``load`` for each file.
+        """
+        stats = []
+        for name in file_names:
+            for ext in ('.csv', '.json'):
+                file_path = os.path.join(path, name + ext)
+                if os.path.exists(file_path):
+                    stats.append(self.load(name, read_rows(file_path)))
+                    break
+        self.recount()
+        return stats
+
+    def recount(self):
+        """Updates the rating totals of menu items if ratings were loaded."""
+        if any(each['name'] == 'ratings' and each['loaded']
+               for each in self.stats):
+            session = sessionmaker(bind=self.engine)()
+            update_rating_counts(session)
+            session.commit()
+            session.close()
+
+
+def load_directory(path, batch_size=batch_size, use_copy=None, echo=False,
+                   test=False, out=sys.stdout):
+    """Loads the input files in a directory into the database.
+
+    :arg string path: Directory holding the input files.
+    :arg int batch_size: Number of rows written by one statement.
+    :arg boolean use_copy: Write with ``COPY``. Defaults to *True* for
+        PostgreSQL databases.
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+    :arg out: File the loading speed is reported to, or *None*.
+    :returns: List of the stats for each file loaded.
+    """
+    loader = BulkLoader(get_engine(echo=echo, test=test),
+                        batch_size=batch_size, use_copy=use_copy, out=out)
+    start = time.time()
+    stats = loader.load_directory(path)
+    if out is not None:
+        seconds = time.time() - start
+        total = sum(each['loaded'] for each in stats)
+        out.write('total: {} rows in {:.2f}s ({:.0f} rows/sec)\n'.format(
+            total, seconds, total / seconds if seconds else 0))
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load CSV or JSON files into the database.')
+    parser.add_argument('directory', help='directory with the input files')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+                        help='rows written per statement')
+    parser.add_argument('--no-copy', action='store_true',
+                        help='use INSERT instead of COPY on PostgreSQL')
+    parser.add_argument('--test', action='store_true',
+                        help='load the test database')
+    args = parser.parse_args()
+    load_directory(args.directory, batch_size=args.batch_size,
+                   use_copy=False if args.no_copy else None, test=args.test)
@@ -0,0 +1,302 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app, session, has_request_context
+from database_setup import load_cache_versions, bump_cache_versions
+
+
+class LocalVersions(object):
+    """Version numbers of cache tags kept in the current process.
+
+    Only usable with a single server process, because other processes never
+    see the changes. See ``DatabaseVersions``.
+    """
+
+    def __init__(self):
+        self._versions = {}  # tag -> number of invalidations
+        self._lock = threading.Lock()
+
+    def load(self, tags):
+        """Returns the list of versions of the tags."""
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        """Increments the versions of the tags."""
+        with self._lock:
+            for tag in set(tags):
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+
+class DatabaseVersions(object):
+    """Version numbers of cache tags kept in the ``cache_version`` table.
+
+    All server processes share the table, so a write handled by one process
+    changes the ETags and drops the cached responses of every process.
+    ``bump`` writes in the session's current transaction, so call it before
+    committing the write it describes. Versions are read once per request.
+
+    :arg get_session: Function returning the session to use.
+    """
+
+    def __init__(self, get_session):
+        self.get_session = get_session
+
+    def load(self, tags):
+        """Returns the list of versions of the tags."""
+        keys = [_tag_key(tag) for tag in tags]
+        if has_request_context():
+            known = request.environ.setdefault('catalog.cache_versions', {})
+        else:
+            known = {}
+        missing = [key for key in keys if key not in known]
+        if missing:
+            known.update(dict.fromkeys(missing, 0))
+            known.update(load_cache_versions(self.get_session(), missing))
+        return [known[key] for key in keys]
+
+    def bump(self, tags):
+        """Increments the versions of the tags in the current transaction."""
+        bump_cache_versions(self.get_session(),
+                            [_tag_key(tag) for tag in tags])
+        if has_request_context():
+            request.environ.pop('catalog.cache_versions', None)
+
+
+def _tag_key(tag):
+    """Returns a tag such as ``('menu_id', 3)`` as a string: "menu_id:3"."""
+    if isinstance(tag, tuple):
+        return u':'.join(u'{}'.format(part) for part in tag)
+    return u'{}'.format(tag)
+
+
+class ResponseCache(object):
+    """Bounded in-process cache of response bodies.
+
+    Entries are dropped when they are older than ``ttl`` seconds or, once
+    ``max_entries`` is reached, in least recently used order. Each entry has
+    a list of tags (e.g. ``('menu_id', 3)``) and ``invalidate`` drops every
+    entry with a given tag.
+
+    Every tag also has a version number that ``invalidate`` increments.
+    ``version`` combines the versions of tags into a string for ETags. An
+    entry is only returned while its tags have the versions read before its
+    value was computed.
+
+    The versions are kept by ``versions``, an object like ``LocalVersions``
+    or ``DatabaseVersions`` with ``load(tags)`` and ``bump(tags)`` methods.
+    With ``DatabaseVersions``, the entries of every server process are
+    checked against the shared versions, so no process serves a response
+    older than the last write.
+
+    :arg int max_entries: Largest number of entries kept.
+    :arg float ttl: Seconds an entry is kept.
+    :arg versions: Version store. Default is a new ``LocalVersions``.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300, versions=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.versions = versions if versions is not None else LocalVersions()
+        # key -> (expires, value, tags, versions)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # Incremented by every invalidation.
+        self._epoch = uuid.uuid4().hex[:8]  # Changed by every clear.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self):
+        """Number of invalidations so far. Pass it to ``set``."""
+        return self._generation
+
+    def get(self, key):
+        """Returns the value stored for a key or *None* if missing."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+        if self.versions.load(entry[2]) != entry[3]:
+            # Changed by a write, possibly in another process.
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                    self.invalidations += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            # Mark entry as most recently used.
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+                self._entries[key] = entry
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, tags=(), generation=None, versions=None):
+        """Stores a value for a key.
+
+        The value is not stored if ``generation`` is given and an
+        invalidation happened since it was read, because the value may have
+        been computed from data changed by a write.
+
+        :arg key: Hashable cache key.
+        :arg value: Value to store.
+        :arg tags: List of hashable tags used by ``invalidate``.
+        :arg int generation: The ``generation`` read before computing value.
+        :arg list versions: The ``versions.load(tags)`` read before
+            computing value. Read now if *None*.
+        """
+        tags = tuple(tags)
+        if versions is None:
+            versions = self.versions.load(tags)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value, tags,
+                                  list(versions))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """Drops all entries that have any of the given tags.
+
+        Also increments the versions of the tags. With ``DatabaseVersions``
+        call it before committing the write, in the same transaction.
+        """
+        self.versions.bump(tags)
+        tags = set(tags)
+        with self._lock:
+            self._generation += 1
+            for key, entry in list(self._entries.items()):
+                if tags.intersection(entry[2]):
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def version(self, *tags):
+        """Returns a string that changes whenever any of the tags changes.
+
+        The string also changes when the cache is cleared and every ``ttl``
+        seconds.
+        """
+        period = int(time.time() // self.ttl) if self.ttl > 0 else 0
+        versions = [str(each) for each in self.versions.load(tags)]
+        return '{}-{}-{}'.format(self._epoch, period, '.'.join(versions))
+
+    def clear(self):
+        """Drops all entries."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._epoch = uuid.uuid4().hex[:8]
+
+    def stats(self):
+        """Returns a dict of the cache's size and hit/miss counters."""
+        with self._lock:
+            return dict(size=len(self._entries),
+                        max_entries=self.max_entries,
+                        ttl=self.ttl,
+                        hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        expirations=self.expirations,
+                        invalidations=self.invalidations)
+
+
+def cached_response(cache, tags, bypass=None):
+    """Decorator for caching the JSON responses of a Flask view function.
+
+    Responses are keyed by the request path and args. Only successful
+    responses that are not streamed are stored.
+
+    Each entry also keeps the compressed copies of its body. They are
+    handed to ``Compressor`` as the response's ``encoded_bodies`` dict of
+    content encodings to bodies, so a cached body is compressed once per
+    encoding rather than on every hit.
+
+    :arg cache: A ResponseCache instance.
+    :arg tags: Function called with the view's arguments and returning the
+        list of tags for the response.
+    :arg bypass: Optional function returning *True* for requests that should
+        not use the cache.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if bypass is not None and bypass():
+                return func(*args, **kwargs)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = cache.get(key)
+            if entry is not None:
+                body, encoded = entry
+                resp = current_app.response_class(
+                    body, mimetype='application/json')
+                resp.encoded_bodies = encoded
+                return resp
+            generation = cache.generation
+            tag_list = tags(*args, **kwargs)
+            versions = cache.versions.load(tag_list)
+            resp = func(*args, **kwargs)
+            if isinstance(resp, current_app.response_class) and \
+                    resp.status_code == 200 and not resp.is_streamed:
+                resp.encoded_bodies = {}
+                cache.set(key, (resp.get_data(), resp.encoded_bodies),
+                          tag_list, generation=generation, versions=versions)
+            return resp
+        return wrapper
+    return decorator
+
+
+def etag_response(cache, tags, per_user=False, bypass=None):
+    """Decorator for adding ETags to the responses of a Flask view function.
+
+    The ETag is built from the cache versions of the response's tags, so it
+    is known before the view runs. Requests with a matching If-None-Match
+    header get an empty 304 response without calling the view.
+
+    :arg cache: A ResponseCache instance.
+    :arg tags: Function called with the view's arguments and returning the
+        list of tags for the response.
+    :arg boolean per_user: Add the logged in user's ID to the ETag for
+        responses that differ between users.
+    :arg bypass: Optional function returning *True* for requests that should
+        not get an ETag.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if bypass is not None and bypass():
+                return func(*args, **kwargs)
+            etag = cache.version(*tags(*args, **kwargs))
+            if per_user:
+                etag += '-{}'.format(session.get('user_id', ''))
+            # Weak comparison, as compressed responses have weak ETags.
+            if request.if_none_match.contains_weak(etag):
+                resp = current_app.response_class(status=304)
+            else:
+                resp = func(*args, **kwargs)
+                if not isinstance(resp, current_app.response_class) or \
+                        resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            # Clients may store responses but must always revalidate.
+            if per_user:
+                resp.headers['Cache-Control'] = 'private, no-cache'
+                resp.vary.add('Cookie')
+            else:
+                resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+    return decorator
@@ -0,0 +1,207 @@
+"""
+Response compression and precompressed static files.
+
+Run this file to write a gzip (and brotli, if the ``brotli`` package is
+installed) copy next to every compressible file in the static folder::
+
+    python compress.py             # Compress "static/".
+    python compress.py path/to/dir --level 9
+
+The app then serves those copies to browsers accepting the encoding, so
+static files cost nothing to compress per request. Run it again after
+changing a static file; outdated copies are not served.
+"""
+import os
+import sys
+import gzip
+import argparse
+import mimetypes
+from io import BytesIO
+from flask import request, send_from_directory
+try:
+    import brotli
+except ImportError:  # Brotli is optional.
+    brotli = None
+
+# Suffixes of precompressed files by content encoding, in order of
+# preference when the browser accepts several equally.
+suffixes = [('br', '.br'), ('gzip', '.gz')]
+
+# Static files already compressed by their format.
+skipped_extensions = ('.gz', '.br', '.png', '.jpg', '.jpeg', '.gif', '.ico',
+                      '.woff', '.woff2', '.zip')
+
+
+def _gzip(data, level):
+    """Returns data compressed in the gzip format."""
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _brotli(data, level):
+    """Returns data compressed in the brotli format."""
+    # Brotli's quality goes to 11 where gzip's level goes to 9.
+    return brotli.compress(data, quality=min(11, level + 2))
+
+
+class Compressor(object):
+    """Compresses responses for browsers that accept gzip or brotli.
+
+    Dynamic responses of the listed mimetypes are compressed once they are
+    at least ``COMPRESS_MIN_SIZE`` bytes; smaller ones gain too little to
+    pay for the compression. Streamed responses and files are sent as they
+    are. Static files are served from precompressed copies instead, see
+    ``precompress``.
+
+    A response with an ``encoded_bodies`` dict, set by
+    ``cache.cached_response``, is compressed once per encoding and the
+    result is kept in the dict.
+
+    Settings are read from the app config when ``init_app`` is called:
+
+    ===================  =====================================================
+    COMPRESS_MIN_SIZE    Smallest response body in bytes that is compressed.
+    COMPRESS_LEVEL       gzip compression level from 1 (fast) to 9 (small).
+    COMPRESS_MIMETYPES   Mimetypes of compressed responses.
+    COMPRESS_BROTLI      Use brotli when the browser prefers or accepts it.
+                         Default *True* if the ``brotli`` package is there.
+    ===================  =====================================================
+    """
+
+    defaults = {
+        'COMPRESS_MIN_SIZE': 500,
+        'COMPRESS_LEVEL': 6,
+        'COMPRESS_MIMETYPES': ['application/json', 'text/html', 'text/css',
+                               'text/plain', 'application/javascript',
+                               'text/javascript'],
+        'COMPRESS_BROTLI': brotli is not None,
+    }
+
+    def __init__(self):
+        self.config = dict(self.defaults)
+        self.static_folder = None
+
+    def init_app(self, app):
+        """Registers the response hook and the precompressed static view."""
+        for key, value in self.defaults.items():
+            app.config.setdefault(key, value)
+        self.config = app.config
+        self.static_folder = app.static_folder
+        app.after_request(self._compress)
+        if 'static' in app.view_functions:
+            app.view_functions['static'] = self.send_static_file
+
+    def encodings(self):
+        """Returns the content encodings usable for the current request.
+
+        Encodings come in the browser's order of preference.
+        """
+        accepted = request.accept_encodings
+        usable = [each for each, _ in suffixes
+                  if accepted.quality(each) > 0 and
+                  (each != 'br' or self.config['COMPRESS_BROTLI'])]
+        return sorted(usable, key=lambda each: -accepted.quality(each))
+
+    def _compress(self, response):
+        response.vary.add('Accept-Encoding')
+        if (response.direct_passthrough or response.is_streamed or
+                response.status_code < 200 or
+                response.status_code in (204, 206, 304) or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in self.config['COMPRESS_MIMETYPES']):
+            return response
+        data = response.get_data()
+        if len(data) < self.config['COMPRESS_MIN_SIZE']:
+            return response
+        encodings = self.encodings()
+        if not encodings:
+            return response
+        encoding = encodings[0]
+        # Compressed bodies kept by the response cache for its entry.
+        encoded = getattr(response, 'encoded_bodies', None)
+        if encoded is not None and encoding in encoded:
+            data = encoded[encoding]
+        else:
+            level = self.config['COMPRESS_LEVEL']
+            if encoding == 'br':
+                data = _brotli(data, level)
+            else:
+                data = _gzip(data, level)
+            if encoded is not None:
+                encoded[encoding] = data
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            # The compressed body differs, but means the same.
+            response.set_etag(etag, weak=True)
+        return response
+
+    def send_static_file(self, filename):
+        """Flask's static view, using a precompressed copy when possible.
+
+        A copy is only used if it is newer than the file.
+        """
+        path = os.path.join(self.static_folder, filename)
+        for encoding in self.encodings():
+            suffix = dict(suffixes)[encoding]
+            try:
+                fresh = (os.path.getmtime(path + suffix) >=
+                         os.path.getmtime(path))
+            except OSError:
+                continue
+            if fresh:
+                response = send_from_directory(
+                    self.static_folder, filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                return response
+        return send_from_directory(self.static_folder, filename)
+
+
+def precompress(directory, level=9, out=sys.stdout):
+    """Writes gzip and brotli copies of the compressible files in a folder.
+
+    Copies are only written when they are smaller than the file.
+
+    :arg string directory: Folder searched with all its sub-folders.
+    :arg int level: gzip compression level. Brotli uses its highest.
+    :returns: Number of copies written.
+    """
+    written = 0
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(skipped_extensions):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            copies = [('.gz', _gzip(data, level))]
+            if brotli is not None:
+                copies.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in copies:
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                written += 1
+                if out is not None:
+                    out.write('{} {} -> {} bytes\n'.format(
+                        path + suffix, len(data), len(compressed)))
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write compressed copies of the static files.')
+    parser.add_argument('directory', nargs='?',
+                        default=os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'static'))
+    parser.add_argument('--level', type=int, default=9,
+                        help='gzip level (default: %(default)s)')
+    args = parser.parse_args()
+    count = precompress(args.directory, args.level)
+    print('Wrote {} compressed files.'.format(count))
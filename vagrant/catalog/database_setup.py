@@ -1,14 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import re
+import sys
 import json
+import time
 from sqlalchemy import Column as Col, ForeignKey
-from sqlalchemy import UniqueConstraint, CheckConstraint
+from sqlalchemy import UniqueConstraint, CheckConstraint, Index
 from sqlalchemy import Integer, Unicode as Uni
 from sqlalchemy import CheckConstraint as Check
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.orm import validates
+from sqlalchemy import create_engine, select, func, inspect, event
+from sqlalchemy import text, literal, literal_column, union_all
+from sqlalchemy import bindparam, cast, tuple_, and_, or_
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.dialects import postgresql, sqlite
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:  # Python 2 or SQLAlchemy < 1.4 have no asyncio support.
+    create_async_engine = None
+
+timer = getattr(time, 'perf_counter', time.time)
 
 Base = declarative_base()
 
@@ -44,6 +59,7 @@ class Restaurant(Base):
     phone = Col(Uni(50), default=u'')
     note = Col(Uni(250), default=u'')
     created_by = Col(Integer, ForeignKey('user.id'), nullable=False)
+    __table_args__ = (Index('ix_restaurant_name', 'name'),)
 
     menu_items = relationship('MenuItem', cascade='delete')
 
@@ -79,7 +95,10 @@ class MenuItemRating(Base):
     user_id = Col(Integer, ForeignKey('user.id'), nullable=False)
     item_id = Col(Integer, ForeignKey('menu_item.id'), nullable=False)
     rating = Col(Integer, Check('rating<4'), nullable=False)
-    __table_args__ = (UniqueConstraint('user_id', 'item_id'),)
+    __table_args__ = (UniqueConstraint('user_id', 'item_id'),
+                      Index('ix_menu_item_rating_item_id', 'item_id'),
+                      Index('ix_menu_item_rating_user_id_rating',
+                            'user_id', 'rating'))
 
     item = relationship('MenuItem')
 
@@ -93,17 +112,26 @@ class MenuItem(Base):
     """Menu item table in the database.
 
     Columns:
-        ============= ======= ==============
-        name          type    description
-        ============= ======= ==============
-        id            integer Primary key
-        name          unicode Name of item
-        description   unicode Description of food item
-        price         unicode Price of food item
-        course        unicode Type of food like main dish or dessert
-        restaurant_id integer Foreign key for a restaurant record
-        created_by    integer Foreign key for a user record
-        ============= ======= ==============
+        ============== ======= =============================
+        name           type    description
+        ============== ======= =============================
+        id             integer Primary key
+        name           unicode Name of item
+        description    unicode Description of food item
+        price          unicode Price of food item
+        price_cents    integer Price in cents, *None* if not a number
+        course         unicode Type of food like main dish or dessert
+        restaurant_id  integer Foreign key for a restaurant record
+        created_by     integer Foreign key for a user record
+        favorite_count integer Number of 'favorite' ratings
+        good_count     integer Number of 'good' ratings
+        bad_count      integer Number of 'bad' ratings
+        ============== ======= =============================
+
+    The rating counts are stored totals of the ``ratings`` relationship.
+    Refresh them with ``update_rating_counts`` after writing ratings.
+    ``price_cents`` is set from ``price`` whenever the price is assigned;
+    code writing prices without the ORM must set both.
 
     Relationships:
         ========== =============== ==========
@@ -119,28 +147,42 @@ class MenuItem(Base):
     name = Col(Uni(80), nullable=False)
     description = Col(Uni(500), default=u'')
     price = Col(Uni(8), default=u'')
+    price_cents = Col(Integer)
     course = Col(Uni(250), default=u'')
     restaurant_id = Col(Integer, ForeignKey('restaurant.id'), nullable=False)
     created_by = Col(Integer, ForeignKey('user.id'), nullable=False)
+    favorite_count = Col(Integer, default=0, server_default='0',
+                         nullable=False)
+    good_count = Col(Integer, default=0, server_default='0', nullable=False)
+    bad_count = Col(Integer, default=0, server_default='0', nullable=False)
+    # Both indexes lead with restaurant_id, so they also serve lookups of a
+    # restaurant's items.
+    __table_args__ = (Index('ix_menu_item_popularity',
+                            restaurant_id,
+                            favorite_count.desc(),
+                            good_count.desc(),
+                            bad_count,
+                            id),
+                      Index('ix_menu_item_price',
+                            restaurant_id, course, price_cents))
 
     restaurant = relationship('Restaurant')
     ratings = relationship('MenuItemRating', cascade='delete')
 
+    @validates('price')
+    def _set_price_cents(self, key, price):
+        self.price_cents = parse_price(price)
+        return price
+
     @property
     def sdict(self):
         """Return object data in serializeable format.
 
-        Also includes the restaurant name and totals for each rating:
+        Also includes the restaurant name:
             * restaurant_name - string
-            * favorite_count - integer
-            * good_count - integer
-            * bad_count - integer
         """
         sd = {c.name: getattr(self, c.name) for c in self.__table__.columns}
         sd['restaurant_name'] = self.restaurant.name
-        sd['favorite_count'] = len([x for x in self.ratings if x.rating == 1])
-        sd['good_count'] = len([x for x in self.ratings if x.rating == 2])
-        sd['bad_count'] = len([x for x in self.ratings if x.rating == 3])
         return sd
 
 
@@ -170,6 +212,7 @@ class User(Base):
     name = Col(Uni(250), nullable=False)
     email = Col(Uni(250), default=u'')
     picture = Col(Uni(250), default=u'')
+    __table_args__ = (Index('ix_user_name_email', 'name', 'email'),)
 
     menu_item_ratings = relationship('MenuItemRating', cascade='delete')
 
@@ -179,6 +222,27 @@ class User(Base):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class CacheVersion(Base):
+    """Version numbers of the response cache tags.
+
+    Columns:
+        ======= ======= =====
+        name    type    description
+        ======= ======= =====
+        tag     unicode Primary key, a tag such as "menu_id:3"
+        version integer Number of writes to the tagged data
+        ======= ======= =====
+
+    Every server process reads the versions from this table, so a write in
+    one process changes the ETags and cached responses of all of them. See
+    ``DatabaseVersions`` in `cache.py`.
+    """
+    __tablename__ = 'cache_version'
+
+    tag = Col(Uni(300), primary_key=True)
+    version = Col(Integer, default=0, server_default='0', nullable=False)
+
+
 ###############################################################################
 # Functions
 ###############################################################################
@@ -187,32 +251,658 @@ sqlite_dbapi = 'sqlite:///'
 postgres_dbapi = 'postgresql+psycopg2:///'
 database_name = 'restaurants'  # Production database
 test_database = 'rest_test'  # Testing database used by catalog_app_test.py.
+# A SQLite database named ':memory:' is kept in memory. Every thread shares
+# its single connection, which is lost when the engine is disposed.
 
 # Set this to "True" to use postgresql db or "False" for sqlite local file.
 use_postgresql = True  # Boolean
 
+# Connection pool settings for the PostgreSQL and SQLite file engines.
+pool_size = 5  # Connections kept open in the pool.
+max_overflow = 10  # Extra connections allowed when the pool is empty.
+pool_pre_ping = True  # Test connections for liveness on checkout.
+pool_recycle = 3600  # Seconds before a connection is replaced.
+
+# Database APIs of the asyncio engines, which need asyncpg or aiosqlite.
+async_sqlite_dbapi = 'sqlite+aiosqlite:///'
+async_postgres_dbapi = 'postgresql+asyncpg:///'
+
+# Engines already created by ``get_engine``, keyed by database URL and echo.
+_engines = {}
 
-def get_database_session(echo=False, test=False):
-    """Returns a session for executing queries.
 
-    Connects to a database, creates an engine and returns a session connection
-    to the engine.
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waits for a connection.
+
+    ``on_wait`` is called with the seconds spent getting a connection from
+    the pool, including opening a new one. It is *None* until set, e.g. by
+    ``Metrics.attach``, and is kept when ``engine.dispose`` recreates the
+    pool.
+    """
+
+    on_wait = None
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.on_wait = self.on_wait
+        return pool
+
+    def _do_get(self):
+        start = timer()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            if self.on_wait is not None:
+                self.on_wait(timer() - start)
+
+
+def get_engine(echo=False, test=False):
+    """Returns the engine for the testing or production database.
+
+    The engine is created on the first call and reused by later calls, so
+    the whole process shares one connection pool per database. The pool
+    is configured by the module's ``pool_*`` and ``max_overflow`` settings.
 
     :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
     :arg boolean test: Boolean to use test db instead of the production db.
 
-    :returns: A SQLAlchemy Session instance.
+    :returns: A SQLAlchemy Engine instance.
     """
     db_name = database_name if not test else test_database
     if use_postgresql:
-        engine = create_engine(postgres_dbapi + db_name, echo=echo)
-        if echo:
-            print('Connected to PostgreSQL: ' + db_name)
+        url = postgres_dbapi + db_name
+        options = dict(poolclass=TimedQueuePool,
+                       pool_size=pool_size,
+                       max_overflow=max_overflow,
+                       pool_pre_ping=pool_pre_ping,
+                       pool_recycle=pool_recycle)
+    elif db_name == ':memory:':
+        url = sqlite_dbapi + db_name
+        options = dict(poolclass=StaticPool,
+                       connect_args=dict(check_same_thread=False))
     else:
-        engine = create_engine(sqlite_dbapi + db_name, echo=echo)
+        # Pooled like PostgreSQL; the connections move between threads.
+        url = sqlite_dbapi + db_name
+        options = dict(poolclass=TimedQueuePool,
+                       pool_size=pool_size,
+                       max_overflow=max_overflow,
+                       pool_pre_ping=pool_pre_ping,
+                       connect_args=dict(check_same_thread=False))
+    key = (url, echo)
+    if key not in _engines:
+        _engines[key] = create_engine(url, echo=echo, **options)
+        if not use_postgresql:
+            _begin_sqlite_transactions(_engines[key])
         if echo:
-            print('Connected to SQLite: ' + db_name)
-    return sessionmaker(bind=engine)()
+            print('Connected to {}: {}'.format(
+                'PostgreSQL' if use_postgresql else 'SQLite', db_name))
+    return _engines[key]
+
+
+def get_async_engine(echo=False, test=False):
+    """Returns a new asyncio engine for the testing or production database.
+
+    The engine has the same pool settings as the one from ``get_engine``.
+    It must be created and used in the event loop that runs the queries.
+    An in-memory SQLite database can't be shared with the other engine.
+
+    :arg boolean echo: Boolean passed to ``create_async_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+
+    :returns: A SQLAlchemy AsyncEngine instance.
+    """
+    if create_async_engine is None:
+        raise RuntimeError('SQLAlchemy 1.4 or newer is needed for asyncio.')
+    db_name = database_name if not test else test_database
+    if use_postgresql:
+        return create_async_engine(async_postgres_dbapi + db_name, echo=echo,
+                                   pool_size=pool_size,
+                                   max_overflow=max_overflow,
+                                   pool_pre_ping=pool_pre_ping,
+                                   pool_recycle=pool_recycle)
+    return create_async_engine(async_sqlite_dbapi + db_name, echo=echo)
+
+
+def _begin_sqlite_transactions(engine):
+    """Lets SQLAlchemy instead of pysqlite begin SQLite transactions.
+
+    pysqlite only begins a transaction before a write and commits before a
+    SAVEPOINT, which breaks ``begin_nested``. The driver's own transaction
+    handling is turned off and a BEGIN is sent when SQLAlchemy begins one.
+    Like PostgreSQL's implicit BEGIN, it is not counted as a statement.
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.connection.cursor().execute('BEGIN')
+
+
+def dispose_engines(close=True):
+    """Closes all pooled connections of the engines from ``get_engine``.
+
+    The engines stay usable and open new connections when needed.
+
+    :arg boolean close: Boolean to close the pooled connections. Pass
+        *False* in a forked process to only drop the connections it
+        inherited, so they stay open for the parent process.
+    """
+    for engine in _engines.values():
+        engine.dispose(close=close)
+
+
+def reset_engines():
+    """Closes and forgets the engines from ``get_engine``.
+
+    The next ``get_engine`` call creates an engine with the current pool
+    settings. In-memory SQLite engines are kept, because closing them would
+    lose the database, and they have no pool settings.
+    """
+    for key, engine in list(_engines.items()):
+        if engine.url.database != ':memory:':
+            engine.dispose()
+            del _engines[key]
+
+
+def get_database_session(echo=False, test=False):
+    """Returns a session for executing queries.
+
+    Connects to a database and returns a session connection to the shared
+    engine from ``get_engine``.
+
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+
+    :returns: A SQLAlchemy Session instance.
+    """
+    return sessionmaker(bind=get_engine(echo=echo, test=test))()
+
+
+def get_scoped_session(echo=False, test=False):
+    """Returns a thread-local session registry for executing queries.
+
+    The registry is used like a session but each thread gets its own
+    session on the shared engine from ``get_engine``. Call ``remove()`` on
+    the registry when a thread's unit of work (e.g. a request) is finished.
+
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+
+    :returns: A SQLAlchemy scoped_session instance.
+    """
+    return scoped_session(sessionmaker(bind=get_engine(echo=echo, test=test)))
+
+
+def parse_price(price):
+    """Returns a price string like "7.50", ".99" or "$3" in cents.
+
+    :arg string price: Price in dollars.
+    :returns: Integer number of cents or *None* if the text is not a price.
+    """
+    match = re.match(r'^\$?(\d*)(?:\.(\d{0,2}))?$', (price or u'').strip())
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    dollars, cents = match.group(1) or '0', match.group(2) or ''
+    return int(dollars) * 100 + int(cents.ljust(2, '0'))
+
+
+def backfill_price_cents(session, batch_size=1000):
+    """Sets ``price_cents`` of menu items from their price strings.
+
+    Only items without a ``price_cents`` value are read, in batches of
+    ``batch_size`` rows by ID. Each batch is committed, so a large table is
+    never locked by one long transaction and concurrent writes to its rows
+    only wait for one batch.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg int batch_size: Number of rows read and updated at a time.
+    :returns: Number of items given a price in cents.
+    """
+    table = MenuItem.__table__
+    stmt = (table.update().where(table.c.id == bindparam('item_id'))
+            .values(price_cents=bindparam('cents')))
+    last_id = 0
+    updated = 0
+    while True:
+        rows = session.execute(
+            select([table.c.id, table.c.price])
+            .where(table.c.price_cents.is_(None))
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)).fetchall()
+        if not rows:
+            return updated
+        last_id = rows[-1][0]
+        params = [dict(item_id=item_id, cents=parse_price(price))
+                  for item_id, price in rows]
+        params = [each for each in params if each['cents'] is not None]
+        if params:
+            session.execute(stmt, params)
+            updated += len(params)
+        session.commit()
+
+
+def update_rating_counts(session, item_ids=None):
+    """Recounts the stored rating totals of menu items.
+
+    Sets ``favorite_count``, ``good_count`` and ``bad_count`` from the
+    ``menu_item_rating`` table with one UPDATE statement. The change is part
+    of the session's current transaction and is not committed.
+
+    The menu item rows are locked with ``SELECT ... FOR UPDATE`` before the
+    recount. Under READ COMMITTED the count subqueries can't see ratings
+    of other open transactions; with the lock, a second transaction waits
+    until the first commits and then counts its ratings too, so the last
+    recount of an item always includes every committed rating.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg list item_ids: IDs of menu items to update. Updates all if *None*.
+    """
+    session.flush()
+    table = MenuItem.__table__
+    # Locked in ID order so transactions rating several items can't
+    # deadlock. SQLite has no row locks; it allows one writer at a time.
+    lock = select([table.c.id]).order_by(table.c.id).with_for_update()
+    if item_ids is not None:
+        lock = lock.where(table.c.id.in_(item_ids))
+    session.execute(lock).fetchall()
+    values = {}
+    for column, rating in [('favorite_count', 1),
+                           ('good_count', 2),
+                           ('bad_count', 3)]:
+        values[column] = (select([func.count(MenuItemRating.id)])
+                          .where(MenuItemRating.item_id == table.c.id)
+                          .where(MenuItemRating.rating == rating)
+                          .scalar_subquery())
+    stmt = table.update().values(**values)
+    if item_ids is not None:
+        stmt = stmt.where(table.c.id.in_(item_ids))
+    session.execute(stmt)
+
+
+def _insert(session):
+    """Returns the dialect's ``insert`` with ``on_conflict_do_update``."""
+    if session.bind.dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def load_cache_versions(session, tags):
+    """Returns the stored versions of response cache tags.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg list tags: Tag strings.
+    :returns: Dict of tags to versions. Tags never bumped are missing.
+    """
+    if not tags:
+        return {}
+    table = CacheVersion.__table__
+    rows = session.execute(select([table.c.tag, table.c.version])
+                           .where(table.c.tag.in_(list(tags))))
+    return dict(rows.fetchall())
+
+
+def bump_cache_versions(session, tags):
+    """Increments the versions of response cache tags with one statement.
+
+    Rows are written in sorted order, so writers bumping the same tags
+    can't deadlock. The change is part of the session's current
+    transaction and is not committed; the new versions become visible to
+    other processes together with the write they describe.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg list tags: Tag strings.
+    """
+    if not tags:
+        return
+    table = CacheVersion.__table__
+    stmt = _insert(session)(table).values(
+        [dict(tag=tag, version=1) for tag in sorted(set(tags))])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['tag'], set_=dict(version=table.c.version + 1))
+    session.execute(stmt)
+
+
+def upsert_ratings(session, ratings):
+    """Inserts or updates menu item ratings with one SQL statement.
+
+    Uses ``INSERT ... ON CONFLICT DO UPDATE`` on the (user_id, item_id)
+    unique constraint, so concurrent writes of the same rating can't fail
+    with a duplicate key error. Stored rating totals are not updated; call
+    ``update_rating_counts`` afterwards. The change is part of the
+    session's current transaction and is not committed.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg list ratings: Dicts with 'user_id', 'item_id' and 'rating' keys.
+    """
+    stmt = _insert(session)(MenuItemRating.__table__).values(ratings)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'item_id'],
+        set_=dict(rating=stmt.excluded.rating))
+    session.execute(stmt)
+
+
+###############################################################################
+# Full-text search
+###############################################################################
+# Text search configuration (language) used on PostgreSQL.
+search_config = 'english'
+
+# Searched text of each table. PostgreSQL indexes these expressions with GIN
+# indexes, and queries must use the same expressions to use the indexes.
+_search_vectors = {
+    'menu_item': "to_tsvector('{}', name || ' ' || coalesce(description, ''))",
+    'restaurant': "to_tsvector('{}', name || ' ' || coalesce(note, ''))",
+}
+
+# SQLite FTS5 table of searched text, kept in sync by triggers. The rowid is
+# twice the item ID for menu items and twice the ID plus one for restaurants.
+# Updates only touch the table when a searched column changes, not when
+# rating totals or prices in cents are written.
+_sqlite_search_ddl = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        name, detail, restaurant_id UNINDEXED,
+        tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS menu_item_search_insert
+        AFTER INSERT ON menu_item BEGIN
+        INSERT INTO search_index (rowid, name, detail, restaurant_id)
+        VALUES (new.id * 2, new.name, new.description, new.restaurant_id);
+        END""",
+    # Update triggers are recreated, in case they predate their column lists.
+    "DROP TRIGGER IF EXISTS menu_item_search_update",
+    """CREATE TRIGGER menu_item_search_update
+        AFTER UPDATE OF name, description, restaurant_id ON menu_item BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        INSERT INTO search_index (rowid, name, detail, restaurant_id)
+        VALUES (new.id * 2, new.name, new.description, new.restaurant_id);
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS menu_item_search_delete
+        AFTER DELETE ON menu_item BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_search_insert
+        AFTER INSERT ON restaurant BEGIN
+        INSERT INTO search_index (rowid, name, detail, restaurant_id)
+        VALUES (new.id * 2 + 1, new.name, new.note, new.id);
+        END""",
+    "DROP TRIGGER IF EXISTS restaurant_search_update",
+    """CREATE TRIGGER restaurant_search_update
+        AFTER UPDATE OF name, note ON restaurant BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+        INSERT INTO search_index (rowid, name, detail, restaurant_id)
+        VALUES (new.id * 2 + 1, new.name, new.note, new.id);
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_search_delete
+        AFTER DELETE ON restaurant BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+        END""",
+]
+
+
+def _search_vector(table):
+    """Returns the searched text expression of a table as SQL."""
+    return literal_column(_search_vectors[table].format(search_config))
+
+
+def _valid_index(conn, name, concurrently=False):
+    """Returns *True* if a PostgreSQL index exists and is usable.
+
+    A failed or interrupted ``CREATE INDEX CONCURRENTLY`` leaves an index
+    marked invalid in ``pg_index``. Queries can't use it, but writes still
+    update it and its name is taken, so it is dropped here to be rebuilt.
+
+    :arg conn: A SQLAlchemy Connection.
+    :arg string name: Index name.
+    :arg boolean concurrently: Drop without locking out writes. The
+        connection must then be in autocommit mode.
+    """
+    valid = conn.execute(text(
+        'SELECT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = :name AND pg_table_is_visible(c.oid)'),
+        dict(name=name)).scalar()
+    if valid is False:
+        conn.execute(text('DROP INDEX {}{}'.format(
+            'CONCURRENTLY ' if concurrently else '', name)))
+    return bool(valid)
+
+
+def create_search_index(conn, concurrently=False):
+    """Adds the full-text search index if it is missing.
+
+    PostgreSQL gets a GIN index on the searched text of the menu_item and
+    restaurant tables, which stays in sync by itself. An invalid index left
+    by a failed concurrent build is rebuilt. SQLite gets an FTS5
+    table, filled from the existing rows and kept in sync by triggers.
+
+    :arg conn: A SQLAlchemy Connection.
+    :arg boolean concurrently: Builds PostgreSQL indexes without locking
+        out writes. The connection must then be in autocommit mode.
+    """
+    if conn.dialect.name == 'postgresql':
+        for table in sorted(_search_vectors):
+            name = 'ix_{}_search'.format(table)
+            if not _valid_index(conn, name, concurrently):
+                conn.execute(text(
+                    'CREATE INDEX {}{} ON {} USING gin ({})'.format(
+                        'CONCURRENTLY ' if concurrently else '', name,
+                        table, _search_vectors[table].format(search_config))))
+    elif conn.dialect.name == 'sqlite':
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'"
+        )).scalar()
+        for ddl in _sqlite_search_ddl:
+            conn.execute(text(ddl))
+        if not exists:
+            conn.execute(text(
+                'INSERT INTO search_index (rowid, name, detail, '
+                'restaurant_id) SELECT id * 2, name, description, '
+                'restaurant_id FROM menu_item'))
+            conn.execute(text(
+                'INSERT INTO search_index (rowid, name, detail, '
+                'restaurant_id) SELECT id * 2 + 1, name, note, id '
+                'FROM restaurant'))
+
+
+def _drop_search_index(target, conn, **kw):
+    """Drops SQLite's search table, which is not part of the metadata."""
+    if conn.dialect.name == 'sqlite':
+        conn.execute(text('DROP TABLE IF EXISTS search_index'))
+
+
+event.listen(Base.metadata, 'after_create',
+             lambda target, conn, **kw: create_search_index(conn))
+event.listen(Base.metadata, 'before_drop', _drop_search_index)
+
+
+def search(session, query, limit, after=None):
+    """Returns menu items and restaurants matching a text search.
+
+    Every word of the query must match the name or the description (note
+    for restaurants) of a result. Words match other forms of the same word,
+    e.g. "burgers" matches "burger". Best matches come first, ties in the
+    order of type and ID, so pages can start after a (rank, type, id) key.
+
+    :arg session: A SQLAlchemy Session instance.
+    :arg string query: Words to search for.
+    :arg int limit: Largest number of results returned.
+    :arg list after: The [rank, type, id] of the result before the first
+        one returned, or *None* for the best results.
+    :returns: List of dicts with 'type' ("item" or "restaurant"), 'id',
+        'name', 'detail', 'restaurant_id' and 'rank' keys.
+    """
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if not words:
+        return []
+    if session.bind.dialect.name == 'postgresql':
+        tsquery = func.plainto_tsquery(search_config, ' '.join(words))
+        items = MenuItem.__table__
+        rests = Restaurant.__table__
+        item_vector = _search_vector('menu_item')
+        rest_vector = _search_vector('restaurant')
+        results = union_all(
+            select([literal('item').label('type'), items.c.id, items.c.name,
+                    items.c.description.label('detail'),
+                    items.c.restaurant_id,
+                    func.ts_rank(item_vector, tsquery).label('rank')])
+            .where(item_vector.op('@@')(tsquery)),
+            select([literal('restaurant'), rests.c.id, rests.c.name,
+                    rests.c.note, rests.c.id,
+                    func.ts_rank(rest_vector, tsquery)])
+            .where(rest_vector.op('@@')(tsquery))).subquery()
+        stmt = select([results])
+        if after is not None:
+            # ts_rank is a real; compare it with the cursor's rank as one.
+            rank = cast(after[0], postgresql.REAL)
+            stmt = stmt.where(or_(
+                results.c.rank < rank,
+                and_(results.c.rank == rank,
+                     tuple_(results.c.type, results.c.id) >
+                     tuple_(after[1], after[2]))))
+        stmt = (stmt.order_by(results.c.rank.desc(), results.c.type,
+                              results.c.id)
+                .limit(limit))
+        rows = session.execute(stmt)
+        return [dict(row) for row in rows]
+    # FTS5 query of quoted words, so words are never read as operators.
+    match = ' '.join('"{}"'.format(word) for word in words)
+    params = dict(match=match, limit=limit)
+    where = ''
+    if after is not None:
+        # Ties are ordered by rowid, which orders them by type and ID too.
+        where = 'WHERE rank > :rank OR (rank = :rank AND row_id > :row_id) '
+        params.update(rank=-after[0],
+                      row_id=after[2] * 2 + (after[1] == 'restaurant'))
+    rows = session.execute(text(
+        'SELECT * FROM (SELECT rowid AS row_id, name, detail, '
+        'restaurant_id, bm25(search_index) AS rank FROM search_index '
+        'WHERE search_index MATCH :match) ' + where +
+        'ORDER BY rank, row_id LIMIT :limit'), params)
+    return [dict(type='restaurant' if row.row_id % 2 else 'item',
+                 id=row.row_id // 2, name=row.name, detail=row.detail,
+                 restaurant_id=row.restaurant_id, rank=-row.rank)
+            for row in rows]
+
+
+def add_missing_tables(engine):
+    """Creates tables defined above that are missing from the database.
+
+    :arg engine: A SQLAlchemy Engine instance.
+    """
+    existing = inspect(engine).get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            # Only this table, so the metadata's search index isn't rebuilt.
+            table.create(engine)
+
+
+def add_missing_columns(engine):
+    """Adds columns defined above that are missing from existing tables.
+
+    Used for upgrading a database created by an older version of this file.
+    New columns need a ``server_default`` if they are not nullable.
+
+    :arg engine: A SQLAlchemy Engine instance.
+    :returns: List of the added Column objects.
+    """
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = 'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                    table.name, column.name,
+                    column.type.compile(engine.dialect))
+                if column.server_default is not None:
+                    ddl += ' DEFAULT ' + column.server_default.arg
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+                conn.execute(ddl)
+                added.append(column)
+    return added
+
+
+# Indexes of older versions of this file that newer indexes made redundant.
+dropped_indexes = ['ix_menu_item_restaurant_id']
+
+
+def add_missing_indexes(engine):
+    """Adds indexes defined above that are missing from existing tables.
+
+    On PostgreSQL the indexes are built with ``CREATE INDEX CONCURRENTLY`` so
+    that reads and writes on the tables are not blocked while building. An
+    index left invalid by an earlier build that failed is dropped and built
+    again. Afterwards the ``dropped_indexes`` are removed.
+
+    :arg engine: A SQLAlchemy Engine instance.
+    """
+    inspector = inspect(engine)
+    postgres = engine.dialect.name == 'postgresql'
+    # "CREATE INDEX CONCURRENTLY" can't run inside a transaction.
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    for table in Base.metadata.sorted_tables:
+        existing = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if postgres:
+                if _valid_index(conn, index.name, concurrently=True):
+                    continue
+            elif index.name in existing:
+                continue
+            ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if postgres:
+                ddl = ddl.replace('INDEX', 'INDEX CONCURRENTLY', 1)
+            conn.execute(ddl)
+    for name in dropped_indexes:
+        conn.execute(text('DROP INDEX {}IF EXISTS {}'.format(
+            'CONCURRENTLY ' if postgres else '', name)))
+    conn.close()
+
+
+def migrate(echo=False, test=False):
+    """Upgrades an existing database to the tables defined above.
+
+    Adds missing tables, columns, indexes and the full-text search index
+    without dropping the database. Menu items get their ``price_cents`` from
+    their price strings, and their rating totals if the total columns were
+    just added, before the indexes on them are built.
+
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+    """
+    engine = get_engine(echo=echo, test=test)
+    add_missing_tables(engine)
+    added = add_missing_columns(engine)
+    session = sessionmaker(bind=engine)()
+    backfill_price_cents(session)
+    if any(column.table is MenuItem.__table__ and column.name in
+           ('favorite_count', 'good_count', 'bad_count') for column in added):
+        update_rating_counts(session)
+        session.commit()
+    session.close()
+    add_missing_indexes(engine)
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    create_search_index(conn, concurrently=True)
+    conn.close()
+
+
+def recount_ratings(echo=False, test=False):
+    """Rebuilds the stored rating totals of every menu item.
+
+    Adds the rating count columns if the database predates them.
+
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+    """
+    session = get_database_session(echo=echo, test=test)
+    add_missing_columns(session.bind)
+    update_rating_counts(session)
+    session.commit()
+    session.close()
 
 
 def create_all(echo=False, test=False):
@@ -225,16 +915,7 @@ def create_all(echo=False, test=False):
     :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
     :arg boolean test: Boolean to use test db instead of the production db.
     """
-    db_name = database_name if not test else test_database
-    if use_postgresql:
-        # Connect to default database: "postgres"
-        engine = create_engine(postgres_dbapi + db_name, echo=echo)
-        Base.metadata.create_all(engine)
-
-    else:
-        # Connect to sqlite local database.
-        engine = create_engine(sqlite_dbapi + db_name, echo=echo)
-        Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine(echo=echo, test=test))
 
 
 def drop_all(echo=False, test=True):
@@ -246,16 +927,7 @@ def drop_all(echo=False, test=True):
     :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
     :arg boolean test: Boolean to use test db instead of the production db.
     """
-    db_name = database_name if not test else test_database
-    if use_postgresql:
-        # Connect to default database: "postgres"
-        engine = create_engine(postgres_dbapi + db_name, echo=echo)
-        Base.metadata.drop_all(engine)
-
-    else:
-        # Connect to sqlite local database.
-        engine = create_engine(sqlite_dbapi + db_name, echo=echo)
-        Base.metadata.drop_all(engine)
+    Base.metadata.drop_all(get_engine(echo=echo, test=test))
 
 
 def create_database(echo=False, test=False):
@@ -268,6 +940,8 @@ def create_database(echo=False, test=False):
     :arg boolean test: Boolean to use test db instead of the production db.
     """
     db_name = database_name if not test else test_database
+    # Pooled connections would keep the old database open.
+    dispose_engines()
     if use_postgresql:
         # Connect to default database: "postgres"
         engine = create_engine(postgres_dbapi + 'postgres', echo=echo)
@@ -287,5 +961,10 @@ def create_database(echo=False, test=False):
 
 
 if __name__ == '__main__':
-    create_database(echo=True)
-    create_all(echo=True)
+    if 'migrate' in sys.argv[1:]:
+        migrate(echo=True)
+    elif 'recount' in sys.argv[1:]:
+        recount_ratings(echo=True)
+    else:
+        create_database(echo=True)
+        create_all(echo=True)
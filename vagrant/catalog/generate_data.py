@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates a synthetic catalog of users, restaurants, menu items and ratings.
+
+The data is made from a random seed, so the same arguments always make the
+same rows. Item popularity follows a Zipf-like distribution: the item of
+popularity rank *r* is rated with a probability proportional to
+``1 / r ** zipf``. Rows are written with the bulk loader in
+``bulk_load.py`` straight into the database configured in
+``database_setup.py``, which should be empty.
+
+Preset scales (users, restaurants, items per restaurant, ratings):
+
+=====  =======  ===========  =====  =========
+Scale  Users    Restaurants  Items  Ratings
+=====  =======  ===========  =====  =========
+10k    1,000    100          20     10,000
+100k   10,000   1,000        20     100,000
+1m     100,000  5,000        30     1,000,000
+=====  =======  ===========  =====  =========
+"""
+import sys
+import random
+import argparse
+from bisect import bisect
+from database_setup import get_engine
+from bulk_load import BulkLoader, batch_size
+
+# Preset sizes: (users, restaurants, items per restaurant, ratings).
+scales = {
+    '10k': (1000, 100, 20, 10000),
+    '100k': (10000, 1000, 20, 100000),
+    '1m': (100000, 5000, 30, 1000000),
+}
+
+# Skew of item popularity. Larger values give more ratings to top items.
+zipf = 1.1
+
+# Relative frequency of favorite (1), good (2) and bad (3) ratings.
+rating_weights = (3, 5, 2)
+
+# Picks of an already rated (user, item) pair in a row after which the
+# remaining ratings are drawn without the popularity weights.
+max_misses = 1000
+
+_adjectives = ['Urban', 'Golden', 'Blue', 'Happy', 'Little', 'Royal',
+               'Rustic', 'Spicy', 'Lucky', 'Green', 'Corner', 'Old Town']
+_nouns = ['Burger', 'Garden', 'Kitchen', 'Grill', 'Bistro', 'Diner',
+          'Noodle House', 'Taqueria', 'Cafe', 'Pizzeria', 'Bakery', 'Deli']
+_dishes = ['Burger', 'Salad', 'Soup', 'Sandwich', 'Noodles', 'Tacos',
+           'Curry', 'Pizza', 'Cake', 'Pie', 'Tea', 'Lemonade', 'Fries']
+_courses = ['Appetizer', 'Entree', 'Dessert', 'Beverage']
+
+
+###############################################################################
+# Row generators
+###############################################################################
+def _email(n):
+    return u'user{}@example.com'.format(n)
+
+
+def _restaurant_name(n):
+    return u'{} {} {}'.format(_adjectives[n % len(_adjectives)],
+                              _nouns[n // len(_adjectives) % len(_nouns)], n)
+
+
+def _item_name(n):
+    return u'{} {}'.format(_dishes[n % len(_dishes)], n)
+
+
+def generate_users(rng, users):
+    """Yields bulk loader rows for ``users`` users."""
+    for n in range(users):
+        yield dict(name=u'User {}'.format(n), email=_email(n),
+                   picture=u'')
+
+
+def generate_restaurants(rng, users, restaurants):
+    """Yields bulk loader rows for ``restaurants`` restaurants."""
+    for n in range(restaurants):
+        yield dict(name=_restaurant_name(n),
+                   phone=u'555-{:04d}'.format(rng.randrange(10000)),
+                   note=u'',
+                   created_by=_email(rng.randrange(users)))
+
+
+def generate_menu_items(rng, users, restaurants, items):
+    """Yields bulk loader rows for ``items`` items of each restaurant."""
+    for r in range(restaurants):
+        for n in range(items):
+            yield dict(restaurant=_restaurant_name(r),
+                       name=_item_name(n),
+                       description=u'',
+                       price=u'{}.{:02d}'.format(rng.randrange(1, 30),
+                                                 rng.randrange(100)),
+                       course=rng.choice(_courses),
+                       created_by=_email(rng.randrange(users)))
+
+
+def _cumulative(weights):
+    """Returns the running totals of a list of weights."""
+    totals = []
+    total = 0
+    for weight in weights:
+        total += weight
+        totals.append(total)
+    return totals
+
+
+def _pick(rng, totals):
+    """Returns an index picked with the weights of ``_cumulative``."""
+    return bisect(totals, rng.random() * totals[-1])
+
+
+def generate_ratings(rng, users, restaurants, items, ratings, zipf=zipf,
+                     rating_weights=rating_weights):
+    """Yields bulk loader rows for ``ratings`` ratings.
+
+    Each rating is by a random user for an item picked with Zipf-like
+    weights. Items get their popularity rank in random order, so popular
+    items are spread over the restaurants. A user rates an item at most
+    once.
+
+    Picks of a pair that is already rated are repeated, which gets slow
+    when few unrated pairs are left. After ``max_misses`` such picks in a
+    row, the remaining ratings are spread evenly over the unrated pairs:
+    sampled from a list of them when there are at most four pairs per
+    rating, else picked at random, which then rarely hits a rated pair.
+
+    :arg float zipf: Skew of item popularity.
+    :arg rating_weights: Relative frequency of ratings 1, 2 and 3.
+    """
+    count = restaurants * items
+    ratings = min(ratings, users * count)
+    ranks = list(range(count))
+    rng.shuffle(ranks)  # ranks[i] is the item with popularity rank i + 1.
+    item_totals = _cumulative(1.0 / (rank ** zipf)
+                              for rank in range(1, count + 1))
+    rating_totals = _cumulative(rating_weights)
+
+    def row(user, item):
+        return dict(user=_email(user),
+                    restaurant=_restaurant_name(item // items),
+                    item=_item_name(item % items),
+                    rating=_pick(rng, rating_totals) + 1)
+
+    seen = set()
+    misses = 0
+    while len(seen) < ratings and misses < max_misses:
+        user = rng.randrange(users)
+        item = ranks[min(_pick(rng, item_totals), count - 1)]
+        if (user, item) in seen:
+            misses += 1
+            continue
+        misses = 0
+        seen.add((user, item))
+        yield row(user, item)
+    if len(seen) < ratings and users * count <= 4 * ratings:
+        # Few pairs in all, so listing them takes little memory.
+        unrated = [(user, item) for user in range(users)
+                   for item in range(count) if (user, item) not in seen]
+        for user, item in rng.sample(unrated, ratings - len(seen)):
+            yield row(user, item)
+    else:
+        # At least three of four pairs are unrated.
+        while len(seen) < ratings:
+            user, item = rng.randrange(users), rng.randrange(count)
+            if (user, item) not in seen:
+                seen.add((user, item))
+                yield row(user, item)
+
+
+###############################################################################
+# Loading
+###############################################################################
+def generate(users, restaurants, items, ratings, seed=0, zipf=zipf,
+             batch_size=batch_size, echo=False, test=False, out=sys.stdout):
+    """Generates a catalog and writes it into the database.
+
+    :arg int users: Number of users.
+    :arg int restaurants: Number of restaurants.
+    :arg int items: Number of menu items of each restaurant.
+    :arg int ratings: Number of ratings. At most one per user and item.
+    :arg int seed: Seed of the random numbers.
+    :arg float zipf: Skew of item popularity.
+    :arg int batch_size: Number of rows written by one statement.
+    :arg boolean echo: Boolean passed to ``create_engine``'s echo arg.
+    :arg boolean test: Boolean to use test db instead of the production db.
+    :arg out: File the loading speed is reported to, or *None*.
+    :returns: List of the bulk loader's stats for each table.
+    """
+    rng = random.Random(seed)
+    loader = BulkLoader(get_engine(echo=echo, test=test),
+                        batch_size=batch_size, out=out)
+    loader.load('users', generate_users(rng, users))
+    loader.load('restaurants', generate_restaurants(rng, users, restaurants))
+    loader.load('menu_items',
+                generate_menu_items(rng, users, restaurants, items))
+    loader.load('ratings', generate_ratings(rng, users, restaurants, items,
+                                            ratings, zipf=zipf))
+    loader.recount()
+    return loader.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic catalog into the database.')
+    parser.add_argument('--scale', choices=sorted(scales), default='10k',
+                        help='preset sizes (default: 10k)')
+    parser.add_argument('--users', type=int, help='number of users')
+    parser.add_argument('--restaurants', type=int,
+                        help='number of restaurants')
+    parser.add_argument('--items', type=int,
+                        help='number of menu items per restaurant')
+    parser.add_argument('--ratings', type=int, help='number of ratings')
+    parser.add_argument('--zipf', type=float, default=zipf,
+                        help='skew of item popularity')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random numbers')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+                        help='rows written per statement')
+    parser.add_argument('--test', action='store_true',
+                        help='write into the test database')
+    args = parser.parse_args()
+    sizes = [given if given is not None else preset for given, preset in
+             zip([args.users, args.restaurants, args.items, args.ratings],
+                 scales[args.scale])]
+    generate(*sizes, seed=args.seed, zipf=args.zipf,
+             batch_size=args.batch_size, test=args.test)
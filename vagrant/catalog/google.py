@@ -0,0 +1,285 @@
+import re
+import json
+import time
+import threading
+from base64 import urlsafe_b64decode
+from binascii import hexlify
+import rsa
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:  # Older requests versions bundle urllib3.
+    from requests.packages.urllib3.util.retry import Retry
+from oauth2client import clientsecrets
+
+
+# Issuers of Google ID tokens.
+issuers = ('accounts.google.com', 'https://accounts.google.com')
+
+# Seconds of clock difference allowed when checking ID token times.
+clock_skew = 300
+
+# Fewest seconds between loads of the key set for unknown key IDs.
+min_key_refresh = 60
+
+
+class GoogleError(Exception):
+    """Raised when a call to Google fails or returns an error."""
+
+
+class GoogleClient(object):
+    """Client for the Google OAuth2 endpoints used by the signin views.
+
+    The client secrets file is parsed once and kept in memory. All calls go
+    through one ``requests.Session``, so connections to Google are kept
+    alive and reused between logins. Every call has a timeout and failed
+    GET calls are retried.
+
+    Settings are read from the app config when ``init_app`` is called:
+
+    ========================  ================================================
+    GOOGLE_CLIENT_SECRETS     Path of the client secrets file.
+    GOOGLE_API_URL            Base URL of the tokeninfo and userinfo calls.
+    GOOGLE_ACCOUNTS_URL       Base URL of the token and revoke calls.
+    GOOGLE_CERTS_URL          URL or file path of the JSON Web Key Set used to
+                              verify ID tokens.
+    GOOGLE_CERTS_TTL          Seconds the key set is kept if the response has
+                              no Cache-Control max-age.
+    GOOGLE_TIMEOUT            Seconds to wait for a connection and a response.
+    GOOGLE_RETRIES            Retries of GET calls on connection errors and
+                              5xx responses.
+    ========================  ================================================
+
+    The base URLs can point to a local stub server in tests and benchmarks.
+    """
+
+    defaults = {
+        'GOOGLE_CLIENT_SECRETS': 'clientsecrets.json',
+        'GOOGLE_API_URL': 'https://www.googleapis.com',
+        'GOOGLE_ACCOUNTS_URL': 'https://accounts.google.com',
+        'GOOGLE_CERTS_URL': 'https://www.googleapis.com/oauth2/v3/certs',
+        'GOOGLE_CERTS_TTL': 3600,
+        'GOOGLE_TIMEOUT': (3.05, 10),
+        'GOOGLE_RETRIES': 2,
+    }
+
+    def __init__(self):
+        self.config = dict(self.defaults)
+        self._secrets = None
+        self._session = None
+        self._keys = None  # Key ID -> rsa.PublicKey
+        self._keys_expire = 0  # Time the key set is loaded again.
+        self._keys_loaded = 0  # Time the key set was last loaded.
+        self._lock = threading.Lock()
+        # Guards the key set only, so loading keys can use the session.
+        self._keys_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Uses the app config, which may still be changed before use."""
+        for key, value in self.defaults.items():
+            app.config.setdefault(key, value)
+        self.config = app.config
+
+    def load_secrets(self):
+        """Parses the client secrets file unless it is already loaded."""
+        with self._lock:
+            if self._secrets is None:
+                client_type, info = clientsecrets.loadfile(
+                    self.config['GOOGLE_CLIENT_SECRETS'])
+                self._secrets = info
+
+    @property
+    def secrets(self):
+        """The 'web' client info from the parsed client secrets file."""
+        if self._secrets is None:
+            self.load_secrets()
+        return self._secrets
+
+    @property
+    def client_id(self):
+        return self.secrets['client_id']
+
+    @property
+    def session(self):
+        """The shared keep-alive ``requests.Session``."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    retry = Retry(total=self.config['GOOGLE_RETRIES'],
+                                  backoff_factor=0.2,
+                                  status_forcelist=(500, 502, 503, 504))
+                    adapter = HTTPAdapter(max_retries=retry)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def reset(self):
+        """Drops the parsed secrets and closes the session's connections.
+
+        Call after changing the config or in a process forked from one that
+        already used the client.
+        """
+        with self._keys_lock:
+            self._keys = None
+        with self._lock:
+            self._secrets = None
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+    def _request(self, method, url, **kwargs):
+        """Sends a request through the shared session with the timeout."""
+        try:
+            return self.session.request(
+                method, url, timeout=self.config['GOOGLE_TIMEOUT'], **kwargs)
+        except requests.RequestException as e:
+            raise GoogleError(str(e))
+
+    def _get_json(self, url, **params):
+        """Sends a GET request and returns the decoded JSON response."""
+        resp = self._request('GET', url, params=params)
+        try:
+            return resp.json()
+        except ValueError:
+            raise GoogleError('Invalid response from {}'.format(url))
+
+    def exchange_code(self, code):
+        """Exchanges a one-time authorization code for tokens.
+
+        :returns: Dict with 'access_token' and 'id_token' keys.
+        :raises GoogleError: If the code is not accepted.
+        """
+        resp = self._request(
+            'POST', self.config['GOOGLE_ACCOUNTS_URL'] + '/o/oauth2/token',
+            data=dict(code=code,
+                      client_id=self.client_id,
+                      client_secret=self.secrets['client_secret'],
+                      redirect_uri='postmessage',
+                      grant_type='authorization_code'))
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+        if resp.status_code != 200 or 'access_token' not in data:
+            raise GoogleError(data.get('error', resp.status_code))
+        return data
+
+    def user_info(self, access_token):
+        """Returns the name, email and picture of a token's user as a dict."""
+        return self._get_json(
+            self.config['GOOGLE_API_URL'] + '/oauth2/v1/userinfo',
+            access_token=access_token, alt='json')
+
+    def revoke(self, token):
+        """Revokes a token. Returns *True* if Google accepted the request."""
+        resp = self._request(
+            'GET', self.config['GOOGLE_ACCOUNTS_URL'] + '/o/oauth2/revoke',
+            params=dict(token=token))
+        return resp.status_code == 200
+
+    def _fetch_keys(self):
+        """Reads the signing key set from its URL or file.
+
+        :returns: Tuple of the dict of key IDs to keys and the seconds the
+            key set may be kept.
+        """
+        location = self.config['GOOGLE_CERTS_URL']
+        ttl = self.config['GOOGLE_CERTS_TTL']
+        if re.match('https?://', location):
+            resp = self._request('GET', location)
+            try:
+                data = resp.json()
+            except ValueError:
+                raise GoogleError('Invalid key set from {}'.format(location))
+            match = re.search(r'max-age=(\d+)',
+                              resp.headers.get('Cache-Control', ''))
+            if match:
+                ttl = int(match.group(1))
+        else:
+            with open(location) as f:
+                data = json.load(f)
+        keys = {}
+        for key in data.get('keys', []):
+            if key.get('kty') == 'RSA':
+                keys[key.get('kid')] = rsa.PublicKey(_b64int(key['n']),
+                                                     _b64int(key['e']))
+        return keys, ttl
+
+    def signing_key(self, kid):
+        """Returns Google's public key with a key ID or *None* if unknown.
+
+        The key set is kept in memory until it expires. An unknown key ID
+        loads the key set again, at most once a minute, because Google
+        rotates its keys. The key set is fetched without holding a lock, so
+        a slow fetch doesn't hold up requests that have a key already.
+        """
+        with self._keys_lock:
+            keys = self._keys
+            now = time.time()
+            stale = keys is None or now >= self._keys_expire or (
+                kid not in keys and now - self._keys_loaded > min_key_refresh)
+        if stale:
+            keys, ttl = self._fetch_keys()
+            with self._keys_lock:
+                now = time.time()
+                self._keys = keys
+                self._keys_loaded = now
+                self._keys_expire = now + ttl
+        return keys.get(kid)
+
+    def verify_id_token(self, id_token, audience):
+        """Checks an ID token (JWT) locally and returns its claims.
+
+        Checks the RS256 signature with Google's cached keys, the audience,
+        the issuer and the issued and expiry times.
+
+        :arg string id_token: Encoded ID token.
+        :arg string audience: Client ID the token must be issued for.
+        :returns: Dict of the token's claims.
+        :raises GoogleError: If the token is not valid.
+        """
+        try:
+            header, payload, signature = id_token.split('.')
+            head = json.loads(_b64decode(header).decode('utf-8'))
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+            signature = _b64decode(signature)
+        except (AttributeError, ValueError, TypeError):
+            raise GoogleError('Malformed ID token.')
+        if head.get('alg') != 'RS256':
+            raise GoogleError('Unexpected ID token algorithm.')
+        key = self.signing_key(head.get('kid'))
+        if key is None:
+            raise GoogleError('Unknown ID token signing key.')
+        try:
+            method = rsa.verify((header + '.' + payload).encode('ascii'),
+                                signature, key)
+        except rsa.VerificationError:
+            raise GoogleError('Invalid ID token signature.')
+        if method not in (True, 'SHA-256'):  # rsa < 4.0 returns True.
+            raise GoogleError('Unexpected ID token hash.')
+        if claims.get('aud') != audience:
+            raise GoogleError('ID token is for another app.')
+        if claims.get('iss') not in issuers:
+            raise GoogleError('ID token is from an unexpected issuer.')
+        now = time.time()
+        try:
+            expires, issued = float(claims['exp']), float(claims['iat'])
+        except (KeyError, TypeError, ValueError):
+            raise GoogleError('ID token has no valid times.')
+        if expires < now - clock_skew or issued > now + clock_skew:
+            raise GoogleError('ID token is expired or not yet valid.')
+        return claims
+
+
+def _b64decode(data):
+    """Decodes unpadded base64url text to bytes."""
+    data = data.encode('ascii')
+    return urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _b64int(data):
+    """Decodes an unpadded base64url big-endian integer."""
+    return int(hexlify(_b64decode(data)), 16)
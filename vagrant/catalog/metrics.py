@@ -0,0 +1,249 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Upper bounds in seconds of the latency histogram buckets.
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def _labels(names, values, extra=None):
+    """Returns a label set like '{a="1",b="2"}' or '' if there are none."""
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, u'{}'.format(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _number(value):
+    """Returns a number in the text exposition format."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Counter metric with optional labels.
+
+    :arg string name: Metric name.
+    :arg string help: Description of the metric.
+    :arg labels: Names of the labels.
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *values):
+        """Adds one to the count for the given label values."""
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + 1
+
+    def expose(self):
+        """Returns the lines of the metric in the text exposition format."""
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, count in values:
+            lines.append('{}{} {}'.format(
+                self.name, _labels(self.labels, key), count))
+        return lines
+
+
+class Histogram(object):
+    """Histogram metric with optional labels.
+
+    Observing a value is one bisect and a few additions under a lock.
+
+    :arg string name: Metric name.
+    :arg string help: Description of the metric.
+    :arg labels: Names of the labels.
+    :arg buckets: Sorted upper bounds of the buckets.
+    """
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        """Adds a value to the histogram for the given label values."""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(values)
+            if entry is None:
+                entry = self._values[values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *values):
+        """Context manager observing the seconds its block takes."""
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(timer() - start, *values)
+
+    def expose(self):
+        """Returns the lines of the metric in the text exposition format."""
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1]))
+                            for key, entry in self._values.items())
+        bounds = self.buckets + (float('inf'),)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _labels(self.labels, key, [('le', _number(bound))]),
+                    cumulative))
+            labels = _labels(self.labels, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels,
+                                              _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels,
+                                                cumulative))
+        return lines
+
+
+class Metrics(object):
+    """Request, database pool, cache and Google API metrics of the app.
+
+    Request latency and counts are recorded by request hooks added with
+    ``init_app``. Pool gauges and cache counters are read when the metrics
+    are exposed, so they cost nothing between scrapes.
+
+    All values are kept in the memory of the process. With several server
+    workers, each scrape is answered by one worker and shows only the
+    requests that worker handled; counters restart from zero when a worker
+    is restarted. Prometheus rates over many scrapes still show the trend,
+    but exact totals need a single worker or prometheus_client's
+    multiprocess mode.
+    """
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            'catalog_request_duration_seconds',
+            'Time spent handling requests by Flask endpoint.',
+            ['endpoint', 'method'])
+        self.requests = Counter(
+            'catalog_requests_total',
+            'Responses by Flask endpoint and status code.',
+            ['endpoint', 'method', 'status'])
+        self.pool_wait_seconds = Histogram(
+            'catalog_db_pool_wait_seconds',
+            'Time spent waiting for a database connection from the pool.',
+            ['database'],
+            buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+                     30.0))
+        self.google_seconds = Histogram(
+            'catalog_google_request_duration_seconds',
+            'Time spent on HTTP calls to Google APIs by call.',
+            ['call'])
+        self._engines = []
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Registers the request hooks with a Flask app."""
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        self._cache = lambda: getattr(app, 'response_cache', None)
+
+    def _start_request(self):
+        g._metrics_start = timer()
+
+    def _end_request(self, response):
+        start = g.get('_metrics_start')
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            self.request_seconds.observe(timer() - start, endpoint,
+                                         request.method)
+            self.requests.inc(endpoint, request.method,
+                              str(response.status_code))
+        return response
+
+    def attach(self, engine):
+        """Records pool gauges and checkout wait times of an engine.
+
+        Wait times are reported by pools with an ``on_wait`` hook, such as
+        ``database_setup.TimedQueuePool``. Safe to repeat.
+        """
+        with self._lock:
+            if engine in self._engines:
+                return
+            self._engines.append(engine)
+        if hasattr(engine.pool, 'on_wait'):
+            database = engine.url.database
+            engine.pool.on_wait = (
+                lambda seconds: self.pool_wait_seconds.observe(seconds,
+                                                               database))
+
+    def _pool_lines(self):
+        gauges = [
+            ('catalog_db_pool_size', 'Connections kept open in the pool.',
+             'size'),
+            ('catalog_db_pool_checked_out',
+             'Connections checked out from the pool.', 'checkedout'),
+            ('catalog_db_pool_overflow',
+             'Connections open beyond the pool size.', 'overflow'),
+        ]
+        lines = []
+        for name, help, method in gauges:
+            lines += ['# HELP {} {}'.format(name, help),
+                      '# TYPE {} gauge'.format(name)]
+            for engine in self._engines:
+                get = getattr(engine.pool, method, None)
+                if get is not None:
+                    # QueuePool counts unopened connections as overflow < 0.
+                    lines.append('{}{} {}'.format(
+                        name, _labels(['database'], [engine.url.database]),
+                        max(get(), 0)))
+        return lines
+
+    def _cache_lines(self):
+        cache = self._cache() if self._cache is not None else None
+        if cache is None:
+            return []
+        stats = cache.stats()
+        name = 'catalog_response_cache_events_total'
+        lines = ['# HELP catalog_response_cache_entries '
+                 'Entries in the response cache.',
+                 '# TYPE catalog_response_cache_entries gauge',
+                 'catalog_response_cache_entries {}'.format(stats['size']),
+                 '# HELP {} Response cache lookups and removals.'
+                 .format(name),
+                 '# TYPE {} counter'.format(name)]
+        for key in ('hits', 'misses', 'evictions', 'expirations',
+                    'invalidations'):
+            lines.append('{}{} {}'.format(
+                name, _labels(['event'], [key]), stats[key]))
+        return lines
+
+    def expose(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in (self.request_seconds, self.requests,
+                       self.pool_wait_seconds, self.google_seconds):
+            lines += metric.expose()
+        lines += self._pool_lines()
+        lines += self._cache_lines()
+        return '\n'.join(lines) + '\n'
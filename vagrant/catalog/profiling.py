@@ -0,0 +1,107 @@
+import time
+import threading
+from collections import deque
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class QueryProfiler(object):
+    """Counts and times the SQL statements run during each Flask request.
+
+    Profiling is opt-in: it only runs while the app's ``SQL_PROFILING``
+    config value is *True*. Profiled responses get an ``X-Query-Count``
+    header and a ``Server-Timing`` header with the time spent in SQL and in
+    the whole request. The last ``window`` requests of each route are kept
+    for ``summary``.
+
+    Statements run while a streamed response is sent come after the headers
+    and are not counted.
+
+    :arg int window: Number of recent requests kept for each route.
+    """
+
+    def __init__(self, window=100):
+        self.window = window
+        self._routes = {}  # route -> [requests, deque of (ms, sql ms, n)]
+        self._engines = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Registers the request hooks with a Flask app."""
+        app.config.setdefault('SQL_PROFILING', False)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    def attach(self, engine):
+        """Listens for the statements run by an engine. Safe to repeat."""
+        if engine in self._engines:
+            return
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        self._engines.add(engine)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        if has_request_context() and '_sql_stats' in g:
+            conn.info.setdefault('query_start', []).append(timer())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if has_request_context() and '_sql_stats' in g:
+            starts = conn.info.get('query_start')
+            if starts:
+                g._sql_stats[0] += 1
+                g._sql_stats[1] += timer() - starts.pop()
+
+    def _start_request(self):
+        if current_app.config.get('SQL_PROFILING'):
+            g._sql_stats = [0, 0.0]  # Number of statements and seconds.
+            g._request_start = timer()
+
+    def _end_request(self, response):
+        if '_sql_stats' not in g:
+            return response
+        total = (timer() - g._request_start) * 1000
+        count, sql = g._sql_stats[0], g._sql_stats[1] * 1000
+        response.headers['X-Query-Count'] = str(count)
+        response.headers['Server-Timing'] = (
+            'db;dur={:.2f};desc="SQL", app;dur={:.2f}'.format(sql, total))
+        if request.url_rule is not None:
+            route = '{} {}'.format(request.method, request.url_rule.rule)
+            with self._lock:
+                entry = self._routes.setdefault(
+                    route, [0, deque(maxlen=self.window)])
+                entry[0] += 1
+                entry[1].append((total, sql, count))
+        return response
+
+    def summary(self):
+        """Returns a dict of query and timing stats for each route.
+
+        Stats are for each route's last ``window`` requests. 'requests' is
+        the number of requests profiled since the start or last ``reset``.
+        """
+        with self._lock:
+            routes = dict((route, (entry[0], list(entry[1])))
+                          for route, entry in self._routes.items())
+        result = {}
+        for route, (requests, recent) in routes.items():
+            times = sorted(each[0] for each in recent)
+            counts = [each[2] for each in recent]
+            result[route] = dict(
+                requests=requests,
+                mean_queries=round(sum(counts) / float(len(counts)), 2),
+                max_queries=max(counts),
+                mean_sql_ms=round(sum(each[1] for each in recent) /
+                                  len(recent), 3),
+                p50_ms=round(times[(len(times) - 1) // 2], 3),
+                p95_ms=round(times[int(0.95 * (len(times) - 1))], 3),
+                max_ms=round(times[-1], 3))
+        return result
+
+    def reset(self):
+        """Drops the stats of all routes."""
+        with self._lock:
+            self._routes.clear()
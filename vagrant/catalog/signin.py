@@ -1,46 +1,38 @@
-import requests
 import uuid
 from flask import request, flash, jsonify
 from flask import session as login_session
-from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
 from catalog import app
+from catalog.google import GoogleError
 from database_setup import User
 
 
 ##############################################################################
 # Google+ Sign in/out
 ##############################################################################
+# OAuth client ID of this app. ID tokens must be issued for it.
+client_id = ''.join(['494203108202-8qijkubc2hiio08dptgb5cc21su8qf84',
+                     '.apps.googleusercontent.com'])
+
+
 @app.route('/gconnect', methods=['POST'])
 def gconnect():
     """Handles G+ third-party signin."""
     code = request.get_json()['data']
     try:
-        oauth_flow = flow_from_clientsecrets('clientsecrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        # Exchange code for credentials object with token
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        # Exchange code for access and ID tokens.
+        with app.metrics.google_seconds.time('token'):
+            tokens = app.google.exchange_code(code)
+        access_token, id_token = tokens['access_token'], tokens['id_token']
+    except (GoogleError, KeyError):
         return jsonify(message='Failed to upgrade authorization code'), 401
 
-    # Check that access token is valid
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token={}'
-           .format(access_token))
-    result = requests.get(url).json()
-    # Abort if error.
-    if result.get('error') is not None:
-        return jsonify(message=result.get('error')), 500
-
-    # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
-        return jsonify(message="Token's user ID doesn't match login."), 401
-
-    # Verify that the access token is valid for this app.
-    app_token = ''.join(['494203108202-8qijkubc2hiio08dptgb5cc21su8qf84',
-                         '.apps.googleusercontent.com'])
-    if result['issued_to'] != app_token:
-        return jsonify(message="Token's client ID does not match app's."), 401
+    # Verify the ID token's signature, app client ID, issuer and expiry
+    # locally with Google's cached signing keys.
+    try:
+        claims = app.google.verify_id_token(id_token, audience=client_id)
+    except GoogleError as e:
+        return jsonify(message=str(e)), 401
+    gplus_id = claims['sub']
 
     stored_credentials = login_session.get('access_token')
     stored_gplus_id = login_session.get('gplus_id')
@@ -50,15 +42,17 @@ def gconnect():
                        username=login_session['username'],
                        picture=login_session['picture'])
 
+    # Get user info
+    try:
+        with app.metrics.google_seconds.time('userinfo'):
+            data = app.google.user_info(access_token)
+    except GoogleError as e:
+        return jsonify(message=str(e)), 500
+
     # Store the access token in the session for later use.
-    login_session['access_token'] = credentials.access_token
+    login_session['access_token'] = access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    data = requests.get(userinfo_url, params=params).json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
@@ -73,6 +67,7 @@ def gconnect():
                         email=data['email'],
                         picture=data['picture'])
         app.db_session.add(new_user)
+        app.response_cache.invalidate('users')
         app.db_session.commit()
         login_session['user_id'] = new_user.id
 
@@ -94,11 +89,13 @@ def gdisconnect():
         login_session.clear()
         return jsonify(error='Current user not connected.'), 401
 
-    url = ('https://accounts.google.com/o/oauth2/revoke?token={}'
-           .format(access_token))
-    result = requests.get(url)
+    try:
+        with app.metrics.google_seconds.time('revoke'):
+            revoked = app.google.revoke(access_token)
+    except GoogleError:
+        return jsonify(error='Failed to reach Google to revoke token.'), 500
 
-    if result.status_code == 200:
+    if revoked:
         # Reset the user's sesson.
         login_session.clear()
         resp = jsonify(status='ok', message='Successfully disconnected.')
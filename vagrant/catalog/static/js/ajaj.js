@@ -1,5 +1,8 @@
 /**
  * Send an AJAJ GET request.
+ * Responses with an ETag are stored in the browser session. Later requests
+ * for the same url send the ETag and reuse the stored response if the
+ * server answers "304 Not Modified".
  * @param {String}   url      Url address for POST.
  * @param {Object}   params   Optional parameters as an object.
  * @param {Function} callback Callback function for applying the response.
@@ -7,12 +10,6 @@
 var aget = function (url, params, callback) {
     'use strict';
     var xmlhttp = new XMLHttpRequest();
-    xmlhttp.onreadystatechange = function () {
-        if (xmlhttp.readyState !== 4) {
-            return;
-        }
-        callback(JSON.parse(xmlhttp.response));
-    };
     params = ko.toJS(params);
     // Change params into a list of strings and join with URL.
     var param_list = [];
@@ -22,11 +19,63 @@ var aget = function (url, params, callback) {
     if (param_list.length > 0) {
         url += '?' + param_list.join('&');
     }
+    var stored = load_response(url);
+    xmlhttp.onreadystatechange = function () {
+        if (xmlhttp.readyState !== 4) {
+            return;
+        }
+        if (xmlhttp.status === 304 && stored !== null) {
+            callback(stored.response);
+            return;
+        }
+        var response = JSON.parse(xmlhttp.response);
+        var etag = xmlhttp.getResponseHeader('ETag');
+        if (etag) {
+            save_response(url, etag, response);
+        }
+        callback(response);
+    };
     xmlhttp.open('GET', url, true);
+    if (stored !== null) {
+        xmlhttp.setRequestHeader('If-None-Match', stored.etag);
+    }
     xmlhttp.send();
 };
 
 
+/**
+ * Return the stored ETag and response for a url or null if none.
+ * @param {String}   url      Url address of a GET request.
+ */
+var load_response = function (url) {
+    'use strict';
+    try {
+        return JSON.parse(sessionStorage.getItem('aget:' + url));
+    } catch (e) {
+        return null;
+    }
+};
+
+
+/**
+ * Store the ETag and response for a url in the browser session.
+ * @param {String}   url      Url address of a GET request.
+ * @param {String}   etag     ETag header of the response.
+ * @param {Object}   response Parsed JSON response.
+ */
+var save_response = function (url, etag, response) {
+    'use strict';
+    try {
+        sessionStorage.setItem('aget:' + url, JSON.stringify({
+            etag: etag,
+            response: response
+        }));
+    } catch (e) {
+        // Storage is full or disabled. The response just isn't reused.
+    }
+};
+
+
 /**
  * Send an AJAJ request.
  * @param {String}   method   AJAJ method for http request.
@@ -1,10 +1,11 @@
-from catalog import app
+from catalog import app, create_app
 import uuid
 
 """
 Item Catalog project main app.
 
-Run this file as 'python catalog_app.py' to initialize the server.
+Run this file as 'python catalog_app.py' to initialize the development
+server. Use 'wsgi.py' with a WSGI server such as gunicorn in production.
 
 Before running this app, ensure that the database is setup by running
 'database_setup.py'.
@@ -15,6 +16,7 @@ Project repository and more details at:
 https://github.com/Ripley6811/FSND-P3-Item-Catalog
 """
 
-app.start_session()
-app.secret_key = uuid.uuid4().hex  # 'secret_key'
+# A random key unless CATALOG_SETTINGS sets one. Sessions end on restart.
+app.secret_key = uuid.uuid4().hex
+create_app()
 app.run(host='0.0.0.0', port=8000, debug=True)
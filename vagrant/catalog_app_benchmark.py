@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+"""
+Benchmarks the routes of **catalog_app** with the Flask test client.
+
+Each dataset is generated into the test database with
+``catalog/generate_data.py`` and every route below is requested many times.
+The p50/p95/p99 latency, SQL queries per request and peak memory of each
+route are printed and compared against a baseline file. The run fails if a
+route got slower, runs more queries or uses more memory than the baseline
+allows.
+
+Every route of ``catalog/api.py``, ``catalog/views.py`` and
+``catalog/signin.py`` is covered, except:
+
+- POST and DELETE of ``/items`` and ``/restaurants``, because they add or
+  delete rows and every request must see the same dataset;
+- ``/environment``, which lists the installed Python packages and runs no
+  catalog code;
+- ``/menu/`` without an ID, which only exists for ``url_for`` in scripts.
+
+Sign-in with ``/gconnect`` and ``/gdisconnect`` talks to the local Google
+stub of ``google_stub.py`` instead of Google. The first sign-in adds its
+user, the later ones find it.
+
+Run the file from the ``vagrant`` directory. It replaces the data in the test
+database, like ``catalog_app_test.py``::
+
+    python catalog_app_benchmark.py                  # Compare to baseline.
+    python catalog_app_benchmark.py --save           # Store a new baseline.
+    python catalog_app_benchmark.py --datasets large --latency-tolerance 0.5
+
+With ``--server`` the anonymous GET routes are instead requested over HTTP
+from a running server by several client threads, and the requests per
+second of each route are printed. Use it to compare servers on the same
+database, e.g. the development server with gunicorn workers::
+
+    python catalog_app_benchmark.py --server http://localhost:8000
+    python catalog_app_benchmark.py --server http://localhost:8000 \\
+        --concurrency 32 --duration 20
+"""
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import requests as http  # "requests" is an argument name below.
+from collections import OrderedDict
+from sqlalchemy import event
+try:
+    import tracemalloc
+except ImportError:  # Python 2 has no memory tracing.
+    tracemalloc = None
+
+from catalog import app, db_setup as db
+from catalog import generate_data
+import google_stub
+
+# Dataset sizes: (users, restaurants, items per restaurant, ratings).
+datasets = OrderedDict([
+    ('small', (50, 10, 10, 500)),
+    ('medium', (500, 50, 20, 5000)),
+    ('large', generate_data.scales['100k']),
+])
+default_datasets = ['small', 'medium']
+
+baseline_file = 'benchmark_baseline.json'
+requests_per_route = 50  # Timed requests for each route.
+warmup_requests = 5  # Untimed requests sent first.
+memory_requests = 5  # Requests traced for peak memory.
+concurrency = 16  # Client threads of a --server run.
+duration = 10  # Seconds each route is requested in a --server run.
+
+# Allowed increase over the baseline before a result is a regression.
+latency_tolerance = 0.25  # Fraction of the baseline latency.
+latency_floor = 0.5  # Milliseconds always allowed, for very fast routes.
+query_tolerance = 0  # Queries per request.
+memory_tolerance = 0.5  # Fraction of the baseline peak memory.
+# Latency percentiles compared. p99 is reported but noisy on short runs.
+compared_percentiles = ['p50', 'p95']
+
+# Routes as (method, url, login, JSON data). The login is False for an
+# anonymous client, True for user 1 or 'google' for user 1 signed in with
+# a Google access token. Routes that create or delete rows are left out so
+# every request sees the same dataset. IDs and names are those of the first
+# rows made by generate_data.
+_restaurant = generate_data._restaurant_name(0)
+_item = generate_data._item_name(0)
+routes = [
+    ('GET', '/', False, None),
+    ('GET', '/menu/1', False, None),
+    ('GET', '/form/item/1?id=1', True, None),
+    ('GET', '/form/restaurant?id=1', True, None),
+    ('GET', '/random_favorites', True, None),
+    ('GET', '/items?id=1', False, None),
+    ('GET', '/items?id=1', True, None),
+    ('GET', '/items?id=1&limit=20', True, None),
+    ('GET', '/api/restaurants', False, None),
+    ('GET', '/api/restaurants?limit=50', False, None),
+    ('GET', '/api/restaurants?stream=1', False, None),
+    ('GET', '/api/users', False, None),
+    ('GET', '/api/menu/restaurant_id=1', False, None),
+    ('GET', '/api/menu/restaurant=' + _restaurant, False, None),
+    ('GET', '/api/favorites?user_id=1', False, None),
+    ('GET', '/api/favorites?user_id=1&limit=20', False, None),
+    ('GET', '/api/search?q=' + _item.split()[0], False, None),
+    ('GET', '/api/search?q={}&limit=20'.format(_item.split()[0]), False,
+     None),
+    ('GET', '/metrics', False, None),
+    ('GET', '/cache', True, None),
+    ('GET', '/debug/queries', True, None),
+    ('POST', '/ratings', True, {'item_id': 1, 'rating': 1}),
+    ('POST', '/ratings/batch', True,
+     {'ratings': [{'item_id': i, 'rating': 2} for i in range(1, 11)]}),
+    ('PUT', '/items', True, {'item': {'id': 1, 'name': _item}, 'rating': 1}),
+    ('PUT', '/restaurants', True,
+     {'restaurant': {'id': 1, 'name': _restaurant}}),
+    ('POST', '/gconnect', False, {'data': 'code'}),
+    ('POST', '/gdisconnect', 'google', None),
+]
+
+# Names of the login kinds in result keys.
+_login_names = {False: 'anon', True: 'user', 'google': 'google'}
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+###############################################################################
+# Measuring
+###############################################################################
+def seed(dataset):
+    """Replaces the test database's data with a generated dataset."""
+    db.drop_all(test=True)
+    db.create_all(test=True)
+    generate_data.generate(*datasets[dataset], seed=0, test=True, out=None)
+    app.start_session(test=True)
+
+
+def percentile(values, p):
+    """Returns the ``p`` percentile of a list by the nearest-rank method."""
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def _client(login):
+    """Returns a test client with the CSRF cookie of ``_login``."""
+    client = app.test_client()
+    if login:
+        client.set_cookie('localhost', '_csrf', 'benchmark')
+    return client
+
+
+def _login(client, login):
+    """Sets the client's session for a route's login.
+
+    Runs before every request, because signing in and out changes it.
+    """
+    with client.session_transaction() as sess:
+        sess.clear()
+        if login:
+            sess['user_id'] = 1
+            sess['username'] = 'User 0'
+            sess['picture'] = ''
+            sess['_csrf'] = 'benchmark'
+        if login == 'google':
+            sess['access_token'] = 'token'
+            sess['gplus_id'] = '42'
+
+
+def _request(client, login, method, url, data, cached):
+    """Sends one request and returns its time in milliseconds.
+
+    :raises RuntimeError: If the request failed.
+    """
+    _login(client, login)
+    if not cached:
+        app.response_cache.clear()
+    body = json.dumps(data) if data is not None else None
+    start = timer()
+    resp = client.open(url, method=method, data=body,
+                       content_type='application/json')
+    resp.get_data()  # Read streamed responses to the end.
+    elapsed = (timer() - start) * 1000
+    if resp.status_code >= 400:
+        raise RuntimeError('{} {} returned {}'.format(
+            method, url, resp.status_code))
+    return elapsed
+
+
+def _start_google_stub():
+    """Starts the Google stub and points the app's Google client at it.
+
+    :returns: Function that stops the stub and restores the settings.
+    """
+    server = google_stub.serve()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    names = ['GOOGLE_API_URL', 'GOOGLE_ACCOUNTS_URL', 'GOOGLE_CERTS_URL']
+    saved = dict((name, app.config[name]) for name in names)
+    app.config.update(GOOGLE_API_URL=url, GOOGLE_ACCOUNTS_URL=url,
+                      GOOGLE_CERTS_URL=url + '/certs')
+    app.google.reset()
+
+    def stop():
+        app.config.update(saved)
+        app.google.reset()
+        server.shutdown()
+        server.server_close()
+    return stop
+
+
+def measure(method, url, login=False, data=None, requests=None,
+            cached=False):
+    """Returns the latency, queries and memory of requests to one route.
+
+    :arg string method: HTTP method.
+    :arg string url: URL with query string.
+    :arg login: Login of the requests, see ``routes``.
+    :arg dict data: JSON data sent with the requests.
+    :arg int requests: Number of timed requests.
+    :arg boolean cached: Keep the response cache between requests. By
+        default it is cleared so every request reaches the database.
+    :returns: Dict with 'p50', 'p95' and 'p99' latency in milliseconds,
+        'queries' per request and 'peak_kb' memory (*None* without
+        ``tracemalloc``).
+    """
+    requests = requests or requests_per_route
+    client = _client(login)
+    for _ in range(warmup_requests):
+        _request(client, login, method, url, data, cached)
+    queries = [0]
+
+    def count(*args):
+        queries[0] += 1
+
+    engine = db.get_engine(test=True)
+    event.listen(engine, 'before_cursor_execute', count)
+    times = []
+    try:
+        for _ in range(requests):
+            times.append(_request(client, login, method, url, data, cached))
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    peak = None
+    if tracemalloc is not None:
+        for _ in range(memory_requests):
+            tracemalloc.start()
+            try:
+                _request(client, login, method, url, data, cached)
+                peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        peak = round(peak / 1024.0, 1)
+    return OrderedDict([('p50', round(percentile(times, 50), 3)),
+                        ('p95', round(percentile(times, 95), 3)),
+                        ('p99', round(percentile(times, 99), 3)),
+                        ('queries', round(queries[0] / float(requests), 1)),
+                        ('peak_kb', peak)])
+
+
+def run(names, requests=None, cached=False, out=sys.stdout):
+    """Benchmarks every route on each named dataset.
+
+    :arg list names: Keys of ``datasets``.
+    :returns: Dict of results keyed by '<dataset> <login> <method> <url>'.
+    """
+    results = OrderedDict()
+    stop_google_stub = _start_google_stub()
+    try:
+        for name in names:
+            seed(name)
+            for method, url, login, data in routes:
+                key = '{} {} {} {}'.format(
+                    name, _login_names[login], method, url)
+                results[key] = measure(method, url, login, data,
+                                       requests=requests, cached=cached)
+                if out is not None:
+                    out.write('{:<60} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} '
+                              '{queries:>6} {peak_kb!s:>9}\n'
+                              .format(key, **results[key]))
+    finally:
+        stop_google_stub()
+    app.db_session.remove()
+    return results
+
+
+def throughput(server, url, concurrency=concurrency, duration=duration):
+    """Returns the requests per second a running server answers for a URL.
+
+    ``concurrency`` threads, each with its own keep-alive session, request
+    the URL over and over for ``duration`` seconds.
+
+    :arg string server: Base URL of the server, like 'http://localhost:8000'.
+    :arg string url: Path of the route.
+    :returns: Dict with 'rps', 'requests', 'errors' and 'p50' and 'p95' ms.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = timer() + duration
+
+    def client():
+        session = http.Session()
+        times = []
+        failed = 0
+        while timer() < stop:
+            start = timer()
+            try:
+                resp = session.get(server + url)
+                resp.content
+                failed += resp.status_code >= 400
+            except http.RequestException:
+                failed += 1
+            times.append((timer() - start) * 1000)
+        session.close()
+        with lock:
+            latencies.extend(times)
+            errors[0] += failed
+
+    start = timer()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - start
+    return dict(rps=round(len(latencies) / elapsed, 1),
+                requests=len(latencies),
+                errors=errors[0],
+                p50=round(percentile(latencies, 50), 3),
+                p95=round(percentile(latencies, 95), 3))
+
+
+def run_server(server, concurrency=concurrency, duration=duration,
+               out=sys.stdout):
+    """Measures the throughput of every anonymous GET route of a server.
+
+    :returns: Dict of results from ``throughput`` keyed by URL.
+    """
+    results = OrderedDict()
+    for method, url, login, data in routes:
+        if method != 'GET' or login or url in results:
+            continue
+        results[url] = throughput(server, url, concurrency, duration)
+        if out is not None:
+            out.write('{:<60} {rps:>8.1f} {p50:>8.2f} {p95:>8.2f} '
+                      '{errors:>6}\n'.format(url, **results[url]))
+    return results
+
+
+def compare(results, baseline, latency_tolerance=latency_tolerance,
+            query_tolerance=query_tolerance,
+            memory_tolerance=memory_tolerance,
+            percentiles=compared_percentiles):
+    """Returns a list of messages for results worse than the baseline.
+
+    Results missing from the baseline are not compared.
+
+    :arg dict results: Results from ``run``.
+    :arg dict baseline: Results from an earlier ``run``.
+    :arg float latency_tolerance: Allowed latency increase as a fraction.
+    :arg float query_tolerance: Allowed increase of queries per request.
+    :arg float memory_tolerance: Allowed peak memory increase as a fraction.
+    :arg list percentiles: Latency percentiles compared.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for stat in percentiles:
+            limit = max(base[stat] * (1 + latency_tolerance),
+                        base[stat] + latency_floor)
+            if result[stat] > limit:
+                regressions.append('{}: {} {:.2f}ms > {:.2f}ms'.format(
+                    key, stat, result[stat], limit))
+        if result['queries'] > base['queries'] + query_tolerance:
+            regressions.append('{}: {} queries > {}'.format(
+                key, result['queries'], base['queries']))
+        if result['peak_kb'] is not None and base['peak_kb'] is not None:
+            limit = base['peak_kb'] * (1 + memory_tolerance)
+            if result['peak_kb'] > limit:
+                regressions.append('{}: peak {}KB > {:.1f}KB'.format(
+                    key, result['peak_kb'], limit))
+    return regressions
+
+
+def _load_baseline(path):
+    """Returns the results stored in a baseline file, or {} if missing."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the catalog routes against a baseline.')
+    parser.add_argument('--datasets', nargs='+', choices=list(datasets),
+                        default=default_datasets)
+    parser.add_argument('--requests', type=int, default=requests_per_route,
+                        help='timed requests per route')
+    parser.add_argument('--cached', action='store_true',
+                        help='keep the response cache between requests')
+    parser.add_argument('--baseline', default=baseline_file,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results in the baseline file')
+    parser.add_argument('--latency-tolerance', type=float,
+                        default=latency_tolerance)
+    parser.add_argument('--query-tolerance', type=float,
+                        default=query_tolerance)
+    parser.add_argument('--memory-tolerance', type=float,
+                        default=memory_tolerance)
+    parser.add_argument('--percentiles', nargs='+',
+                        choices=['p50', 'p95', 'p99'],
+                        default=compared_percentiles)
+    parser.add_argument('--server',
+                        help='measure the throughput of a running server')
+    parser.add_argument('--concurrency', type=int, default=concurrency,
+                        help='client threads of a --server run')
+    parser.add_argument('--duration', type=float, default=duration,
+                        help='seconds per route of a --server run')
+    args = parser.parse_args()
+
+    if args.server:
+        sys.stdout.write('{:<60} {:>8} {:>8} {:>8} {:>6}\n'.format(
+            'route', 'req/s', 'p50 ms', 'p95 ms', 'errors'))
+        results = run_server(args.server.rstrip('/'), args.concurrency,
+                             args.duration)
+        sys.exit(1 if any(each['errors'] for each in results.values())
+                 else 0)
+
+    app.secret_key = 'benchmark'
+    sys.stdout.write('{:<60} {:>8} {:>8} {:>8} {:>6} {:>9}\n'.format(
+        'route', 'p50 ms', 'p95 ms', 'p99 ms', 'SQL', 'peak KB'))
+    results = run(args.datasets, requests=args.requests, cached=args.cached)
+    baseline = _load_baseline(args.baseline)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+    else:
+        regressions = compare(results, baseline,
+                              latency_tolerance=args.latency_tolerance,
+                              query_tolerance=args.query_tolerance,
+                              memory_tolerance=args.memory_tolerance,
+                              percentiles=args.percentiles)
+        for each in regressions:
+            print('REGRESSION ' + each)
+        if not baseline:
+            print('No baseline in {}. Run with --save to create it.'
+                  .format(args.baseline))
+        sys.exit(1 if regressions else 0)
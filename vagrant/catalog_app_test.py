@@ -1,16 +1,80 @@
 import unittest
 from flask_testing import TestCase, LiveServerTestCase
+import os
 import json
+import gzip
+import random
+import shutil
+import tempfile
 import requests
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+from base64 import urlsafe_b64decode
+from sqlalchemy import inspect, event
+from sqlalchemy.orm import scoped_session, sessionmaker
 
-from catalog import app, db_setup as db
+from catalog import app, db_setup as db, create_app, after_fork
+from catalog.cache import ResponseCache, DatabaseVersions
+from catalog import compress
+from catalog.compress import precompress
+from catalog import assets
+from catalog.metrics import Histogram
+from catalog.google import GoogleError
+from catalog.bulk_load import BulkLoader
+from catalog import generate_data
+import catalog_app_benchmark as benchmark
+import google_stub
+from google_stub import GoogleStub
+try:
+    import asyncio
+    from catalog import async_api
+except (ImportError, SyntaxError):  # Python 2
+    async_api = None
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
 """
 Access the active session with `app.db_session`
 Access the database table classes through `db`:
    `db.MenuItem`, `db.Restaurant`, etc.
+
+Set CATALOG_TEST_MEMORY=1 to test against an in-memory SQLite database.
+Parallel runs with pytest-xdist (`pytest -n 4 catalog_app_test.py`) give
+each worker its own test database.
 """
+if os.environ.get('CATALOG_TEST_MEMORY'):
+    db.use_postgresql = False
+    db.test_database = ':memory:'
+elif os.environ.get('PYTEST_XDIST_WORKER'):
+    name, ext = os.path.splitext(db.test_database)
+    db.test_database = '{}_{}{}'.format(
+        name, os.environ['PYTEST_XDIST_WORKER'], ext)
+in_memory = db.test_database == ':memory:' and not db.use_postgresql
+
+
+def setUpModule():
+    """Creates the test database and its tables once for all tests."""
+    db.create_database(test=True)
+    db.create_all(test=True)
+
+
+def tearDownModule():
+    db.drop_all(test=True)
+    db.dispose_engines()
+
 
 class MyTestCase(TestCase):
+    """Runs each test in a transaction that is rolled back afterwards.
+
+    Commits made through ``app.db_session`` only release a savepoint, so the
+    tables are left empty for the next test without being rebuilt. Tests
+    that write through the engine instead set ``transactional`` to *False*;
+    the tables are rebuilt after each of their tests.
+    """
+    transactional = True
 
     def create_app(self):
         app.secret_key = 'secret_key'
@@ -19,12 +83,77 @@ class MyTestCase(TestCase):
         return app
 
     def setUp(self):
-        db.create_all(test=True)
         app.start_session(test=True)
+        app.response_cache.clear()
+        if not self.transactional:
+            return
+        self.connection = db.get_engine(test=True).connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        Session = sessionmaker(bind=self.connection)
+        event.listen(Session, 'after_transaction_end', self.restart_savepoint)
+        app.db_session = scoped_session(Session)
+
+    def restart_savepoint(self, session, transaction):
+        """Starts a new savepoint after a session commits or rolls back."""
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
+    def add_catalog(self, items=('Soup', 'Cake', 'Tea'), users=('Ann',),
+                    restaurants=('Diner',), ratings=(), **item_columns):
+        """Adds users, restaurants, menu items and ratings and commits them.
+
+        The first user creates every row. Sets ``user_id`` and
+        ``restaurant_id`` to the IDs of the first user and restaurant and
+        ``url`` to the first restaurant's "/api/menu" url.
+
+        :arg items: Item names or dicts of MenuItem columns. Items belong to
+            the first restaurant unless a dict has a 'restaurant' index.
+        :arg users: User names.
+        :arg restaurants: Restaurant names or dicts of Restaurant columns.
+        :arg ratings: (user index, item index, rating) tuples. The items'
+            rating totals are counted.
+        :arg item_columns: Columns shared by all items, like ``course``.
+        :returns: Tuple of the lists of users, restaurants and items.
+        """
+        session = app.db_session
+        users = [db.User(name=name) for name in users]
+        session.add_all(users)
+        session.flush()
+        restaurants = [db.Restaurant(created_by=users[0].id, **(
+            each if isinstance(each, dict) else dict(name=each)))
+            for each in restaurants]
+        session.add_all(restaurants)
+        session.flush()
+        rows = []
+        for each in items:
+            columns = dict(item_columns)
+            columns.update(each if isinstance(each, dict) else dict(name=each))
+            restaurant = restaurants[columns.pop('restaurant', 0)]
+            rows.append(db.MenuItem(restaurant_id=restaurant.id,
+                                    created_by=users[0].id, **columns))
+        session.add_all(rows)
+        session.flush()
+        for user, item, rating in ratings:
+            session.add(db.MenuItemRating(user_id=users[user].id,
+                                          item_id=rows[item].id,
+                                          rating=rating))
+        if ratings:
+            db.update_rating_counts(session)
+        session.commit()
+        self.user_id = users[0].id
+        self.restaurant_id = restaurants[0].id
+        self.url = '/api/menu/restaurant_id={}'.format(self.restaurant_id)
+        return users, restaurants, rows
 
     def tearDown(self):
-        app.db_session.close()
-        db.drop_all(test=True)
+        app.db_session.remove()
+        if self.transactional:
+            self.transaction.rollback()
+            self.connection.close()
+        else:
+            db.drop_all(test=True)
+            db.create_all(test=True)
 
 
 class TestNoLoginPageLoadingAndRedirect(MyTestCase):
@@ -139,6 +268,1019 @@ class TestNoLoginResponses(MyTestCase):
 #        self.assertDictContainsSubset(mi_data, r0)
 
 
+class TestItemsResponse(MyTestCase):
+    """Test menu item lists with rating totals."""
+
+    def setUp(self):
+        super(TestItemsResponse, self).setUp()
+        # Cake: two favorites, Tea: one good, Soup: one bad.
+        self.add_catalog(users=('Ann', 'Bob', 'Cat'),
+                         ratings=[(0, 1, 1), (1, 1, 1), (0, 2, 2), (2, 0, 3)])
+
+    def test_items_sorted_by_popularity(self):
+        response = self.client.get('/items?id={}'.format(self.restaurant_id))
+        self.assert200(response)
+        items = response.json['items']
+        self.assertEqual([each['name'] for each in items],
+                         ['Cake', 'Tea', 'Soup'])
+        self.assertEqual(items[0]['favorite_count'], 2)
+        self.assertEqual(items[1]['good_count'], 1)
+        self.assertEqual(items[2]['bad_count'], 1)
+        self.assertEqual(items[0]['restaurant_name'], 'Diner')
+        self.assertEqual([each['rating'] for each in items], [0, 0, 0])
+
+    def test_items_include_user_rating(self):
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+        response = self.client.get('/items?id={}'.format(self.restaurant_id))
+        self.assert200(response)
+        ratings = [each['rating'] for each in response.json['items']]
+        self.assertEqual(ratings, [1, 2, 0])
+
+    def test_items_pages_follow_popularity(self):
+        url = '/items?id={}&limit=2'.format(self.restaurant_id)
+        response = self.client.get(url)
+        self.assert200(response)
+        names = [each['name'] for each in response.json['items']]
+        self.assertEqual(names, ['Cake', 'Tea'])
+        response = self.client.get(url + '&after=' + response.json['next'])
+        self.assert200(response)
+        names = [each['name'] for each in response.json['items']]
+        self.assertEqual(names, ['Soup'])
+        self.assertIsNone(response.json['next'])
+
+    def test_items_without_paging_args(self):
+        response = self.client.get('/items?id={}'.format(self.restaurant_id))
+        self.assertNotIn('next', response.json)
+        response = self.client.get('/items?id=1&after=bad')
+        self.assert400(response)
+
+    def test_favorites_sample(self):
+        url = '/api/favorites?user_id={}'.format(self.user_id)
+        response = self.client.get(url)
+        self.assert200(response)
+        self.assertEqual([each['name'] for each in response.json['items']],
+                         ['Cake'])
+        self.assertEqual(response.json['items'][0]['restaurant_name'],
+                         'Diner')
+        response = self.client.get(url + '&limit=0')
+        self.assertEqual(response.json['items'], [])
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+            sess['_csrf'] = 'csrf'
+        self.client.set_cookie('localhost', '_csrf', 'csrf')
+
+    def post_rating(self, item, rating):
+        return self.client.post('/ratings',
+                                data=json.dumps({'item_id': item.id,
+                                                 'rating': rating}),
+                                content_type='application/json')
+
+    def test_save_rating_updates_counts(self):
+        self.login()
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        response = self.post_rating(soup, 1)
+        self.assert200(response)
+        app.db_session.refresh(soup)
+        self.assertEqual(soup.favorite_count, 1)
+        self.assertEqual(soup.bad_count, 1)
+
+    def test_save_rating_replaces_existing_rating(self):
+        self.login()
+        cake = app.q_MenuItem().filter_by(name='Cake').one()
+        self.assert200(self.post_rating(cake, 3))
+        self.assert200(self.post_rating(cake, 3))
+        ratings = app.q_Rating().filter_by(user_id=self.user_id,
+                                           item_id=cake.id).all()
+        self.assertEqual([each.rating for each in ratings], [3])
+        app.db_session.refresh(cake)
+        self.assertEqual(cake.favorite_count, 1)
+        self.assertEqual(cake.bad_count, 1)
+
+    def test_save_ratings_batch(self):
+        self.login()
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        tea = app.q_MenuItem().filter_by(name='Tea').one()
+        ratings = [{'item_id': soup.id, 'rating': 2},
+                   {'item_id': tea.id, 'rating': 9},
+                   {'item_id': 0, 'rating': 1}]
+        response = self.client.post('/ratings/batch',
+                                    data=json.dumps({'ratings': ratings}),
+                                    content_type='application/json')
+        self.assert200(response)
+        results = {each['item_id']: each['status']
+                   for each in response.json['results']}
+        self.assertEqual(results, {soup.id: 'ok', tea.id: 'error',
+                                   0: 'error'})
+        app.db_session.refresh(soup)
+        app.db_session.refresh(tea)
+        self.assertEqual(soup.good_count, 1)
+        self.assertEqual(tea.good_count, 1)
+
+    def test_etag_not_modified(self):
+        url = '/api/menu/restaurant_id={}'.format(self.restaurant_id)
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+        # A rating changes the menu's rating totals and its ETag.
+        self.login()
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        self.assert200(self.post_rating(soup, 1))
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_items_etag_differs_by_user(self):
+        url = '/items?id={}'.format(self.restaurant_id)
+        etag = self.client.get(url).headers['ETag']
+        self.login()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(response)
+
+    def test_rating_clears_cached_menu(self):
+        self.login()
+        url = '/api/menu/restaurant_id={}'.format(self.restaurant_id)
+        hits = app.response_cache.stats()['hits']
+        menu = self.client.get(url).json['menu']
+        self.assertEqual(self.client.get(url).json['menu'], menu)
+        self.assertEqual(app.response_cache.stats()['hits'], hits + 1)
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        self.assert200(self.post_rating(soup, 1))
+        menu = self.client.get(url).json['menu']
+        counts = {each['name']: each['favorite_count'] for each in menu}
+        self.assertEqual(counts['Soup'], 1)
+
+    def test_menu_stream(self):
+        url = '/api/menu/restaurant_id={}'.format(self.restaurant_id)
+        menu = self.client.get(url).json['menu']
+        response = self.client.get(url + '?stream=1')
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(each) for each in lines], menu)
+        response = self.client.get(
+            url, headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.get_data(as_text=True).splitlines(), lines)
+
+    def test_accept_is_in_vary(self):
+        url = '/api/menu/restaurant_id={}'.format(self.restaurant_id)
+        response = self.client.get(url)
+        self.assertIn('Accept', response.vary)
+        response = self.client.get(
+            url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertStatus(response, 304)
+        self.assertIn('Accept', response.vary)
+        response = self.client.get(
+            '/api/users', headers={'Accept': 'application/x-ndjson'})
+        self.assertIn('Accept', response.vary)
+
+
+class TestMenuFilters(MyTestCase):
+    """Test menu filters and sorting by price."""
+
+    def setUp(self):
+        super(TestMenuFilters, self).setUp()
+        self.add_catalog(items=[
+            dict(name=name, price=price, course=course)
+            for name, price, course in [('Soup', '3.50', 'Appetizer'),
+                                        ('Steak', '$12', 'Entree'),
+                                        ('Pie', '.99', 'Dessert'),
+                                        ('Fish', '', 'Entree'),
+                                        ('Stew', '7.5', 'Entree')]])
+
+    def names(self, url, key='menu'):
+        response = self.client.get(url)
+        self.assert200(response)
+        return [each['name'] for each in response.json[key]]
+
+    def test_parse_price(self):
+        self.assertEqual(db.parse_price('7.50'), 750)
+        self.assertEqual(db.parse_price('.99'), 99)
+        self.assertEqual(db.parse_price(' $3 '), 300)
+        self.assertEqual(db.parse_price('7.5'), 750)
+        for price in ('', '.', 'free', '1.999', None):
+            self.assertIsNone(db.parse_price(price))
+
+    def test_filters_and_sort(self):
+        self.assertEqual(self.names(self.url + '?sort=price'),
+                         ['Pie', 'Soup', 'Stew', 'Steak', 'Fish'])
+        self.assertEqual(self.names(self.url + '?course=Entree'),
+                         ['Steak', 'Fish', 'Stew'])
+        self.assertEqual(
+            self.names(self.url + '?min_price=1&max_price=7.50&sort=price'),
+            ['Soup', 'Stew'])
+        items = '/items?id={}&course=Entree&sort=price'.format(
+            self.restaurant_id)
+        self.assertEqual(self.names(items, 'items'), ['Stew', 'Steak', 'Fish'])
+        self.assert400(self.client.get(self.url + '?max_price=cheap'))
+        self.assert400(self.client.get(self.url + '?sort=name'))
+
+    def test_price_pages(self):
+        names = []
+        url = self.url + '?sort=price&limit=2'
+        while url:
+            response = self.client.get(url).json
+            names += [each['name'] for each in response['menu']]
+            url = response['next'] and '{}?sort=price&limit=2&after={}'.format(
+                self.url, response['next'])
+        self.assertEqual(names, ['Pie', 'Soup', 'Stew', 'Steak', 'Fish'])
+
+    def test_price_pages_after_unpriced_items(self):
+        app.db_session.add(db.MenuItem(
+            name='Bread', price='free', restaurant_id=self.restaurant_id,
+            created_by=app.q_User().one().id))
+        app.db_session.commit()
+        names = []
+        url = self.url + '?sort=price&limit=1'
+        while url:
+            response = self.client.get(url).json
+            names += [each['name'] for each in response['menu']]
+            url = response['next'] and '{}?sort=price&limit=1&after={}'.format(
+                self.url, response['next'])
+        self.assertEqual(names, ['Pie', 'Soup', 'Stew', 'Steak', 'Fish',
+                                 'Bread'])
+
+    def test_backfill(self):
+        table = db.MenuItem.__table__
+        app.db_session.execute(table.update().values(price_cents=None))
+        commits = []
+        event.listen(app.db_session(), 'after_commit', commits.append)
+        self.assertEqual(db.backfill_price_cents(app.db_session,
+                                                 batch_size=2), 4)
+        # One commit per batch of 2, including the item without a price.
+        self.assertEqual(len(commits), 3)
+        steak = app.q_MenuItem().filter_by(name='Steak').one()
+        self.assertEqual(steak.price_cents, 1200)
+
+
+@unittest.skipIf(async_api is None, 'Needs Python 3 with asyncio.')
+class TestAsyncReadAPI(MyTestCase):
+    """Test that the ASGI read API returns the same JSON as the Flask API."""
+
+    def setUp(self):
+        super(TestAsyncReadAPI, self).setUp()
+        self.add_catalog(items=[dict(name=name, price=price)
+                                for name, price in [('Soup', '4'),
+                                                    ('Cake', '2.50'),
+                                                    ('Tea', '')]],
+                         ratings=[(0, 1, 1)], course='Entree')
+
+    def urls(self):
+        r_id = self.restaurant_id
+        return ['/api/restaurants',
+                '/api/restaurants?limit=1',
+                '/api/menu/restaurant_id={}'.format(r_id),
+                '/api/menu/restaurant=Diner?limit=2',
+                '/api/menu?restaurant_id={}&sort=price'.format(r_id),
+                '/items?id={}'.format(r_id),
+                '/items?id={}&limit=2'.format(r_id)]
+
+    def scope(self, url, method='GET'):
+        path, _, query = url.partition('?')
+        cookie = self.client.cookie_jar and '; '.join(
+            '{}={}'.format(c.name, c.value) for c in self.client.cookie_jar)
+        return {'type': 'http', 'method': method, 'path': path,
+                'query_string': query.encode('ascii'),
+                'headers': [(b'cookie', (cookie or '').encode('latin-1'))]}
+
+    def asgi(self, url, method='GET'):
+        """Sends a request to the ASGI app and returns (status, body)."""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            application = async_api.AsyncReadAPI(test=True)
+            loop.run_until_complete(application(self.scope(url, method),
+                                                receive, send))
+            if application.engine is not None:
+                loop.run_until_complete(application.engine.dispose())
+        finally:
+            loop.close()
+        return messages[0]['status'], messages[1]['body']
+
+    def test_statements_match_flask_json(self):
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+        for url in self.urls():
+            path, _, query = url.partition('?')
+            for pattern, build, per_user in async_api.routes:
+                match = pattern.match(path)
+                if match:
+                    break
+            params = match.groupdict()
+            if per_user:
+                params['user_id'] = async_api.AsyncReadAPI()._user_id(
+                    self.scope(url))
+                self.assertEqual(params['user_id'], self.user_id)
+            args = async_api.MultiDict(async_api.parse_qsl(query))
+            stmt, render = build(args, **params)
+            data = render(app.db_session.execute(stmt).all())
+            self.assertEqual(data, self.client.get(url).json, url)
+
+    def test_errors(self):
+        self.assertEqual(self.asgi('/api/users')[0], 404)
+        self.assertEqual(self.asgi('/api/restaurants', 'POST')[0], 405)
+        self.assertEqual(self.asgi('/items')[0], 400)
+        self.assertEqual(self.asgi('/api/restaurants?limit=x')[0], 400)
+
+    @unittest.skipIf(aiosqlite is None or db.use_postgresql or in_memory,
+                     'Needs aiosqlite and a SQLite database file.')
+    def test_responses_match_flask(self):
+        # The ASGI app reads committed rows on its own connection.
+        self.transaction.commit()
+        self.transaction = self.connection.begin()
+        try:
+            for url in self.urls():
+                status, body = self.asgi(url)
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(body.decode('utf-8')),
+                                 self.client.get(url).json, url)
+        finally:
+            for table in reversed(db.Base.metadata.sorted_tables):
+                self.connection.execute(table.delete())
+
+
+class TestCompression(MyTestCase):
+    """Test gzip responses and precompressed static files."""
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.add_catalog(items=['Dish {}'.format(n) for n in range(30)],
+                         description='Soup of the day ' * 4)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        app.compressor.static_folder = app.static_folder
+        shutil.rmtree(self.directory)
+        super(TestCompression, self).tearDown()
+
+    def test_large_json_is_gzipped(self):
+        plain = self.client.get(self.url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        response = self.client.get(
+            self.url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(response.data)).read(),
+                         plain.data)
+        # The weak ETag of the gzipped menu still matches.
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        response = self.client.get(
+            self.url, headers={'Accept-Encoding': 'gzip',
+                               'If-None-Match': response.headers['ETag']})
+        self.assertStatus(response, 304)
+
+    def test_cached_bodies_are_gzipped_once(self):
+        calls = []
+        gzip_data = compress._gzip
+
+        def counted_gzip(data, level):
+            calls.append(data)
+            return gzip_data(data, level)
+        compress._gzip = counted_gzip
+        try:
+            first, second = [self.client.get(
+                self.url, headers={'Accept-Encoding': 'gzip'})
+                for _ in range(2)]
+        finally:
+            compress._gzip = gzip_data
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(calls), 1)
+
+    def test_small_and_refused_responses_are_plain(self):
+        response = self.client.get('/api/restaurants',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = self.client.get(
+            self.url, headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_precompressed_static_files(self):
+        path = os.path.join(self.directory, 'js', 'app.js')
+        os.mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('function hello() { return "hello"; }\n' * 50)
+        with open(os.path.join(self.directory, 'font.woff'), 'w') as f:
+            f.write('font' * 100)
+        self.assertGreaterEqual(precompress(self.directory, out=None), 1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'font.woff.gz')))
+        app.compressor.static_folder = self.directory
+        response = self.client.get('/static/js/app.js',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', response.mimetype)
+        with open(path + '.gz', 'rb') as f:
+            self.assertEqual(response.data, f.read())
+        response.close()
+        response = self.client.get('/static/js/app.js')
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+        # A copy older than its file is not used.
+        os.utime(path + '.gz', (0, 0))
+        response = self.client.get('/static/js/app.js',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+
+class TestAssets(MyTestCase):
+    """Test the fingerprinted asset bundles."""
+
+    def setUp(self):
+        super(TestAssets, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'js'))
+        self.write('js/a.js', 'var a = 1;\n')
+        self.write('js/app.0123456789.js', 'var a=1;\n')
+        self.write('manifest.json',
+                   '{"js/app.js": "js/app.0123456789.js"}\n')
+
+    def tearDown(self):
+        app.assets.static_folder = app.static_folder
+        app.compressor.static_folder = app.static_folder
+        app.assets.reload()
+        shutil.rmtree(self.directory)
+        super(TestAssets, self).tearDown()
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(text)
+
+    def use_directory(self):
+        app.assets.static_folder = self.directory
+        app.compressor.static_folder = self.directory
+        app.assets.reload()
+
+    def test_bundle_sources_exist(self):
+        for sources in assets.bundles.values():
+            for source in sources:
+                self.assertTrue(os.path.isfile(
+                    os.path.join(app.static_folder, source)), source)
+
+    def test_unbuilt_bundles_link_sources(self):
+        os.remove(os.path.join(self.directory, 'manifest.json'))
+        self.use_directory()
+        response = self.client.get('/')
+        self.assertIn(b'src="/static/js/ajaj.js"', response.data)
+        self.assertIn(b'href="/static/css/main.css"', response.data)
+
+    def test_hashed_urls_are_cached(self):
+        self.use_directory()
+        url = '/static/js/app.0123456789.js'
+        with app.test_request_context():
+            self.assertEqual(app.jinja_env.globals['url_for'](
+                'static', filename='js/app.js'), url)
+            self.assertEqual(app.assets.asset_urls('js/app.js'), [url])
+        response = self.client.get(url)
+        self.assertEqual(response.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        response.close()
+        response = self.client.get('/static/js/a.js')
+        self.assertNotIn('immutable', response.headers.get('Cache-Control',
+                                                           ''))
+        response.close()
+
+
+class TestSearch(MyTestCase):
+    """Test full-text search of menu items and restaurants."""
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.add_catalog(
+            restaurants=[dict(name='Burger Barn', note='Grilled to order'),
+                         'Cafe'],
+            items=[dict(name='Cheese Burger', description='With fries'),
+                   dict(name='Veggie Burger', restaurant=1),
+                   dict(name='Soup', description='Grilled vegetables',
+                        restaurant=1)])
+
+    def search(self, q, **args):
+        args['q'] = q
+        response = self.client.get('/api/search', query_string=args)
+        self.assert200(response)
+        return response.json
+
+    def test_items_and_restaurants_match(self):
+        results = self.search('burgers')['results']
+        self.assertEqual(sorted((each['type'], each['name'])
+                                for each in results),
+                         [('item', 'Cheese Burger'), ('item', 'Veggie Burger'),
+                          ('restaurant', 'Burger Barn')])
+        results = self.search('grilled')['results']
+        self.assertEqual(sorted(each['name'] for each in results),
+                         ['Burger Barn', 'Soup'])
+        # Every word must match.
+        results = self.search('burger fries')['results']
+        self.assertEqual([each['name'] for each in results],
+                         ['Cheese Burger'])
+        self.assertEqual(self.search('"NEAR(')['results'], [])
+        self.assert400(self.client.get('/api/search?q=+'))
+
+    def test_index_follows_writes(self):
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        soup.description = 'Tomato'
+        app.db_session.commit()
+        self.assertEqual(self.search('tomato')['results'][0]['id'], soup.id)
+        self.assertEqual(self.search('vegetables')['results'], [])
+        app.db_session.delete(soup)
+        app.db_session.commit()
+        self.assertEqual(self.search('tomato')['results'], [])
+
+    def test_pages(self):
+        first = self.search('burger', limit=2)
+        self.assertEqual(len(first['results']), 2)
+        second = self.search('burger', limit=2, after=first['next'])
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next'])
+        names = [each['name'] for each in
+                 first['results'] + second['results']]
+        self.assertEqual(len(set(names)), 3)
+        self.assert400(self.client.get('/api/search?q=a&after=WyJhIl0'))
+        # Pages start after the rank, type and ID of the last result.
+        self.assertEqual(json.loads(urlsafe_b64decode(
+            first['next'] + '=' * (-len(first['next']) % 4)).decode()),
+            [first['results'][-1]['rank'], first['results'][-1]['type'],
+             first['results'][-1]['id']])
+
+    @unittest.skipIf(db.use_postgresql, 'Triggers are only used on SQLite.')
+    def test_other_columns_skip_index(self):
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        dbapi_connection = self.connection.connection
+        changes = dbapi_connection.total_changes
+        db.update_rating_counts(app.db_session, [soup.id])
+        self.connection.execute(
+            "UPDATE menu_item SET price = '2', price_cents = 200")
+        # Only the menu item rows, without search index rewrites.
+        self.assertEqual(dbapi_connection.total_changes - changes, 4)
+
+
+class TestQueryProfiler(MyTestCase):
+    """Test SQL query counting and timing per request."""
+
+    def setUp(self):
+        super(TestQueryProfiler, self).setUp()
+        app.query_profiler.reset()
+
+    def tearDown(self):
+        app.config['SQL_PROFILING'] = False
+        super(TestQueryProfiler, self).tearDown()
+
+    def test_profiling_is_off_by_default(self):
+        response = self.client.get('/api/restaurants')
+        self.assertNotIn('X-Query-Count', response.headers)
+
+    def test_query_headers_and_summary(self):
+        app.config['SQL_PROFILING'] = True
+        response = self.client.get('/api/restaurants')
+        # The shared cache versions and the restaurants.
+        self.assertEqual(response.headers['X-Query-Count'], '2')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.client.get('/api/restaurants')
+        self.assertStatus(self.client.get('/debug/queries'), 401)
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['_csrf'] = 'token'
+        self.client.set_cookie('localhost', '_csrf', 'token')
+        stats = self.client.get('/debug/queries').json['routes']
+        stats = stats['GET /api/restaurants']
+        self.assertEqual(stats['requests'], 2)
+        # The second request was answered from the response cache, which
+        # only checked the cache versions.
+        self.assertEqual(stats['max_queries'], 2)
+        self.assertEqual(stats['mean_queries'], 1.5)
+
+
+class TestMetrics(MyTestCase):
+    """Test the Prometheus metrics endpoint."""
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('h', 'Help.', ['call'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value, 'a')
+        lines = histogram.expose()
+        self.assertIn('h_bucket{call="a",le="0.1"} 1', lines)
+        self.assertIn('h_bucket{call="a",le="1.0"} 3', lines)
+        self.assertIn('h_bucket{call="a",le="+Inf"} 4', lines)
+        self.assertIn('h_count{call="a"} 4', lines)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/restaurants')
+        response = self.client.get('/metrics')
+        self.assert200(response)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('# TYPE catalog_request_duration_seconds histogram',
+                      lines)
+        self.assertTrue(any(line.startswith(
+            'catalog_requests_total{endpoint="api_restaurants",'
+            'method="GET",status="200"}') for line in lines))
+        self.assertIn('# TYPE catalog_db_pool_wait_seconds histogram', lines)
+        if not in_memory:
+            self.assertTrue(any(line.startswith(
+                'catalog_db_pool_wait_seconds_count') for line in lines))
+
+    @unittest.skipIf(in_memory, 'The in-memory database is not pooled.')
+    def test_pool_wait_is_timed_after_dispose(self):
+        engine = db.get_engine(test=True)
+        app.metrics.attach(engine)
+        engine.dispose()
+        waits = []
+        engine.pool.on_wait, on_wait = waits.append, engine.pool.on_wait
+        self.assertIsNotNone(on_wait)
+        try:
+            engine.connect().close()
+        finally:
+            engine.pool.on_wait = on_wait
+        self.assertEqual(len(waits), 1)
+
+
+class TestGoogleSignin(MyTestCase):
+    """Test signing in and out against a local Google stub server."""
+
+    def setUp(self):
+        super(TestGoogleSignin, self).setUp()
+        self.server = google_stub.serve()
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        app.config['GOOGLE_API_URL'] = url
+        app.config['GOOGLE_ACCOUNTS_URL'] = url
+        # A local file stands in for Google's signing keys.
+        handle, self.key_file = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump(GoogleStub.key_set(), f)
+        app.config['GOOGLE_CERTS_URL'] = self.key_file
+        app.google.reset()
+        GoogleStub.connections.clear()
+        GoogleStub.claims = {}
+
+    def tearDown(self):
+        app.google.reset()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.key_file)
+        for key, value in app.google.defaults.items():
+            app.config[key] = value
+        super(TestGoogleSignin, self).tearDown()
+
+    def gconnect(self):
+        return self.client.post('/gconnect',
+                                data=json.dumps({'data': 'code'}),
+                                content_type='application/json')
+
+    def test_signin_and_signout(self):
+        response = self.gconnect()
+        self.assert200(response)
+        self.assertEqual(response.json['username'], 'Dee')
+        self.assertEqual(app.q_User().filter_by(name='Dee').count(), 1)
+        response = self.client.post('/gdisconnect')
+        self.assert200(response)
+        # All three calls to Google used one kept-alive connection.
+        self.assertEqual(len(GoogleStub.connections), 1)
+
+    def test_signin_rejects_other_audience(self):
+        GoogleStub.claims = {'aud': 'other-app'}
+        self.assert401(self.gconnect())
+
+    def test_keys_load_over_http_on_fresh_client(self):
+        # The first call to Google loads the keys and opens the session.
+        app.config['GOOGLE_CERTS_URL'] = app.config['GOOGLE_API_URL'] + \
+            '/certs'
+        app.google.reset()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            app.google.verify_id_token(GoogleStub.id_token(),
+                                       GoogleStub.client_id)))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'Loading the keys hung.')
+        self.assertEqual(result[0]['sub'], '42')
+
+    def test_id_token_checks(self):
+        verify = app.google.verify_id_token
+        aud = GoogleStub.client_id
+        claims = verify(GoogleStub.id_token(), aud)
+        self.assertEqual(claims['sub'], '42')
+        for token in [GoogleStub.id_token(exp=int(time.time()) - 3600),
+                      GoogleStub.id_token(iss='evil.example.com'),
+                      GoogleStub.id_token()[:-4] + 'AAAA']:
+            with self.assertRaises(GoogleError):
+                verify(token, aud)
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test the LRU, TTL and invalidation rules of the response cache."""
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_entry_is_missing(self):
+        cache = ResponseCache(ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_invalidate_by_tag(self):
+        cache = ResponseCache()
+        cache.set('menu1', 1, [('menu_id', 1)])
+        cache.set('menu2', 2, [('menu_id', 2)])
+        generation = cache.generation
+        cache.invalidate(('menu_id', 1))
+        self.assertIsNone(cache.get('menu1'))
+        self.assertEqual(cache.get('menu2'), 2)
+        # Values read before an invalidation are not stored.
+        cache.set('menu1', 1, [('menu_id', 1)], generation=generation)
+        self.assertIsNone(cache.get('menu1'))
+
+
+class TestSharedCacheVersions(MyTestCase):
+    """Test response cache versions shared through the database."""
+
+    def setUp(self):
+        super(TestSharedCacheVersions, self).setUp()
+        # A cache of another server process using the same database.
+        self.other = ResponseCache(
+            versions=DatabaseVersions(lambda: app.db_session))
+
+    def test_invalidate_is_seen_by_other_caches(self):
+        tags = [('menu_id', 1), 'restaurants']
+        etag = self.other.version(*tags)
+        self.other.set('menu1', b'old', tags)
+        app.response_cache.invalidate(('menu_id', 1))
+        app.db_session.commit()
+        self.assertNotEqual(self.other.version(*tags), etag)
+        self.assertIsNone(self.other.get('menu1'))
+        row = app.db_session.query(db.CacheVersion).get(u'menu_id:1')
+        self.assertEqual(row.version, 1)
+
+    def test_rolled_back_write_keeps_versions(self):
+        etag = self.other.version('users')
+        app.response_cache.invalidate('users')
+        app.db_session.rollback()
+        self.assertEqual(self.other.version('users'), etag)
+
+
+class TestDatabaseSession(MyTestCase):
+    """Test the shared engine and thread-local sessions."""
+
+    transactional = False
+
+    def test_engine_is_reused(self):
+        self.assertIs(db.get_engine(test=True), db.get_engine(test=True))
+
+    def test_sessions_are_thread_local(self):
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(app.db_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], app.db_session())
+        self.assertIs(sessions[0].bind, app.db_session().bind)
+
+    def test_migrate_adds_missing_indexes(self):
+        engine = db.get_engine(test=True)
+        engine.execute('DROP INDEX ix_menu_item_price')
+        # An index of older databases that is no longer needed.
+        engine.execute('CREATE INDEX ix_menu_item_restaurant_id '
+                       'ON menu_item (restaurant_id)')
+        db.migrate(test=True)
+        names = [i['name'] for i in inspect(engine).get_indexes('menu_item')]
+        self.assertIn('ix_menu_item_price', names)
+        self.assertNotIn('ix_menu_item_restaurant_id', names)
+
+    @unittest.skipUnless(db.use_postgresql,
+                         'Only PostgreSQL marks failed index builds invalid.')
+    def test_migrate_rebuilds_invalid_indexes(self):
+        engine = db.get_engine(test=True)
+        # What a failed "CREATE INDEX CONCURRENTLY" leaves behind.
+        engine.execute("UPDATE pg_index SET indisvalid = false WHERE "
+                       "indexrelid = 'ix_menu_item_price'::regclass")
+        db.migrate(test=True)
+        with engine.connect() as conn:
+            self.assertTrue(db._valid_index(conn, 'ix_menu_item_price'))
+
+    def test_migrate_recounts_added_totals(self):
+        items = self.add_catalog(items=['Soup'], ratings=[(0, 0, 1)])[2]
+        item_id = items[0].id
+        app.db_session.remove()
+        # A database from before the stored totals.
+        engine = db.get_engine(test=True)
+        engine.execute('DROP INDEX ix_menu_item_popularity')
+        for column in ('favorite_count', 'good_count', 'bad_count'):
+            engine.execute('ALTER TABLE menu_item DROP COLUMN ' + column)
+        db.migrate(test=True)
+        self.assertEqual(engine.execute(
+            'SELECT favorite_count FROM menu_item WHERE id = {}'
+            .format(item_id)).scalar(), 1)
+
+    def test_migrate_adds_missing_tables(self):
+        engine = db.get_engine(test=True)
+        engine.execute('DROP TABLE cache_version')
+        db.migrate(test=True)
+        self.assertIn('cache_version', inspect(engine).get_table_names())
+
+
+class TestCreateApp(MyTestCase):
+    """Test the production app factory and fork handling."""
+
+    transactional = False
+
+    def setUp(self):
+        super(TestCreateApp, self).setUp()
+        self.secret_key = app.config['SECRET_KEY']
+        self.pool_size = db.pool_size
+
+    def tearDown(self):
+        app.config['SECRET_KEY'] = self.secret_key
+        db.pool_size = self.pool_size
+        db.reset_engines()
+        super(TestCreateApp, self).tearDown()
+
+    def test_secret_key_is_required(self):
+        app.config['SECRET_KEY'] = None
+        self.assertRaises(RuntimeError, create_app)
+
+    def test_settings(self):
+        self.assertIs(create_app(dict(SECRET_KEY='shared',
+                                      DATABASE_POOL_SIZE=2)), app)
+        self.assertEqual(app.secret_key, 'shared')
+        self.assertEqual(db.pool_size, 2)
+        self.assert200(self.client.get('/api/restaurants'))
+
+    @unittest.skipIf(in_memory, 'In-memory databases have no pool size.')
+    def test_pool_settings_replace_engine(self):
+        engine = db.get_engine(test=True)
+        create_app(dict(SECRET_KEY='shared', DATABASE_POOL_SIZE=2))
+        self.assertIsNot(db.get_engine(test=True), engine)
+        self.assertEqual(db.get_engine(test=True).pool.size(), 2)
+        self.assert200(self.client.get('/api/restaurants'))
+
+    @unittest.skipIf(in_memory, 'Disposing loses an in-memory database.')
+    def test_after_fork_replaces_pool(self):
+        engine = db.get_engine(test=True)
+        pool = engine.pool
+        session = app.db_session()
+        after_fork()
+        self.assertIsNot(engine.pool, pool)
+        self.assertIsNot(app.db_session(), session)
+        self.assert200(self.client.get('/api/restaurants'))
+
+
+class TestBulkLoad(MyTestCase):
+    """Test loading CSV and JSON files with the bulk loader."""
+
+    transactional = False
+
+    def setUp(self):
+        super(TestBulkLoad, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        files = {
+            'users.csv': 'name,email,picture\n'
+                         'Ann,ann@example.com,\n'
+                         'Bob,bob@example.com,\n',
+            'restaurants.json': json.dumps([
+                {'name': 'Diner', 'phone': '555-1234',
+                 'created_by': 'ann@example.com'}]),
+            'menu_items.csv': 'restaurant,name,price,course,created_by\n'
+                              'Diner,Soup,2.50,Appetizer,ann@example.com\n'
+                              'Diner,Cake,3.99,Dessert,bob@example.com\n'
+                              'Diner,Tea,1.00,Beverage,bob@example.com\n',
+            'ratings.csv': 'user,restaurant,item,rating\n'
+                           'ann@example.com,Diner,Cake,1\n'
+                           'bob@example.com,Diner,Cake,1\n'
+                           'bob@example.com,Diner,Soup,3\n',
+        }
+        for name, data in files.items():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestBulkLoad, self).tearDown()
+
+    def load(self):
+        loader = BulkLoader(db.get_engine(test=True), batch_size=2, out=None)
+        return {each['name']: each for each in
+                loader.load_directory(self.directory)}
+
+    def test_load_resolves_foreign_keys(self):
+        stats = self.load()
+        self.assertEqual(stats['menu_items']['loaded'], 3)
+        cake = app.q_MenuItem().filter_by(name='Cake').one()
+        self.assertEqual(cake.restaurant.name, 'Diner')
+        bob = app.q_User().filter_by(email='bob@example.com').one()
+        self.assertEqual(cake.created_by, bob.id)
+        self.assertEqual(cake.favorite_count, 2)
+        soup = app.q_MenuItem().filter_by(name='Soup').one()
+        rating = app.q_Rating().filter_by(item_id=soup.id).one()
+        self.assertEqual((rating.user_id, rating.rating), (bob.id, 3))
+
+    def test_load_again_skips_existing_rows(self):
+        self.load()
+        stats = self.load()
+        self.assertEqual([each['loaded'] for each in stats.values()],
+                         [0, 0, 0, 0])
+        self.assertEqual(stats['ratings']['skipped'], 3)
+        self.assertEqual(app.q_MenuItem().count(), 3)
+
+    def test_unknown_foreign_key(self):
+        with open(os.path.join(self.directory, 'ratings.csv'), 'a') as f:
+            f.write('cat@example.com,Diner,Tea,2\n')
+        with self.assertRaises(ValueError):
+            self.load()
+
+
+class TestGenerateData(MyTestCase):
+    """Test the synthetic catalog generator."""
+
+    transactional = False
+
+    def test_generate_writes_rows(self):
+        generate_data.generate(5, 3, 4, 30, seed=1, test=True, out=None)
+        self.assertEqual(app.q_User().count(), 5)
+        self.assertEqual(app.q_MenuItem().count(), 12)
+        self.assertEqual(app.q_Rating().count(), 30)
+        totals = sum(item.favorite_count + item.good_count + item.bad_count
+                     for item in app.q_MenuItem())
+        self.assertEqual(totals, 30)
+
+    def test_ratings_are_repeatable_and_skewed(self):
+        def ratings(seed):
+            rng = random.Random(seed)
+            return list(generate_data.generate_ratings(rng, 200, 10, 10,
+                                                       2000))
+        self.assertEqual(ratings(1), ratings(1))
+        self.assertNotEqual(ratings(1), ratings(2))
+        counts = Counter((each['restaurant'], each['item'])
+                         for each in ratings(1)).most_common()
+        self.assertGreater(counts[0][1], 5 * counts[len(counts) // 2][1])
+
+    def test_ratings_can_fill_every_pair(self):
+        rng = random.Random(1)
+        ratings = list(generate_data.generate_ratings(rng, 20, 5, 10, 1000))
+        pairs = set((each['user'], each['restaurant'], each['item'])
+                    for each in ratings)
+        self.assertEqual(len(ratings), 1000)
+        self.assertEqual(len(pairs), 1000)
+
+    def test_stalled_ratings_at_large_scale(self):
+        # A steep zipf fills the top item's pairs and stalls the weighted
+        # picks long before users * items pairs could be listed.
+        rng = random.Random(1)
+        max_misses = generate_data.max_misses
+        generate_data.max_misses = 10
+        try:
+            ratings = list(generate_data.generate_ratings(
+                rng, 100000, 5000, 30, 200000, zipf=3.0))
+        finally:
+            generate_data.max_misses = max_misses
+        pairs = set((each['user'], each['restaurant'], each['item'])
+                    for each in ratings)
+        self.assertEqual(len(pairs), 200000)
+        items = set(pair[1:] for pair in pairs)
+        self.assertGreater(len(items), 1000)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test the benchmark's comparison with a baseline."""
+
+    result = dict(p50=1.0, p95=2.0, p99=4.0, queries=2.0, peak_kb=100.0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+
+    def test_compare_within_tolerance(self):
+        result = dict(self.result, p95=2.2, peak_kb=120.0)
+        self.assertEqual(benchmark.compare({'a': result},
+                                           {'a': self.result}), [])
+
+    def test_compare_finds_regressions(self):
+        result = dict(self.result, p95=20.0, queries=3.0, peak_kb=500.0)
+        regressions = benchmark.compare({'a': result, 'b': result},
+                                        {'a': self.result})
+        self.assertEqual(len(regressions), 3)
+
+
+@unittest.skipIf(in_memory, 'The server process needs a database file.')
 class MyLiveTest(LiveServerTestCase):
 
     def create_app(self):
@@ -148,13 +1290,10 @@ class MyLiveTest(LiveServerTestCase):
         return app
 
     def setUp(self):
-        db.create_all(test=True)
         app.start_session(test=True)
 
     def tearDown(self):
-        app.db_session.close()
-        db.drop_all(test=True)
-
+        app.db_session.remove()
 
     def test_server_is_up_and_running(self):
         response = requests.get(self.get_server_url())
@@ -0,0 +1,97 @@
+"""
+Local stand-in for the Google endpoints used by ``catalog/signin.py``.
+
+``serve`` starts it in a background thread. Point the app's
+``GOOGLE_API_URL``, ``GOOGLE_ACCOUNTS_URL`` and ``GOOGLE_CERTS_URL``
+(plus "/certs") at its address to sign in without reaching Google. Used by
+``catalog_app_test.py`` and ``catalog_app_benchmark.py``.
+"""
+import json
+import time
+import threading
+import rsa
+from base64 import urlsafe_b64encode
+from binascii import unhexlify
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+def _b64(data):
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+class GoogleStub(BaseHTTPRequestHandler):
+    """Local stand-in for the Google endpoints used by signin.py."""
+
+    protocol_version = 'HTTP/1.1'  # Keep connections alive.
+    # Send the body at once rather than after the client's delayed ACK.
+    disable_nagle_algorithm = True
+    client_id = ('494203108202-8qijkubc2hiio08dptgb5cc21su8qf84'
+                 '.apps.googleusercontent.com')
+    public_key, private_key = rsa.newkeys(512)
+    connections = set()
+    claims = {}
+
+    @classmethod
+    def key_set(cls):
+        def number(value):
+            return _b64(unhexlify('{:x}'.format(value).zfill(
+                (value.bit_length() + 7) // 8 * 2)))
+        return {'keys': [{'kty': 'RSA', 'alg': 'RS256', 'kid': 'stub',
+                          'n': number(cls.public_key.n),
+                          'e': number(cls.public_key.e)}]}
+
+    @classmethod
+    def id_token(cls, **claims):
+        now = int(time.time())
+        claims = dict(dict(sub='42', aud=cls.client_id,
+                           iss='https://accounts.google.com', iat=now,
+                           exp=now + 3600), **claims)
+        signed = '.'.join(
+            _b64(json.dumps(each).encode('utf-8'))
+            for each in ({'alg': 'RS256', 'kid': 'stub'}, claims))
+        signature = rsa.sign(signed.encode('ascii'), cls.private_key,
+                             'SHA-256')
+        return signed + '.' + _b64(signature)
+
+    def respond(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        GoogleStub.connections.add(self.client_address)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.respond({'access_token': 'token',
+                      'id_token': self.id_token(**GoogleStub.claims)})
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/oauth2/v1/userinfo':
+            self.respond({'name': 'Dee', 'email': 'dee@example.com',
+                          'picture': ''})
+        elif path == '/certs':
+            self.respond(self.key_set())
+        else:
+            self.respond({})
+
+    def log_message(self, *args):
+        pass
+
+
+def serve():
+    """Starts a stub server on a free local port in a daemon thread.
+
+    :returns: The HTTPServer. Call its ``shutdown`` and ``server_close``
+        methods to stop it.
+    """
+    server = HTTPServer(('127.0.0.1', 0), GoogleStub)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,27 @@
+"""
+Gunicorn settings for ``wsgi.py``. Options given on the command line or in
+``GUNICORN_CMD_ARGS`` take precedence.
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get('CATALOG_BIND', '0.0.0.0:8000')
+# One worker per core, plus one to cover workers waiting on the database.
+workers = int(os.environ.get('CATALOG_WORKERS',
+                             multiprocessing.cpu_count() + 1))
+# Load the app once before forking, so workers share its memory pages. Each
+# worker caches responses in its own memory, checked against the cache
+# versions in the database (see `catalog/cache.py`), and the preloaded app
+# gives all workers the same ETags.
+preload_app = True
+# Restart workers after a while so slow leaks can't build up.
+max_requests = 10000
+max_requests_jitter = 1000
+timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    """Drops database connections the worker inherited from the master."""
+    from catalog import after_fork
+    after_fork()
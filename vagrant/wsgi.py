@@ -0,0 +1,21 @@
+"""
+WSGI entry point of the Item Catalog app for production servers.
+
+The settings are read from the Python file named by the ``CATALOG_SETTINGS``
+environment variable, for example::
+
+    SECRET_KEY = 'long random text shared by all workers'
+    DATABASE_NAME = 'restaurants'
+    DATABASE_POOL_SIZE = 5
+    GOOGLE_CLIENT_SECRETS = '/vagrant/clientsecrets.json'
+
+Run the app with several worker processes under a pre-fork server from the
+``vagrant`` directory::
+
+    CATALOG_SETTINGS=/etc/catalog.cfg gunicorn -c gunicorn.conf.py wsgi:app
+
+See ``create_app`` in `catalog/__init__.py` for the settings.
+"""
+from catalog import create_app
+
+app = application = create_app()